@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# aqi_grid.py
+"""
+ICA/AQI de la EPA sobre arreglos completos (2-D o 3-D), con las mismas tablas
+de cortes y reglas que src/lib/aqui.ts (PM25_BP, O3_BP, NO2_BP, lerpAQI, aqiCategory):
+ - El tramo de cada celda es searchsorted sobre Clow (calculado como conteo de
+   comparaciones, por bloques); la interpolación lineal se evalúa vectorizada.
+ - Igual que lerpAQI: valores entre Chigh de un tramo y Clow del siguiente,
+   o fuera de la tabla, no tienen índice (NaN); redondeo "half up" como Math.round.
+ - AQI final = máximo por pollutant; category = índice en CATEGORIES;
+   dominant = índice en POLLUTANTS (-1 = sin dato).
+
+Uso (snapshots .npy + .json de tempo_grid con concentraciones en superficie):
+  python aqi_grid.py --no2 no2_ppb.npy --pm25 pm25.npy --out ./aqi/2025-10-04T15
+"""
+from pathlib import Path
+from typing import Dict, Optional
+import argparse
+import logging
+
+import numpy as np
+
+# (Clow, Chigh, Ilow, Ihigh), igual que src/lib/aqui.ts
+PM25_BP = np.array([
+    (0.0, 12.0, 0, 50),
+    (12.1, 35.4, 51, 100),
+    (35.5, 55.4, 101, 150),
+    (55.5, 150.4, 151, 200),
+    (150.5, 250.4, 201, 300),
+    (250.5, 500.4, 301, 500),
+], dtype=np.float64)
+
+O3_BP = np.array([
+    (0, 54, 0, 50),
+    (55, 70, 51, 100),
+    (71, 85, 101, 150),
+    (86, 105, 151, 200),
+    (106, 200, 201, 300),
+], dtype=np.float64)
+
+# NO2 en ppb; ppb ≈ 0.522 * µg/m3
+NO2_BP = np.array([
+    (0, 53, 0, 50),
+    (54, 100, 51, 100),
+    (101, 360, 101, 150),
+    (361, 649, 151, 200),
+    (650, 1249, 201, 300),
+], dtype=np.float64)
+
+POLLUTANTS = ("pm25", "o3", "no2")
+TABLES = {"pm25": PM25_BP, "o3": O3_BP, "no2": NO2_BP}
+UGM3_TO_PPB = {"o3": 0.5, "no2": 0.522}   # mismas aproximaciones que computeAQI
+CATEGORY_LIMITS = np.array([50, 100, 150, 200, 300], dtype=np.float64)
+BLOCK = 1 << 15   # celdas por bloque en lerp_aqi
+CATEGORIES = ("Bueno", "Moderado", "Dañino p/grupos sensibles", "Dañino", "Muy dañino", "Peligroso")
+
+def lerp_aqi(conc, table: np.ndarray) -> np.ndarray:
+    """
+    Sub-índice de un pollutant para todo el arreglo (NaN fuera de la tabla o en huecos).
+    El tramo es searchsorted(Clow, c, side="right") - 1; con tablas de <= 6 cortes
+    se calcula como suma de comparaciones, por bloques que caben en caché.
+    """
+    c = np.asarray(conc, dtype=np.float64)
+    clow, chigh, ilow, ihigh = table.T
+    slope = (ihigh - ilow) / (chigh - clow)
+    flat = c.ravel()
+    out = np.empty(flat.size, dtype=np.float64)
+    k = np.empty(min(BLOCK, flat.size), dtype=np.intp)
+    ge = np.empty(k.size, dtype=bool)
+    for s in range(0, flat.size, BLOCK):
+        x = flat[s:s + BLOCK]
+        o = out[s:s + BLOCK]
+        kk, t = k[:x.size], ge[:x.size]
+        kk[:] = 0
+        for edge in clow[1:]:
+            np.greater_equal(x, edge, out=t)
+            kk += t
+        bad = ~(x >= clow[0])                 # negativos y NaN
+        bad |= ~(x <= chigh.take(kk))         # huecos entre tramos y sobre la tabla
+        np.subtract(x, clow.take(kk), out=o)
+        o *= slope.take(kk)
+        o += ilow.take(kk)
+        o += 0.5                              # Math.round: redondeo hacia arriba en .5
+        np.floor(o, out=o)
+        o[bad] = np.nan
+    return out.reshape(c.shape)
+
+def aqi_category(aqi) -> np.ndarray:
+    """Código de categoría (índice en CATEGORIES) por celda; -1 donde no hay AQI."""
+    a = np.asarray(aqi, dtype=np.float64)
+    code = np.zeros(a.shape, dtype=np.int8)
+    for limit in CATEGORY_LIMITS:   # == searchsorted(CATEGORY_LIMITS, a, side="left")
+        code += a > limit
+    code[~np.isfinite(a)] = -1
+    return code
+
+def compute_aqi(pm25=None, o3=None, no2=None, units: Optional[Dict[str, str]] = None) -> Dict[str, np.ndarray]:
+    """
+    AQI de arreglos de concentración de igual forma (None = pollutant ausente).
+    units: {"o3": "ppb"|"µg/m3", "no2": "ppb"|"µg/m3"}; PM2.5 siempre en µg/m3.
+    Retorna aqi (float32, NaN = sin dato), category (int8), dominant (int8) y
+    by_pollutant (sub-índices float32). Se procesa por bloques de BLOCK celdas.
+    """
+    units = units or {}
+    given = {"pm25": pm25, "o3": o3, "no2": no2}
+    inputs = {}
+    for name in POLLUTANTS:
+        if given[name] is None:
+            continue
+        conc = np.asarray(given[name])
+        factor = UGM3_TO_PPB.get(name, 1.0) if units.get(name) in ("µg/m3", "ug/m3") else 1.0
+        inputs[name] = (conc.ravel(), factor)
+    if not inputs:
+        raise ValueError("se necesita al menos un pollutant")
+    shape = np.asarray(next(v for v in given.values() if v is not None)).shape
+    size = int(np.prod(shape))
+    aqi = np.empty(size, dtype=np.float32)
+    category = np.empty(size, dtype=np.int8)
+    dominant = np.empty(size, dtype=np.int8)
+    by_pollutant = {name: np.empty(size, dtype=np.float32) for name in inputs}
+    for s in range(0, size, BLOCK):
+        e = min(size, s + BLOCK)
+        best = np.full(e - s, -np.inf)
+        dom = dominant[s:e]
+        dom[:] = -1
+        # Máximo por celda; con ">" estricto un empate queda en el primero de POLLUTANTS
+        for name, (flat, factor) in inputs.items():
+            x = flat[s:e].astype(np.float64)
+            if factor != 1.0:
+                x *= factor
+            sub = lerp_aqi(x, TABLES[name])
+            by_pollutant[name][s:e] = sub
+            upd = sub > best
+            best[upd] = sub[upd]
+            dom[upd] = POLLUTANTS.index(name)
+        best[dom < 0] = np.nan
+        aqi[s:e] = best
+        category[s:e] = aqi_category(best)
+    return {
+        "aqi": aqi.reshape(shape),
+        "category": category.reshape(shape),
+        "dominant": dominant.reshape(shape),
+        "by_pollutant": {n: v.reshape(shape) for n, v in by_pollutant.items()},
+    }
+
+def main(argv=None):
+    from tempo_grid import open_snapshot, write_snapshot
+    parser = argparse.ArgumentParser(description="AQI EPA sobre grillas de concentración en superficie.")
+    parser.add_argument("--pm25", default="", help="Snapshot .npy de PM2.5 (µg/m3)")
+    parser.add_argument("--o3", default="", help="Snapshot .npy de O3")
+    parser.add_argument("--no2", default="", help="Snapshot .npy de NO2")
+    parser.add_argument("--o3-units", default="ppb", choices=["ppb", "µg/m3", "ug/m3"])
+    parser.add_argument("--no2-units", default="ppb", choices=["ppb", "µg/m3", "ug/m3"])
+    parser.add_argument("--out", required=True, help="Prefijo de salida (<out>_aqi.npy, _category, _dominant)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    inputs, grid, meta = {}, None, {}
+    for name in POLLUTANTS:
+        path = getattr(args, name)
+        if not path:
+            continue
+        values, g, m = open_snapshot(Path(path))
+        if grid is not None and g.to_dict() != grid.to_dict():
+            parser.error(f"{path}: grilla distinta a la de los demás pollutants")
+        grid, meta = g, m
+        inputs[name] = values
+    if not inputs:
+        parser.error("indique al menos --pm25, --o3 o --no2")
+
+    res = compute_aqi(**inputs, units={"o3": args.o3_units, "no2": args.no2_units})
+    out = Path(args.out)
+    base_meta = {k: v for k, v in meta.items() if k in ("timeISO", "source")}
+    for key in ("aqi", "category", "dominant"):
+        extra = {"categories": list(CATEGORIES)} if key == "category" else \
+                {"pollutants": list(POLLUTANTS)} if key == "dominant" else {}
+        write_snapshot(res[key], grid, {**base_meta, "layer": key, **extra}, out.with_name(f"{out.name}_{key}"))
+    valid = np.isfinite(res["aqi"])
+    if valid.any():
+        logging.info(f"AQI máx {np.nanmax(res['aqi']):.0f}; celdas con dato: {int(valid.sum())}")
+    logging.info(f"[OK] {out}_aqi.npy, {out}_category.npy, {out}_dominant.npy")
+
+if __name__ == "__main__":
+    main()
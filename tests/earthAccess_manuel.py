@@ -2,6 +2,9 @@ import datetime as dt
 import earthaccess as ea
 import xarray as xr
 import numpy as np
+from pathlib import Path
+
+from tempo_store import GranuleStore
 
 DATE = dt.date(2025, 10, 4)
 t0 = f"{DATE}T00:00:00Z"
@@ -22,18 +25,23 @@ print("Granulos encontrados:", len(results))
 for r in results[:3]:
     print("→", r.data_links()[0])
 
-# 2) Descarga y lectura
-if results:
-    [path] = ea.download(results[:1], "./data_tempo")
-    ds = xr.open_dataset(path, group="product")
-    no2 = ds["vertical_column_troposphere"]  # molecules/cm^2
-    print("NO2 mean:", float(no2.mean().values))
-else:
+# 2) Descarga y lectura (el manifiesto evita re-descargar granulos ya verificados)
+store = GranuleStore(Path("./data_tempo"))
+if not results:
     print("Sin resultados: pruebe sin 'temporal' o cambie la fecha +/-1 día.")
+    raise SystemExit(1)
+paths = store.ensure(results[:1], CID)
+if not paths:
+    print("[ERROR] No se pudo descargar ni verificar el primer granulo "
+          f"({results[0].data_links()[0] if results[0].data_links() else 'sin enlace'}); revise el log.")
+    raise SystemExit(1)
+path = paths[0]
+ds = xr.open_dataset(path, group="product")
+no2 = ds["vertical_column_troposphere"]  # molecules/cm^2
+print("NO2 mean:", float(no2.mean().values))
 
 #------------------------------------------------------------------------------------
-# Descargar el primer granulo (puede cambiar el índice)
-[path] = ea.download(results[:1], "./data_tempo")
+# Primer granulo: ya está en el almacén local (puede cambiar el índice)
 
 print(f"Archivo descargado: {path}")
 
@@ -49,13 +57,15 @@ mean_gt = float(no2_gt.mean().values)
 
 print(f"Promedio NO₂ sobre Guatemala: {mean_gt:.3e} mol/cm²")
 
-# Exportar a GeoTIFF (opcional)
+# Exportar a Cloud-Optimized GeoTIFF (opcional): un COG teselado, comprimido y con
+# overviews por paso de tiempo, generados en paralelo y validados (ver tempo_cog.py).
+# Para el día completo: python tempo_cog.py --data-dir ./data_tempo --bbox -93 8 -87 19
 try:
-    import rioxarray
-    no2_gt = no2_gt.rio.write_crs("EPSG:4326", inplace=True)
-    geotiff_path = f"./data_tempo/TEMPO_NO2_GT_{DATE.isoformat()}.tif"
-    no2_gt.isel(time=0).rio.to_raster(geotiff_path)
-    print(f"[OK] Exportado GeoTIFF: {geotiff_path}")
+    from tempo_cog import export_cogs
+    cogs = export_cogs([path], Path("./data_tempo/cog"), variables=["vertical_column_troposphere"],
+                       bbox=(-93, 8, -87, 19))
+    ok = [c["path"] for c in cogs if c["status"] in ("ok", "skipped")]
+    print(f"[OK] {len(ok)}/{len(cogs)} COG exportados en ./data_tempo/cog")
 except Exception as e:
-    print("[INFO] No se exportó GeoTIFF:", e)
+    print("[INFO] No se exportó COG:", e)
 
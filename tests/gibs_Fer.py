@@ -5,19 +5,36 @@ GIBS downloader (interactivo):
  - Si no se pasa --places, pregunta en terminal por lugares (separados por coma).
  - Guarda todo en Test_gibs al lado del .py.
  - No requiere correo; usa 'anonymous' en User-Agent para Nominatim.
+ - Con --workers N prueba las combinaciones en paralelo (--collect-all para descargar todas).
+ - Con --jobs manifiesto.jsonl|csv corre sin preguntas un lote de trabajos
+   reanudable (ver gibs_batch.py).
 """
 from pathlib import Path
 import argparse
 import logging
 import csv
 import json
+import sqlite3
+import time
 import requests
 import xml.etree.ElementTree as ET
 from datetime import datetime, date
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from typing import List, Optional, Dict, Tuple
+from typing import List, Optional, Dict, Tuple, Iterable, Iterator, Callable
+import io
 import math
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+
+from gibs_time import TimeIndex
+from gibs_image_cache import ImageCache, cache_key
+from gibs_geocode import BatchGeocoder, GeocodeCache, DEFAULT_TTL_DAYS
+from gibs_download import BlankDetector, DownloadCancelled, stream_download
+from gibs_metrics import RequestMetrics, instrument_session
 
 # -------------------- CONFIG DEFAULTS --------------------
 # Constantes de configuración por defecto
@@ -33,24 +50,44 @@ DEFAULT_BBOXES = [
     [-82.7, 24.2, -79.8, 31.0],  # Florida
 ]
 DEFAULT_SIZES = [(800, 600), (1200, 900), (1600, 1200)]  # Resoluciones de prueba
+DEFAULT_WORKERS = 1     # 1 = barrido secuencial (comportamiento original)
+DEFAULT_PER_HOST = 6    # Máx solicitudes simultáneas por host
+CACHE_DIR_NAME = ".cache_gibs"   # Caché persistente junto al .py
+DEFAULT_GETCAP_TTL = 3600        # Segundos antes de revalidar GetCapabilities
+DEFAULT_IMAGE_CACHE_MB = 512     # Límite de la caché de imágenes
+DEFAULT_IMAGE_CACHE_ENTRIES = 5000
+DEFAULT_LATEST_TTL = 900         # Vigencia de imágenes TIME=latest (las fechadas no caducan)
+PARTIAL_DIR_NAME = ".partial"    # Descargas a medias (reanudables) dentro de Test_gibs
 # ---------------------------------------------------------
 
 # -------------------- UTIL / SESSION ---------------------
-def create_session(retries: int = 3, backoff: float = 0.8) -> requests.Session:
+def create_session(retries: int = 3, backoff: float = 0.8, pool_size: int = 10) -> requests.Session:
     """
     Crea una sesión HTTP con reintentos automáticos.
     - retries: número máximo de reintentos
     - backoff: tiempo de espera exponencial entre intentos
+    - pool_size: conexiones reutilizables por host (subirlo si se usan varios workers)
     """
     s = requests.Session()
     retry = Retry(total=retries, backoff_factor=backoff,
                   status_forcelist=(500, 502, 503, 504),
                   allowed_methods=frozenset(["GET", "HEAD"]))
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
     s.mount("https://", adapter)
     s.mount("http://", adapter)
+    if metrics is not None:
+        instrument_session(s, metrics)
     return s
 
+# Métricas por solicitud (--metrics / --trace); None = sin instrumentar
+metrics: Optional[RequestMetrics] = None
+
+def set_metrics(collector: Optional[RequestMetrics]):
+    """Activa las métricas (o las quita con None) en la sesión global y en las que cree create_session."""
+    global metrics
+    metrics = collector
+    instrument_session(session, collector)
+
 # Sesión global configurada
 session = create_session()
 
@@ -82,6 +119,67 @@ def parse_time_text(raw: Optional[str]) -> Optional[str]:
             return parts[1].strip()
     return t
 
+NS_WMTS = '{http://www.opengis.net/wmts/1.0}'
+NS_OWS = '{http://www.opengis.net/ows/1.1}'
+
+def layer_record(layer: ET.Element) -> Dict:
+    """
+    Extrae id, título y dimensión temporal de un elemento wmts:Layer.
+    - time_text: último valor de TIME (compatibilidad con el CSV)
+    - time_values: lista ISO 8601 completa (start/end/period, separada por comas)
+    """
+    id_el = layer.find(NS_OWS + 'Identifier')
+    title_el = layer.find(NS_OWS + 'Title')
+    time_text = None
+    time_values = None
+    # Buscar dimensión TIME (GIBS la identifica con ows:Identifier, no con atributo name)
+    for dim in layer.findall(NS_WMTS + 'Dimension'):
+        name = dim.get('name') or dim.findtext(NS_OWS + 'Identifier') or ''
+        if name.strip().lower() == 'time':
+            values = [v.text.strip() for v in dim.findall(NS_WMTS + 'Value') if v.text and v.text.strip()]
+            if not values and dim.text and dim.text.strip():
+                values = [dim.text.strip()]
+            if values:
+                time_values = ",".join(values)
+                time_text = parse_time_text(values[-1].split(',')[-1])
+            break
+    # Alternativamente, buscar en Extent
+    if time_text is None:
+        for ext in layer.findall(NS_OWS + 'Extent'):
+            if ext.get('name') and ext.get('name').lower() == 'time':
+                time_text = parse_time_text(ext.text or '')
+                break
+    return {
+        'id': id_el.text if id_el is not None else None,
+        'title': title_el.text if title_el is not None else None,
+        'time_text': time_text,
+        'time_values': time_values,
+    }
+
+def iter_capabilities(source) -> Iterator[Dict]:
+    """
+    Parser incremental de GetCapabilities (iterparse).
+    - source: archivo o stream binario/texto (p.ej. la respuesta HTTP)
+    Emite cada capa en cuanto se cierra su elemento wmts:Layer y luego lo
+    descarta del árbol, así la memoria no crece con el tamaño del catálogo.
+    """
+    stack: List[ET.Element] = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if elem.tag == NS_WMTS + 'Layer':
+            yield layer_record(elem)
+        elif not (elem.tag == NS_WMTS + 'TileMatrixSet' and stack
+                  and stack[-1].tag == NS_WMTS + 'Contents'):
+            # (los TileMatrixSet dentro de TileMatrixSetLink son parte de la capa)
+            continue
+        # Capas y TileMatrixSets ya procesados se sueltan del padre
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
 def parse_capabilities(xml_text: str) -> List[Dict]:
     """
     Parsea el XML de GetCapabilities y devuelve lista de capas con:
@@ -89,31 +187,7 @@ def parse_capabilities(xml_text: str) -> List[Dict]:
     - título
     - time_text (dimensión temporal detectada)
     """
-    ns_wmts = '{http://www.opengis.net/wmts/1.0}'
-    ns_ows = '{http://www.opengis.net/ows/1.1}'
-    root = ET.fromstring(xml_text)
-    layers = []
-    for layer in root.findall('.//' + ns_wmts + 'Layer'):
-        id_el = layer.find(ns_ows + 'Identifier')
-        title_el = layer.find(ns_ows + 'Title')
-        time_text = None
-        # Buscar dimensión TIME
-        for dim in layer.findall(ns_wmts + 'Dimension'):
-            if dim.get('name') and dim.get('name').lower() == 'time':
-                time_text = parse_time_text(dim.text or '')
-                break
-        # Alternativamente, buscar en Extent
-        if time_text is None:
-            for ext in layer.findall(ns_ows + 'Extent'):
-                if ext.get('name') and ext.get('name').lower() == 'time':
-                    time_text = parse_time_text(ext.text or '')
-                    break
-        layers.append({
-            'id': id_el.text if id_el is not None else None,
-            'title': title_el.text if title_el is not None else None,
-            'time_text': time_text
-        })
-    return layers
+    return list(iter_capabilities(io.StringIO(xml_text)))
 
 def try_parse_date(token: Optional[str]) -> Optional[date]:
     """
@@ -143,23 +217,27 @@ def save_text(path: Path, text: str):
 def save_csv(rows: List[Dict], path: Path):
     """Guarda una lista de diccionarios en CSV."""
     with path.open("w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=['id','title','time_text','last_date'])
+        w = csv.DictWriter(f, fieldnames=['id','title','time_text','last_date'], extrasaction='ignore')
         w.writeheader()
         for r in rows:
             w.writerow(r)
     logging.info(f"CSV guardado: {path}")
 
 def save_meta(meta: Dict, path: Path):
-    """Guarda un diccionario en JSON con indentación."""
-    with path.open("w", encoding="utf-8") as f:
+    """Guarda un diccionario en JSON con indentación (escritura atómica)."""
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with tmp.open("w", encoding="utf-8") as f:
         json.dump(meta, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
     logging.info(f"Meta guardada: {path}")
 
 # -------------------- GEOCODING helpers --------------------
-def geocode_place(place: str, timeout:int=10) -> Optional[List[float]]:
+def geocode_place(place: str, timeout:int=10, raise_errors: bool = False) -> Optional[List[float]]:
     """
     Geocodifica un lugar usando Nominatim (OpenStreetMap).
     Retorna bbox [minLon, minLat, maxLon, maxLat] o None si falla.
+    - raise_errors: propaga errores de red en vez de retornar None
+      (el geocodificador por lotes no cachea esos fallos)
     """
     headers = {"User-Agent": "gibs-downloader/1.0 (anonymous)"}
     params = {"q": place, "format": "json", "limit": 1, "addressdetails": 0, "polygon_geojson": 0}
@@ -177,6 +255,8 @@ def geocode_place(place: str, timeout:int=10) -> Optional[List[float]]:
         south, north, west, east = map(float, bb[:4])
         return [west, south, east, north]
     except Exception as e:
+        if raise_errors:
+            raise
         logging.warning(f"Error geocodificando '{place}': {e}")
         return None
 
@@ -196,42 +276,196 @@ def expand_bbox_km(bbox: List[float], buffer_km: float) -> List[float]:
     return [minlon - deg_lon, minlat - deg_lat, maxlon + deg_lon, maxlat + deg_lat]
 
 # -------------------- DOWNLOAD FLOW ---------------------
-def fetch_getcap(session: requests.Session, out_dir: Path) -> str:
+class CapabilitiesCache:
     """
-    Descarga el documento GetCapabilities de GIBS.
-    Guarda copia en XML en disco y devuelve el texto.
+    Caché en SQLite de GetCapabilities:
+    - validadores HTTP (ETag / Last-Modified) y hora de la última validación
+    - tabla de capas ya parseada (id, title, time_text, time_values, last_date)
+    En corridas "calientes" se devuelven las filas sin descargar ni parsear XML.
     """
-    logging.info("Descargando GetCapabilities desde GIBS...")
-    r = session.get(GIBS_GETCAP_URL, timeout=REQUEST_TIMEOUT)
-    r.raise_for_status()
-    xml = r.text
-    save_text(out_dir / "getcap_raw.xml", xml)
-    logging.info(f"GetCapabilities guardado ({len(xml)} bytes)")
-    return xml
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS getcap (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                checked_at REAL NOT NULL,
+                size INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS layers (
+                url TEXT NOT NULL,
+                id TEXT NOT NULL,
+                title TEXT,
+                time_text TEXT,
+                time_values TEXT,
+                last_date TEXT,
+                PRIMARY KEY (url, id)
+            );
+        """)
+        cols = {r[1] for r in self.conn.execute("PRAGMA table_info(layers)")}
+        if 'time_values' not in cols:
+            # Caché creada antes del índice temporal: se fuerza una descarga completa
+            with self.conn:
+                self.conn.execute("ALTER TABLE layers ADD COLUMN time_values TEXT")
+                self.conn.execute("DELETE FROM getcap")
+
+    def entry(self, url: str) -> Optional[Dict]:
+        """Validadores guardados para la URL, o None si nunca se descargó."""
+        row = self.conn.execute(
+            "SELECT etag, last_modified, checked_at, size FROM getcap WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'checked_at': row[2], 'size': row[3]}
+
+    def rows(self, url: str) -> List[Dict]:
+        """Tabla de capas parseada en la última descarga completa."""
+        cur = self.conn.execute(
+            "SELECT id, title, time_text, time_values, last_date FROM layers WHERE url = ? ORDER BY rowid", (url,))
+        return [{'id': r[0], 'title': r[1], 'time_text': r[2], 'time_values': r[3], 'last_date': r[4]}
+                for r in cur]
+
+    def store(self, url: str, etag: Optional[str], last_modified: Optional[str],
+              size: int, rows: List[Dict]):
+        """Reemplaza validadores y tabla de capas en una sola transacción."""
+        with self.conn:
+            self.conn.execute("DELETE FROM layers WHERE url = ?", (url,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO layers (url, id, title, time_text, time_values, last_date) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(url, r['id'], r['title'], r['time_text'], r.get('time_values'), r['last_date'])
+                 for r in rows])
+            self.conn.execute(
+                "INSERT OR REPLACE INTO getcap (url, etag, last_modified, checked_at, size) VALUES (?, ?, ?, ?, ?)",
+                (url, etag, last_modified, time.time(), size))
+
+    def touch(self, url: str):
+        """Marca la entrada como recién validada (respuesta 304)."""
+        with self.conn:
+            self.conn.execute("UPDATE getcap SET checked_at = ? WHERE url = ?", (time.time(), url))
+
+    def close(self):
+        self.conn.close()
+
+def load_layer_rows(session: requests.Session, out_dir: Path,
+                    cache: Optional[CapabilitiesCache], ttl: float = DEFAULT_GETCAP_TTL) -> List[Dict]:
+    """
+    Devuelve la tabla de capas usando la caché cuando es posible:
+    - entrada con menos de `ttl` segundos: se usa sin tocar la red
+    - entrada vencida: GET condicional (If-None-Match / If-Modified-Since);
+      un 304 reutiliza la tabla guardada sin parsear XML
+    - 200: se guarda getcap_raw.xml, se parsea y se actualiza la caché
+    Si la red falla y hay caché, se usan las filas guardadas aunque estén vencidas.
+    """
+    if cache is None:
+        logging.info("Descargando GetCapabilities desde GIBS...")
+        with session.get(GIBS_GETCAP_URL, timeout=REQUEST_TIMEOUT, stream=True) as r:
+            r.raise_for_status()
+            return list(iter_layers_with_dates(stream_getcap(r, out_dir)))
+
+    url = GIBS_GETCAP_URL
+    entry = cache.entry(url)
+    cached = cache.rows(url) if entry else []
+    if entry and cached and time.time() - entry['checked_at'] < ttl:
+        logging.info(f"GetCapabilities desde caché ({len(cached)} capas, TTL {ttl:.0f}s)")
+        return cached
+
+    headers = {}
+    if entry and cached:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        logging.info("Validando GetCapabilities contra GIBS..." if headers
+                     else "Descargando GetCapabilities desde GIBS...")
+        r = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT, stream=True)
+        if r.status_code == 304:
+            r.close()
+            cache.touch(url)
+            logging.info(f"GetCapabilities sin cambios (304); {len(cached)} capas desde caché")
+            return cached
+        r.raise_for_status()
+    except Exception as e:
+        if cached:
+            logging.warning(f"No se pudo validar GetCapabilities ({e}); usando caché vencida")
+            return cached
+        raise
 
-def collect_layers_with_dates(xml_text: str) -> List[Dict]:
+    try:
+        with r:
+            rows = list(iter_layers_with_dates(stream_getcap(r, out_dir)))
+    except Exception as e:
+        if cached:
+            logging.warning(f"GetCapabilities incompleto ({e}); usando caché vencida")
+            return cached
+        raise
+    size = (out_dir / "getcap_raw.xml").stat().st_size
+    cache.store(url, r.headers.get('ETag'), r.headers.get('Last-Modified'), size, rows)
+    return rows
+
+class _TeeReader:
+    """Envuelve un stream de lectura y copia a disco cada bloque leído."""
+    def __init__(self, raw, sink):
+        self.raw = raw
+        self.sink = sink
+        self.bytes_read = 0
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.raw.read(n)
+        if data:
+            self.sink.write(data)
+            self.bytes_read += len(data)
+        return data
+
+def stream_getcap(response: requests.Response, out_dir: Path) -> Iterator[Dict]:
     """
-    Procesa las capas extraídas de GetCapabilities.
-    Devuelve una lista con id, título, dimensión temporal y última fecha parseada.
+    Parsea GetCapabilities directamente del stream HTTP (respuesta con stream=True).
+    Las capas salen a medida que llegan los bytes; el XML se copia a
+    getcap_raw.xml mientras se lee, sin mantener el documento en memoria.
+    """
+    response.raw.decode_content = True
+    path = out_dir / "getcap_raw.xml"
+    with path.open("wb") as sink:
+        tee = _TeeReader(response.raw, sink)
+        yield from iter_capabilities(tee)
+    logging.info(f"GetCapabilities guardado ({tee.bytes_read} bytes)")
+
+def iter_layers_with_dates(layers: Iterable[Dict]) -> Iterator[Dict]:
+    """
+    Versión generadora de collect_layers_with_dates: recibe registros de capa
+    (p.ej. de iter_capabilities) y emite filas con last_date a medida que llegan.
     """
-    layers = parse_capabilities(xml_text)
-    rows = []
     for l in layers:
         if not l.get('id'):
             continue
-        token = l.get('time_text')
-        if token and '/' in token:
-            token = token.split('/')[1]
-        if token and ',' in token:
-            token = token.split(',')[-1]
-        dt = try_parse_date(token)
-        rows.append({
+        index = TimeIndex.from_values(l.get('time_values'))
+        latest = index.latest() if index else None
+        if latest is not None:
+            dt = latest.date()
+        else:
+            token = l.get('time_text')
+            if token and '/' in token:
+                token = token.split('/')[1]
+            if token and ',' in token:
+                token = token.split(',')[-1]
+            dt = try_parse_date(token)
+        yield {
             'id': l['id'],
             'title': l['title'],
             'time_text': l['time_text'],
+            'time_values': l.get('time_values'),
             'last_date': dt.isoformat() if dt else None
-        })
-    return rows
+        }
+
+def collect_layers_with_dates(xml_text: str) -> List[Dict]:
+    """
+    Procesa las capas extraídas de GetCapabilities.
+    Devuelve una lista con id, título, dimensión temporal y última fecha parseada.
+    """
+    return list(iter_layers_with_dates(parse_capabilities(xml_text)))
 
 def build_image_params(layer_id: str, bbox: List[float], width: int, height: int, time_param: str) -> Dict:
     """
@@ -251,51 +485,336 @@ def build_image_params(layer_id: str, bbox: List[float], width: int, height: int
 
 def attempt_image_download(session: requests.Session, out_dir: Path,
                            layer_id: str, time_param: str,
-                           bbox: List[float], size: Tuple[int,int]) -> Optional[Path]:
+                           bbox: List[float], size: Tuple[int,int],
+                           cancel: Optional[threading.Event] = None) -> Optional[Path]:
     """
     Intenta descargar una imagen de GIBS con los parámetros dados.
     Guarda tanto la imagen como un archivo JSON de metadatos.
     Retorna la ruta de la imagen si se descarga exitosamente.
+    - cancel: evento opcional; si se activa, se aborta la descarga en curso
     """
-    width, height = size
-    params = build_image_params(layer_id, bbox, width, height, time_param)
-    try:
-        r = session.get(IMAGE_DOWNLOAD_BASE, params=params, timeout=REQUEST_TIMEOUT, stream=True)
-    except Exception as e:
-        logging.debug(f"Request error for {layer_id} TIME={time_param}: {e}")
+    if cancel is not None and cancel.is_set():
+        return None
+    key = None
+    if image_cache is not None:
+        params = build_image_params(layer_id, bbox, size[0], size[1], time_param)
+        key = cache_key(IMAGE_DOWNLOAD_BASE, params)
+        path = image_path(out_dir, layer_id, time_param, size, bbox)
+        if image_cache.fetch(key, path):
+            logging.info(f"♻️  Desde caché: {path}")
+            url = requests.Request("GET", IMAGE_DOWNLOAD_BASE, params=params).prepare().url
+            save_image_meta(out_dir, layer_id, time_param, bbox, size, url, path)
+            return path
+    # El cupo por host se mantiene durante toda la transferencia, no solo la cabecera
+    with host_slot(IMAGE_DOWNLOAD_BASE):
+        path = _download_image(session, out_dir, layer_id, time_param, bbox, size, cancel)
+    if path and key:
+        try:
+            image_cache.put(key, path, latest=(time_param == "latest"))
+        except OSError as e:
+            logging.debug(f"No se pudo guardar en caché {path}: {e}")
+    return path
+
+def attempt_tile_download(session: requests.Session, out_dir: Path,
+                          layer_id: str, time_param: str,
+                          bbox: List[float], size: Tuple[int,int],
+                          cancel: Optional[threading.Event] = None) -> Optional[Path]:
+    """
+    Igual que attempt_image_download pero compone la imagen con teselas WMTS
+    (motor --engine tiles). Capas sin grilla teselada usan image-download.
+    """
+    if tile_fetcher is None or not tile_fetcher.supports(layer_id):
+        return attempt_image_download(session, out_dir, layer_id, time_param, bbox, size, cancel)
+    if cancel is not None and cancel.is_set():
         return None
+    path = image_path(out_dir, layer_id, time_param, size, bbox)
+
+    def accept(tmp: Path, digest: str, content_type: str) -> bool:
+        if blank_detector.is_blank(tmp, digest, size[0] * size[1], content_type):
+            logging.info(f"⬜ Mosaico sin datos descartado: layer={layer_id} TIME={time_param} bbox={bbox}")
+            return False
+        return True
 
-    if r.status_code != 200:
-        logging.debug(f"HTTP {r.status_code} for layer={layer_id} TIME={time_param} bbox={bbox} size={width}x{height}")
+    if not tile_fetcher.render(layer_id, time_param, bbox, size, path, cancel, validate=accept):
+        logging.debug(f"Sin mosaico válido para layer={layer_id} TIME={time_param} bbox={bbox}")
         return None
+    logging.info(f"🧩 Compuesto desde teselas: {path}")
+    template = tile_fetcher.grid['layers'][layer_id]['template']
+    save_image_meta(out_dir, layer_id, time_param, bbox, size, template, path)
+    return path
+
+def _name_stem(layer_id: str, time_param: str, bbox: Optional[List[float]]) -> str:
+    """{layer}_{time}, más _{bbox} si bbox_in_names está activo (--collect-all)."""
+    stem = f"{layer_id.replace('/', '_')}_{time_param}"
+    if bbox_in_names and bbox:
+        stem += "_" + "_".join(f"{v:g}" for v in bbox)
+    return stem
+
+def image_path(out_dir: Path, layer_id: str, time_param: str, size: Tuple[int,int],
+               bbox: Optional[List[float]] = None) -> Path:
+    """Ruta de salida de una imagen: {layer}_{time}[_{bbox}]_{WxH}.jpg en out_dir."""
+    return out_dir / f"{_name_stem(layer_id, time_param, bbox)}_{size[0]}x{size[1]}.jpg"
+
+def save_image_meta(out_dir: Path, layer_id: str, time_param: str, bbox: List[float],
+                    size: Tuple[int,int], url: str, path: Path):
+    """Escribe {layer}_{time}[_{bbox}]_meta.json junto a la imagen."""
+    meta = {
+        "layer": layer_id,
+        "time": time_param,
+        "bbox": bbox,
+        "size": [size[0], size[1]],
+        "url": url,
+        "file": str(path),
+    }
+    save_meta(meta, out_dir / f"{_name_stem(layer_id, time_param, bbox)}_meta.json")
+
+def _download_image(session: requests.Session, out_dir: Path,
+                    layer_id: str, time_param: str,
+                    bbox: List[float], size: Tuple[int,int],
+                    cancel: Optional[threading.Event]) -> Optional[Path]:
+    """
+    Descarga efectiva de attempt_image_download (ya dentro del cupo del host).
+    Una imagen "sin datos" se descarta y retorna None para que el barrido
+    siga con el siguiente candidato.
+    """
+    width, height = size
+    params = build_image_params(layer_id, bbox, width, height, time_param)
+    path = image_path(out_dir, layer_id, time_param, size, bbox)
+    # .part estable por solicitud (incluye bbox): se puede reanudar entre corridas
+    part = out_dir / PARTIAL_DIR_NAME / f"{cache_key(IMAGE_DOWNLOAD_BASE, params)}.part"
+
+    def accept(tmp: Path, digest: str, content_type: str) -> bool:
+        if blank_detector.is_blank(tmp, digest, width * height, content_type):
+            logging.info(f"⬜ Imagen sin datos descartada: layer={layer_id} TIME={time_param} bbox={bbox}")
+            return False
+        return True
 
-    safe = layer_id.replace('/', '_')
-    fname = f"{safe}_{time_param}_{width}x{height}.jpg"
-    path = out_dir / fname
     try:
-        with path.open("wb") as fd:
-            for chunk in r.iter_content(1024):
-                if chunk:
-                    fd.write(chunk)
-        logging.info(f"✅ Descargado: {path}")
-        meta = {
-            "layer": layer_id,
-            "time": time_param,
-            "bbox": bbox,
-            "size": [width, height],
-            "url": r.url,
-            "file": str(path),
-        }
-        save_meta(meta, out_dir / f"{safe}_{time_param}_meta.json")
-        return path
-    except Exception as e:
+        result = stream_download(session, IMAGE_DOWNLOAD_BASE, params, path, part,
+                                 REQUEST_TIMEOUT, cancel, validate=accept)
+    except DownloadCancelled:
+        logging.debug(f"Cancelado: layer={layer_id} TIME={time_param} bbox={bbox} size={width}x{height}")
+        return None
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else "?"
+        logging.debug(f"HTTP {status} for layer={layer_id} TIME={time_param} bbox={bbox} size={width}x{height}")
+        return None
+    except requests.RequestException as e:
+        logging.debug(f"Request error for {layer_id} TIME={time_param}: {e}")
+        return None
+    except OSError as e:
         logging.error(f"Error guardando archivo {path}: {e}")
-        if path.exists():
-            try:
-                path.unlink()
-            except Exception:
-                pass
         return None
+    if result is None:
+        return None
+    logging.info(f"✅ Descargado: {path}")
+    save_image_meta(out_dir, layer_id, time_param, bbox, size, result[1], path)
+    return path
+
+# -------------------- CONCURRENT SWEEP ------------------
+_host_limits: Dict[str, threading.BoundedSemaphore] = {}
+_host_limits_lock = threading.Lock()
+_per_host_limit = DEFAULT_PER_HOST
+image_cache: Optional[ImageCache] = None
+tile_fetcher = None  # gibs_tiles.TileFetcher si se usa --engine tiles
+bbox_in_names = False  # --collect-all: la bbox va en el nombre para no pisar imágenes
+blank_detector = BlankDetector()  # en memoria; main lo persiste en la caché
+
+def set_blank_detector(detector: BlankDetector):
+    """Reemplaza el detector de imágenes sin datos (p. ej. con firmas persistentes)."""
+    global blank_detector
+    blank_detector = detector
+
+def set_tile_fetcher(fetcher):
+    """Activa (o desactiva con None) el motor de teselas WMTS."""
+    global tile_fetcher
+    tile_fetcher = fetcher
+
+def set_bbox_in_names(enabled: bool):
+    """Incluye (o no) la bbox en los nombres de imagen y metadatos."""
+    global bbox_in_names
+    bbox_in_names = enabled
+
+def set_image_cache(cache: Optional[ImageCache]):
+    """Activa (o desactiva con None) la caché de imágenes compartida por todos los workers."""
+    global image_cache
+    image_cache = cache
+
+def set_per_host_limit(limit: int):
+    """Fija el máximo de solicitudes simultáneas por host (reinicia los semáforos)."""
+    global _per_host_limit
+    with _host_limits_lock:
+        _per_host_limit = max(1, limit)
+        _host_limits.clear()
+
+class host_slot:
+    """
+    Context manager que reserva un cupo del host de la URL.
+    Limita la concurrencia por servidor aunque haya más workers.
+    """
+    def __init__(self, url: str):
+        host = urlparse(url).netloc
+        with _host_limits_lock:
+            sem = _host_limits.get(host)
+            if sem is None:
+                sem = _host_limits[host] = threading.BoundedSemaphore(_per_host_limit)
+        self._sem = sem
+
+    def __enter__(self):
+        self._sem.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._sem.release()
+        return False
+
+def build_attempts(rows_sorted: List[Dict], max_layers: int,
+                   bboxes: List[List[float]], sizes: List[Tuple[int,int]]) -> List[Tuple[str, str, List[float], Tuple[int,int]]]:
+    """
+    Genera la lista de intentos (layer, TIME, bbox, size) en orden de prioridad:
+    capas con last_date más reciente primero. Si la capa trae índice temporal
+    solo se pide su último instante disponible; si no, "latest" y luego last_date.
+    """
+    attempts = []
+    for rec in rows_sorted[:max(0, max_layers)]:
+        index = TimeIndex.from_values(rec.get('time_values'))
+        latest = index.latest() if index else None
+        if latest is not None:
+            time_attempts = [index.time_param(latest)]
+        else:
+            time_attempts = ["latest"]
+            if rec['last_date']:
+                time_attempts.append(rec['last_date'])
+        for time_param in time_attempts:
+            for bbox in bboxes:
+                for size in sizes:
+                    attempts.append((rec['id'], time_param, bbox, size))
+    return attempts
+
+def run_attempts_concurrent(session: requests.Session, out_dir: Path,
+                            attempts: List[Tuple[str, str, List[float], Tuple[int,int]]],
+                            workers: int, collect_all: bool = False,
+                            download_fn: Callable = None) -> List[Path]:
+    """
+    Ejecuta los intentos con un pool de hilos acotado.
+    - Los intentos se despachan en orden de prioridad y nunca hay más de
+      `workers` en vuelo, así los de menor prioridad solo arrancan cuando
+      se libera un cupo.
+    - collect_all=False: gana el intento válido de mayor prioridad, como en el
+      modo secuencial. Al llegar una imagen válida se cancela solo lo de menor
+      prioridad y se esperan los intentos de mayor prioridad aún en vuelo.
+    - collect_all=True: se recorren todos los intentos y se devuelven todas las imágenes.
+    - download_fn: función de descarga (por defecto attempt_image_download)
+    """
+    download_fn = download_fn or attempt_image_download
+    results: List[Path] = []
+    best: Optional[Tuple[int, Path]] = None   # (prioridad, ruta) del mejor éxito
+    pending = iter(enumerate(attempts))
+    in_flight: Dict = {}                      # futuro -> (prioridad, evento de cancelación)
+
+    def submit_next(pool) -> bool:
+        for rank, (layer_id, time_param, bbox, size) in pending:
+            logging.info(f"Intentando: layer={layer_id} TIME={time_param} bbox={bbox} size={size[0]}x{size[1]}")
+            cancel = threading.Event()
+            fut = pool.submit(download_fn, session, out_dir,
+                              layer_id, time_param, bbox, size, cancel)
+            in_flight[fut] = (rank, cancel)
+            return True
+        return False
+
+    def cancel_all(min_rank: int = -1):
+        for fut, (rank, cancel) in in_flight.items():
+            if rank > min_rank:
+                cancel.set()
+                fut.cancel()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gibs") as pool:
+        try:
+            while len(in_flight) < workers and submit_next(pool):
+                pass
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    rank, _ = in_flight.pop(fut)
+                    path = None if fut.cancelled() else fut.result()
+                    if not path:
+                        continue
+                    if collect_all:
+                        results.append(path)
+                    elif best is None or rank < best[0]:
+                        if best is not None:
+                            logging.info(f"Se prefiere {path.name} (mayor prioridad) sobre {best[1].name}")
+                        best = (rank, path)
+                if best is not None:
+                    # Lo pendiente siempre tiene menor prioridad que lo ya despachado
+                    cancel_all(best[0])
+                    if not any(rank < best[0] for rank, _ in in_flight.values()):
+                        wait(in_flight)
+                        break
+                    continue
+                while len(in_flight) < workers and submit_next(pool):
+                    pass
+        except KeyboardInterrupt:
+            cancel_all()
+            raise
+    return [best[1]] if best is not None else results
+
+def parse_sizes(text: str) -> List[Tuple[int,int]]:
+    """Convierte "800x600,1200x900" en [(800, 600), (1200, 900)] (ignora tokens inválidos)."""
+    sizes = []
+    for token in text.split(","):
+        token = token.strip()
+        if not token:
+            continue
+        if "x" not in token:
+            logging.warning(f"Ignorando tamaño inválido: {token}")
+            continue
+        w,h = token.split("x", 1)
+        try:
+            sizes.append((int(w), int(h)))
+        except ValueError:
+            logging.warning(f"Ignorando tamaño no numérico: {token}")
+    return sizes
+
+def configure_downloads(args, out_dir: Path, script_dir: Path) -> Callable:
+    """
+    Aplica --per-host, la caché de imágenes, el detector de imágenes sin datos
+    y el motor (--engine). Retorna la función de descarga a usar; se deshace con release_downloads.
+    """
+    set_per_host_limit(args.per_host)
+    if not args.no_cache:
+        set_blank_detector(BlankDetector(script_dir / CACHE_DIR_NAME / "blank_fingerprints.txt"))
+        set_image_cache(ImageCache(script_dir / CACHE_DIR_NAME / "images",
+                                   max_bytes=int(args.image_cache_mb * 1024 * 1024),
+                                   max_entries=args.image_cache_entries,
+                                   latest_ttl=args.latest_ttl))
+    download_fn = attempt_image_download
+    if args.engine == "tiles":
+        try:
+            from gibs_tiles import TileFetcher, load_tile_grid
+        except ImportError as e:
+            logging.warning(f"Motor de teselas no disponible ({e}); se usa image-download")
+        else:
+            grid = load_tile_grid(out_dir / "getcap_raw.xml", script_dir / CACHE_DIR_NAME / "tile_grid.json")
+            if grid:
+                set_tile_fetcher(TileFetcher(create_session(pool_size=max(10, args.tile_workers)), grid,
+                                             script_dir / CACHE_DIR_NAME / "tiles",
+                                             workers=args.tile_workers, timeout=REQUEST_TIMEOUT,
+                                             slot=host_slot, mutable_ttl=args.latest_ttl))
+                download_fn = attempt_tile_download
+            else:
+                logging.warning("No hay getcap_raw.xml para armar la grilla WMTS; se usa image-download")
+    return download_fn
+
+def release_downloads():
+    """Cierra la caché de imágenes y el motor de teselas activados por configure_downloads."""
+    if image_cache is not None:
+        logging.debug(f"Caché de imágenes: {image_cache.hits} aciertos, {image_cache.misses} fallos")
+        image_cache.close()
+        set_image_cache(None)
+    if tile_fetcher is not None:
+        logging.info(f"Teselas: {tile_fetcher.fetched} descargadas, {tile_fetcher.reused} reutilizadas")
+        set_tile_fetcher(None)
 
 # -------------------- MAIN ------------------------------
 def main(argv=None):
@@ -313,34 +832,82 @@ def main(argv=None):
                         help="Lista tamaños WxH separada por comas, e.g. 800x600,1200x900")
     parser.add_argument("--places", type=str, default="", help="(Opcional) lista de lugares/países separados por comas")
     parser.add_argument("--buffer-km", type=float, default=0.0, help="Buffer en km para expandir bbox geocodificada")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Descargas simultáneas (1 = secuencial)")
+    parser.add_argument("--per-host", type=int, default=DEFAULT_PER_HOST,
+                        help="Máx solicitudes simultáneas por host")
+    parser.add_argument("--collect-all", action="store_true",
+                        help="No detenerse en la primera imagen válida; descargar todas las combinaciones "
+                             "(la bbox se agrega al nombre de cada archivo)")
+    parser.add_argument("--getcap-ttl", type=float, default=DEFAULT_GETCAP_TTL,
+                        help="Segundos que la caché de GetCapabilities se usa sin revalidar")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Ignorar las cachés (GetCapabilities e imágenes) y descargar todo")
+    parser.add_argument("--image-cache-mb", type=float, default=DEFAULT_IMAGE_CACHE_MB,
+                        help="Tamaño máximo de la caché de imágenes en MB")
+    parser.add_argument("--image-cache-entries", type=int, default=DEFAULT_IMAGE_CACHE_ENTRIES,
+                        help="Máx imágenes en caché")
+    parser.add_argument("--latest-ttl", type=float, default=DEFAULT_LATEST_TTL,
+                        help="Segundos que una imagen TIME=latest sigue vigente en caché")
+    parser.add_argument("--engine", choices=("image", "tiles"), default="image",
+                        help="image = render del servidor (image-download); tiles = mosaico local de teselas WMTS")
+    parser.add_argument("--tile-workers", type=int, default=8, help="Teselas descargadas en paralelo por imagen")
+    parser.add_argument("--geocode-ttl-days", type=float, default=DEFAULT_TTL_DAYS,
+                        help="Días que un lugar geocodificado sigue vigente en caché")
+    parser.add_argument("--offline", action="store_true",
+                        help="No consultar Nominatim; solo caché de geocodificación y gazetteer local")
+    parser.add_argument("--out-dir", type=str, default="",
+                        help="Carpeta de salida (por defecto Test_gibs junto al .py)")
+    parser.add_argument("--metrics", type=str, default="",
+                        help="Exportar métricas por solicitud al final (.prom = Prometheus textfile, .json = resumen)")
+    parser.add_argument("--trace", type=str, default="",
+                        help="Traza JSONL con una línea por solicitud HTTP")
+    parser.add_argument("--jobs", type=str, default="",
+                        help="Manifiesto JSONL/CSV de trabajos (place|bbox, layer, start, end, size): modo por lotes")
+    parser.add_argument("--state", type=str, default="",
+                        help="SQLite de avance del modo por lotes (por defecto <out-dir>/batch_state.sqlite)")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Modo por lotes: reintentar también los trabajos que terminaron con fallas")
+    parser.add_argument("--max-steps", type=int, default=366,
+                        help="Modo por lotes: máx instantes TIME por trabajo")
     parser.add_argument("--verbose", action="store_true", help="Verbose logging")
     args = parser.parse_args(argv)
 
     setup_logging(args.verbose)
 
+    if args.metrics or args.trace:
+        set_metrics(RequestMetrics(Path(args.trace) if args.trace else None))
+    try:
+        run(args)
+    finally:
+        if metrics is not None:
+            if args.metrics:
+                metrics.export(Path(args.metrics))
+                logging.info(f"Métricas HTTP exportadas a {args.metrics}")
+            for host, h in metrics.summary()["hosts"].items():
+                logging.info(f"HTTP {host}: {h['requests']} solicitudes, {h['retries']} reintentos, "
+                             f"{h['bytes'] / 1e6:.1f} MB, espera {h['wait_s']:.1f} s / transferencia {h['transfer_s']:.1f} s")
+            metrics.close()
+            set_metrics(None)
+
+def run(args):
+    """Cuerpo de main con los argumentos ya procesados."""
     # Directorio del script
     try:
         script_dir = Path(__file__).resolve().parent
     except NameError:
         script_dir = Path.cwd()
-    out_dir = script_dir / "Test_gibs"
+    out_dir = Path(args.out_dir) if args.out_dir else script_dir / "Test_gibs"
     out_dir.mkdir(parents=True, exist_ok=True)
     logging.info(f"Carpeta de salida: {out_dir}")
 
-    # Parsear tamaños
-    sizes = []
-    for token in args.sizes.split(","):
-        token = token.strip()
-        if not token:
-            continue
-        if "x" not in token:
-            logging.warning(f"Ignorando tamaño inválido: {token}")
-            continue
-        w,h = token.split("x", 1)
-        try:
-            sizes.append((int(w), int(h)))
-        except ValueError:
-            logging.warning(f"Ignorando tamaño no numérico: {token}")
+    if args.jobs:
+        # Modo por lotes: manifiesto de trabajos, sin preguntas en terminal
+        from gibs_batch import run_batch
+        run_batch(args, out_dir, script_dir)
+        return
+
+    sizes = parse_sizes(args.sizes)
 
     # Si no se pasó --places, preguntar en terminal
     places_input = args.places.strip() if args.places else ""
@@ -350,12 +917,36 @@ def main(argv=None):
         except Exception:
             places_input = ""
 
-    # Preparar bboxes: geocodificar si hay lugares dados
+    # Geocodificar lugares en segundo plano (caché -> Nominatim limitado -> gazetteer)
+    places = [p.strip() for p in places_input.split(",") if p.strip()] if places_input else []
+    geo_cache = None
+    geocoded = None
+    if places:
+        if not args.no_cache:
+            geo_cache = GeocodeCache(script_dir / CACHE_DIR_NAME / "geocode.sqlite", args.geocode_ttl_days)
+        geocoder = BatchGeocoder(lambda p: geocode_place(p, raise_errors=True), cache=geo_cache,
+                                 offline=args.offline)
+        geocoded = geocoder.resolve_async(places)
+
+    # Descargar GetCapabilities (o reutilizar la caché) y procesar capas con fechas
+    cache = None if args.no_cache else CapabilitiesCache(script_dir / CACHE_DIR_NAME / "getcap.sqlite")
+    try:
+        rows = load_layer_rows(session, out_dir, cache, args.getcap_ttl)
+    except Exception as e:
+        logging.error(f"No se pudo descargar GetCapabilities: {e}")
+        return
+    finally:
+        if cache is not None:
+            cache.close()
+
+    # Preparar bboxes con el resultado de la geocodificación
     bboxes_to_try: List[List[float]] = []
-    if places_input:
-        places = [p.strip() for p in places_input.split(",") if p.strip()]
+    if geocoded is not None:
+        resolved = geocoded.result()
+        if geo_cache is not None:
+            geo_cache.close()
         for place in places:
-            bbox = geocode_place(place)
+            bbox = resolved.get(place)
             if bbox:
                 bbox = expand_bbox_km(bbox, args.buffer_km)
                 bboxes_to_try.append(bbox)
@@ -363,16 +954,6 @@ def main(argv=None):
                 logging.warning(f"No se obtuvo bbox para '{place}', se omitirá.")
     if not bboxes_to_try:
         bboxes_to_try = DEFAULT_BBOXES
-
-    # Descargar GetCapabilities
-    try:
-        xml = fetch_getcap(session, out_dir)
-    except Exception as e:
-        logging.error(f"No se pudo descargar GetCapabilities: {e}")
-        return
-
-    # Procesar capas con fechas
-    rows = collect_layers_with_dates(xml)
     if not rows:
         logging.warning("No se detectaron capas con dimensión TIME en GetCapabilities.")
         return
@@ -381,35 +962,43 @@ def main(argv=None):
     save_csv(rows_sorted, out_dir / "gibs_layers_dates.csv")
     logging.info(f"Se detectaron {len(rows_sorted)} capas con TIME. Probando descargas... (máx {args.max_layers})")
 
-    # Intentar descargas
-    tried = 0
+    # Intentar descargas (fechas según el índice TIME de cada capa)
+    attempts = build_attempts(rows_sorted, args.max_layers, bboxes_to_try, sizes)
+    workers = max(1, args.workers)
+    download_fn = configure_downloads(args, out_dir, script_dir)
+    set_bbox_in_names(args.collect_all)
+    downloaded: List[Path] = []
     try:
-        for rec in rows_sorted:
-            if tried >= args.max_layers:
-                break
-            layer_id = rec['id']
-            last_date = rec['last_date']
-            logging.debug(f"Probando layer {layer_id} last_date={last_date}")
-
-            # Se prueban dos tiempos: "latest" y la última fecha detectada
-            time_attempts = ["latest"]
-            if last_date:
-                time_attempts.append(last_date)
-
-            for time_param in time_attempts:
-                for bbox in bboxes_to_try:
-                    for size in sizes:
-                        logging.info(f"Intentando: layer={layer_id} TIME={time_param} bbox={bbox} size={size[0]}x{size[1]}")
-                        path = attempt_image_download(session, out_dir, layer_id, time_param, bbox, size)
-                        if path:
-                            logging.info("Imagen válida obtenida, terminando proceso.")
-                            return
-            tried += 1
+        if workers == 1:
+            for layer_id, time_param, bbox, size in attempts:
+                logging.info(f"Intentando: layer={layer_id} TIME={time_param} bbox={bbox} size={size[0]}x{size[1]}")
+                path = download_fn(session, out_dir, layer_id, time_param, bbox, size)
+                if path:
+                    downloaded.append(path)
+                    if not args.collect_all:
+                        break
+        else:
+            logging.info(f"Barrido concurrente: {len(attempts)} intentos, {workers} workers, {args.per_host} por host")
+            sweep_session = create_session(pool_size=max(10, workers))
+            downloaded = run_attempts_concurrent(sweep_session, out_dir, attempts, workers, args.collect_all,
+                                                 download_fn)
     except KeyboardInterrupt:
         logging.warning("Interrumpido por usuario (KeyboardInterrupt).")
+    finally:
+        set_bbox_in_names(False)
+        release_downloads()
+
+    if downloaded and args.collect_all:
+        logging.info(f"Proceso terminado. {len(downloaded)} imágenes válidas descargadas.")
+        return
+    if downloaded:
+        logging.info("Imagen válida obtenida, terminando proceso.")
+        return
 
     logging.info("Proceso terminado. No se encontró ninguna imagen válida con las combinaciones probadas.")
     logging.info(f"Revisa {out_dir / 'gibs_layers_dates.csv'} para elegir manualmente un layer y probarlo.")
 
 if __name__ == "__main__":
+    # gibs_batch importa gibs_Fer: que comparta este módulo (cachés, cupos, métricas) y no una copia
+    sys.modules.setdefault("gibs_Fer", sys.modules[__name__])
     main()
@@ -4,12 +4,22 @@
 # probando varias capas y fechas recientes si no hay datos disponibles.
 
 import os
+import io
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from owslib.wms import WebMapService
 from geopy.geocoders import Nominatim
 from shapely.geometry import box
 
+from gibs_time import TimeIndex
+
+try:
+    from PIL import Image
+except ImportError:  # sin Pillow solo se detectan respuestas vacías o XML
+    Image = None
+
 # --- Configuración de logging ---
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
@@ -21,6 +31,22 @@ LAYERS = [
     "VIIRS_SNPP_CorrectedReflectance_TrueColor",
     "BlueMarble_ShadedRelief"
 ]
+DAYS_BACK = 5       # hoy y hasta 4 días anteriores
+MAX_WORKERS = 8     # capas descargadas en paralelo (las fechas de cada capa van en orden)
+BLANK_STD = 2.0     # desviación estándar por debajo de la cual la imagen es "sin datos"
+
+# --- Cliente WMS compartido (un solo GetCapabilities por ejecución) ---
+_wms_clients = {}
+_wms_lock = threading.Lock()
+
+def get_wms(wms_url):
+    """Devuelve un WebMapService por URL, creado la primera vez que se pide."""
+    with _wms_lock:
+        wms = _wms_clients.get(wms_url)
+        if wms is None:
+            logging.info("Leyendo GetCapabilities WMS...")
+            wms = _wms_clients[wms_url] = WebMapService(wms_url)
+        return wms
 
 # --- Función para obtener bounding box de un lugar ---
 def get_bbox(place_name):
@@ -32,10 +58,59 @@ def get_bbox(place_name):
     return box(location.longitude-1, location.latitude-1,
                location.longitude+1, location.latitude+1)
 
+# --- Índice de fechas disponibles por capa ---
+def get_time_indexes(wms_url, layers):
+    """
+    Lee la dimensión TIME de cada capa en el GetCapabilities WMS y arma
+    su TimeIndex. Capas sin TIME (p.ej. BlueMarble) quedan en None; las que no
+    aparecen en el GetCapabilities se omiten (se prueban todas las fechas).
+    Si el GetCapabilities falla se devuelve {} y se prueban todas las fechas.
+    """
+    try:
+        wms = get_wms(wms_url)
+    except Exception as e:
+        logging.warning(f"No se pudo leer GetCapabilities WMS, se probarán todas las fechas: {e}")
+        return {}
+    indexes = {}
+    for layer in layers:
+        try:
+            positions = wms[layer].timepositions
+        except KeyError:
+            continue
+        indexes[layer] = TimeIndex.from_values(positions)
+    return indexes
+
+# --- Detección de respuestas sin datos ---
+def is_no_data(data, content_type=""):
+    """
+    True si la respuesta no trae imagen útil: vacía, XML de excepción o
+    una imagen uniforme/transparente (GIBS devuelve 200 con imagen en blanco).
+    """
+    if not data:
+        return True
+    head = data[:200].lstrip()
+    if "xml" in (content_type or "").lower() or head.startswith(b"<?xml") or head.startswith(b"<Service"):
+        return True
+    if Image is None:
+        return False
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            if im.mode in ("RGBA", "LA") or "transparency" in im.info:
+                alpha = im.convert("RGBA").getchannel("A")
+                if alpha.getextrema()[1] == 0:
+                    return True
+            gray = im.convert("L").resize((64, 64))
+            pixels = list(gray.getdata())
+    except Exception:
+        return True
+    mean = sum(pixels) / len(pixels)
+    std = (sum((p - mean) ** 2 for p in pixels) / len(pixels)) ** 0.5
+    return std < BLANK_STD
+
 # --- Función para descargar imagen ---
 def download_image(wms_url, layer, bbox, date, out_file):
     try:
-        wms = WebMapService(wms_url)
+        wms = get_wms(wms_url)
         response = wms.getmap(
             layers=[layer],
             styles=[''],
@@ -44,19 +119,39 @@ def download_image(wms_url, layer, bbox, date, out_file):
             width=800,
             height=800,
             format='image/png',
-            time=date
+            time=date  # None: capa sin dimensión TIME
         )
-        if response is None or response.read() is None:
+        # Una sola lectura: el cuerpo no se puede volver a leer
+        data = response.read() if response is not None else b""
+        content_type = response.info().get("Content-Type", "") if response is not None else ""
+        if is_no_data(data, content_type):
             logging.warning(f"No hay datos para capa {layer} fecha {date}")
             return False
-        with open(out_file, 'wb') as f:
-            f.write(response.read())
+        tmp = f"{out_file}.part"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, out_file)
         logging.info(f"Imagen descargada: {out_file}")
         return True
     except Exception as e:
         logging.error(f"Error al descargar capa {layer} fecha {date}: {e}")
         return False
 
+# --- Fechas a probar por capa ---
+def candidate_dates(indexes, layer, today):
+    """
+    Fechas de los últimos DAYS_BACK días (más reciente primero) que la capa
+    tiene disponibles según su índice TIME; sin índice se prueban todas.
+    Una capa sin dimensión TIME se pide una sola vez, sin fecha: [None].
+    """
+    if layer in indexes and indexes[layer] is None:
+        return [None]
+    days = [(today - timedelta(days=d)).date() for d in range(DAYS_BACK)]
+    index = indexes.get(layer)
+    if index is not None:
+        days = [d for d in days if index.contains(d)]
+    return [d.strftime("%Y-%m-%d") for d in days]
+
 # --- Función principal ---
 def main():
     place_name = input("Introduce el lugar o país: ")
@@ -69,22 +164,28 @@ def main():
     output_dir = os.path.join(os.getcwd(), "GIBS_Images")
     os.makedirs(output_dir, exist_ok=True)
 
-    success = False
     today = datetime.now(timezone.utc)
+    indexes = get_time_indexes(WMS_URL, LAYERS)
 
-    # Intentar la fecha actual y hasta 4 días anteriores
-    for delta_days in range(0, 5):
-        date_str = (today - timedelta(days=delta_days)).strftime("%Y-%m-%d")
-        logging.info(f"Intentando para fecha {date_str}")
-        for layer in LAYERS:
-            out_file = os.path.join(output_dir, f"{place_name}_{layer}_{date_str}.png")
+    # Capas en paralelo; dentro de cada capa las fechas van en orden (más reciente
+    # primero) y se para en la primera con datos, así no se escriben fechas viejas
+    def run(layer):
+        for date_str in candidate_dates(indexes, layer, today):
+            suffix = f"_{date_str}" if date_str else ""
+            out_file = os.path.join(output_dir, f"{place_name}_{layer}{suffix}.png")
+            logging.info(f"Intentando capa {layer} fecha {date_str or '(sin TIME)'}")
             if download_image(WMS_URL, layer, bbox, date_str, out_file):
-                success = True
-        if success:
-            break
+                return date_str or "sin TIME"
+        return None
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        best = {layer: found for layer, found in zip(LAYERS, pool.map(run, LAYERS)) if found}
 
-    if not success:
-        logging.error(f"No se pudo descargar ninguna imagen válida para {place_name} en los últimos 5 días.")
+    for layer in LAYERS:
+        if layer not in best:
+            logging.warning(f"Sin imagen para {layer} en los últimos {DAYS_BACK} días.")
+    if not best:
+        logging.error(f"No se pudo descargar ninguna imagen válida para {place_name} en los últimos {DAYS_BACK} días.")
 
 if __name__ == "__main__":
     main()
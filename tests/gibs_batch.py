@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# gibs_batch.py
+"""
+Modo por lotes de gibs_Fer (--jobs): un manifiesto JSONL o CSV de trabajos
+(place o bbox, layer, start, end, size), sin preguntas en terminal.
+ - Cada trabajo se expande a los instantes TIME disponibles en [start, end]
+   según el índice temporal de la capa (días corridos si la capa no lo trae).
+ - Las descargas de todos los trabajos comparten un pool de hilos acotado
+   (--workers); host_slot limita la concurrencia por servidor (--per-host).
+ - GetCapabilities se carga una sola vez y cada lugar distinto se geocodifica
+   una sola vez (caché geocode.sqlite -> Nominatim -> gazetteer) para todo el lote.
+ - El avance se guarda en SQLite (--state): una corrida cortada se reanuda sin
+   repetir trabajos terminados ni instantes ya descargados.
+ - batch_report.csv resume cada trabajo: estado, imágenes, faltantes y error.
+
+Manifiesto JSONL (una línea por trabajo; id opcional, por defecto un hash de la línea):
+  {"id": "lima-modis", "place": "Lima, Peru", "layer": "MODIS_Terra_CorrectedReflectance_TrueColor",
+   "start": "2025-09-01", "end": "2025-09-07", "size": "800x600", "buffer_km": 20}
+El CSV usa las mismas columnas (bbox como "minLon,minLat,maxLon,maxLat").
+start = "latest" (o vacío) pide solo el último instante disponible.
+
+Uso:
+  python gibs_Fer.py --jobs trabajos.jsonl --workers 16 --per-host 6
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import csv
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+import gibs_Fer
+from gibs_Fer import (CACHE_DIR_NAME, DEFAULT_SIZES, CapabilitiesCache, configure_downloads, create_session,
+                      expand_bbox_km, geocode_place, load_layer_rows, parse_sizes, release_downloads)
+from gibs_geocode import BatchGeocoder, GeocodeCache
+from gibs_time import TimeIndex, parse_instant
+
+JOBS_DIR_NAME = "jobs"            # salida de cada trabajo: <out-dir>/jobs/<id>/
+REPORT_NAME = "batch_report.csv"
+MAX_LISTED_MISSING = 10           # instantes faltantes listados en el error de un trabajo
+
+def load_manifest(path: Path) -> List[Dict]:
+    """
+    Lee el manifiesto (.csv o JSONL) como lista de dicts. Las líneas JSONL
+    vacías o con # se ignoran; una línea inválida queda como trabajo con "_error".
+    """
+    specs = []
+    if path.suffix.lower() == ".csv":
+        with path.open(newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                spec = {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+                if spec:
+                    specs.append(spec)
+        return specs
+    with path.open(encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                spec = json.loads(line)
+                if not isinstance(spec, dict):
+                    raise ValueError("se esperaba un objeto JSON")
+            except ValueError as e:
+                spec = {"id": f"line-{n}", "_error": f"línea {n} inválida: {e}"}
+            specs.append(spec)
+    return specs
+
+def job_id(spec: Dict) -> str:
+    """Id del trabajo: el campo id (apto para nombre de carpeta) o un hash estable de la especificación."""
+    if spec.get("id"):
+        return re.sub(r"[^\w.-]+", "_", str(spec["id"])).strip("_") or "job"
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+def parse_bbox(value) -> List[float]:
+    """bbox de una lista o de un texto "minLon,minLat,maxLon,maxLat"."""
+    parts = value.split(",") if isinstance(value, str) else list(value)
+    if len(parts) != 4:
+        raise ValueError(f"bbox inválida: {value!r}")
+    minlon, minlat, maxlon, maxlat = (float(p) for p in parts)
+    if minlon >= maxlon or minlat >= maxlat:
+        raise ValueError(f"bbox vacía: {value!r}")
+    return [minlon, minlat, maxlon, maxlat]
+
+def normalize_job(spec: Dict, default_size: Tuple[int,int], default_buffer_km: float) -> Dict:
+    """Valida una especificación y completa valores por defecto (ValueError si es inválida)."""
+    if spec.get("_error"):
+        raise ValueError(spec["_error"])
+    layer = str(spec.get("layer") or "").strip()
+    if not layer:
+        raise ValueError("falta layer")
+    place = str(spec.get("place") or "").strip()
+    bbox = parse_bbox(spec["bbox"]) if spec.get("bbox") else None
+    if not place and bbox is None:
+        raise ValueError("falta place o bbox")
+    size = default_size
+    if spec.get("size"):
+        sizes = parse_sizes(str(spec["size"]))
+        if not sizes:
+            raise ValueError(f"size inválido: {spec['size']!r}")
+        size = sizes[0]
+    start = str(spec.get("start") or "latest").strip()
+    return {
+        "layer": layer,
+        "place": place,
+        "bbox": bbox,
+        "start": start,
+        "end": str(spec.get("end") or start).strip(),
+        "size": size,
+        "buffer_km": float(spec.get("buffer_km") or default_buffer_km or 0.0),
+    }
+
+def job_times(job: Dict, index: Optional[TimeIndex], max_steps: int) -> List[str]:
+    """
+    Parámetros TIME del trabajo en orden cronológico. Con índice temporal se
+    usan los instantes disponibles en [start, end]; sin él, un día por fecha.
+    Un end sin hora cubre el día completo.
+    """
+    if job["start"].lower() == "latest":
+        latest = index.latest() if index else None
+        return [index.time_param(latest)] if latest is not None else ["latest"]
+    start, end = parse_instant(job["start"]), parse_instant(job["end"])
+    if start is None or end is None:
+        raise ValueError(f"fechas inválidas: start={job['start']!r} end={job['end']!r}")
+    if end < start:
+        raise ValueError(f"end ({job['end']}) anterior a start ({job['start']})")
+    times = []
+    if index:
+        upper = end.date() if "T" not in job["end"] else end
+        for t in index.iter_before(upper):
+            if t < start:
+                break
+            times.append(index.time_param(t))
+            if len(times) > max_steps:
+                break
+        times.reverse()
+    else:
+        t = start
+        while t <= end and len(times) <= max_steps:
+            times.append(t.strftime("%Y-%m-%d"))
+            t += timedelta(days=1)
+    if len(times) > max_steps:
+        raise ValueError(f"más de {max_steps} instantes en el rango (ver --max-steps)")
+    if not times:
+        raise ValueError(f"la capa no tiene datos entre {job['start']} y {job['end']}")
+    return times
+
+class BatchState:
+    """
+    Avance del lote en SQLite: especificación y estado de cada trabajo y
+    resultado de cada instante. Solo se usa desde el hilo que despacha.
+    """
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                spec TEXT NOT NULL,
+                status TEXT NOT NULL,
+                images INTEGER NOT NULL DEFAULT 0,
+                missing INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tasks (
+                job_id TEXT NOT NULL,
+                time TEXT NOT NULL,
+                status TEXT NOT NULL,
+                path TEXT,
+                error TEXT,
+                PRIMARY KEY (job_id, time)
+            );
+        """)
+
+    def sync_job(self, jid: str, spec: Dict) -> str:
+        """Registra el trabajo y retorna su estado; si la especificación cambió, se reinicia."""
+        text = json.dumps(spec, sort_keys=True, ensure_ascii=False)
+        row = self.conn.execute("SELECT spec, status FROM jobs WHERE job_id = ?", (jid,)).fetchone()
+        if row is not None and row[0] == text:
+            return row[1]
+        with self.conn:
+            if row is not None:
+                logging.info(f"Trabajo {jid}: la especificación cambió, se reinicia")
+                self.conn.execute("DELETE FROM tasks WHERE job_id = ?", (jid,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, spec, status, updated_at) VALUES (?, ?, 'pending', ?)",
+                (jid, text, time.time()))
+        return "pending"
+
+    def done_times(self, jid: str) -> Set[str]:
+        return {t for (t,) in self.conn.execute(
+            "SELECT time FROM tasks WHERE job_id = ? AND status = 'done'", (jid,))}
+
+    def record_task(self, jid: str, time_param: str, path: Optional[Path], error: Optional[str] = None):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO tasks (job_id, time, status, path, error) VALUES (?, ?, ?, ?, ?)",
+                (jid, time_param, "done" if path else "missing", str(path) if path else None, error))
+
+    def finish_job(self, jid: str, times: List[str], error: Optional[str] = None) -> str:
+        """Cierra el trabajo: done si todos sus instantes tienen imagen, failed si no."""
+        placeholders = ",".join("?" * len(times))
+        done = self.done_times(jid) if times else set()
+        missing = [t for t in times if t not in done]
+        if error is None and missing:
+            listed = ", ".join(missing[:MAX_LISTED_MISSING])
+            more = f" (+{len(missing) - MAX_LISTED_MISSING})" if len(missing) > MAX_LISTED_MISSING else ""
+            error = f"sin imagen para TIME {listed}{more}"
+        status = "failed" if error else "done"
+        with self.conn:
+            if times:
+                # Instantes que ya no corresponden al rango (p. ej. índice temporal actualizado)
+                self.conn.execute(f"DELETE FROM tasks WHERE job_id = ? AND time NOT IN ({placeholders})",
+                                  (jid, *times))
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, images = ?, missing = ?, error = ?, updated_at = ? WHERE job_id = ?",
+                (status, len(times) - len(missing), len(missing), error, time.time(), jid))
+        return status
+
+    def write_report(self, job_ids: List[str], path: Path) -> Dict[str, int]:
+        """CSV con una fila por trabajo del manifiesto; retorna el conteo por estado."""
+        counts: Dict[str, int] = {}
+        tmp = path.with_name(path.name + ".tmp")
+        with tmp.open("w", newline="", encoding="utf-8") as f:
+            w = csv.writer(f)
+            w.writerow(["job_id", "status", "images", "missing", "error"])
+            for jid in job_ids:
+                row = self.conn.execute(
+                    "SELECT status, images, missing, error FROM jobs WHERE job_id = ?", (jid,)).fetchone()
+                if row is None:
+                    continue
+                w.writerow([jid, *row])
+                counts[row[0]] = counts.get(row[0], 0) + 1
+        tmp.replace(path)
+        return counts
+
+    def close(self):
+        self.conn.close()
+
+def _resolve_places(args, script_dir: Path, places: List[str]):
+    """Geocodifica en segundo plano los lugares distintos del lote; retorna (Future, caché)."""
+    geo_cache = None
+    if not args.no_cache:
+        geo_cache = GeocodeCache(script_dir / CACHE_DIR_NAME / "geocode.sqlite", args.geocode_ttl_days)
+    geocoder = BatchGeocoder(lambda p: geocode_place(p, raise_errors=True), cache=geo_cache,
+                             offline=args.offline)
+    return geocoder.resolve_async(places), geo_cache
+
+def run_batch(args, out_dir: Path, script_dir: Path):
+    """Ejecuta (o reanuda) el lote del manifiesto args.jobs."""
+    manifest = Path(args.jobs)
+    try:
+        specs = load_manifest(manifest)
+    except OSError as e:
+        logging.error(f"No se pudo leer el manifiesto {manifest}: {e}")
+        return
+    default_size = (parse_sizes(args.sizes) or DEFAULT_SIZES)[0]
+    state = BatchState(Path(args.state) if args.state else out_dir / "batch_state.sqlite")
+    order: List[str] = []
+    try:
+        # 1) Registrar trabajos y elegir los pendientes
+        pending: Dict[str, Dict] = {}
+        for spec in specs:
+            jid = job_id(spec)
+            if jid in pending or jid in order:
+                logging.warning(f"Trabajo {jid} repetido en el manifiesto; se usa la primera aparición")
+                continue
+            order.append(jid)
+            status = state.sync_job(jid, spec)
+            if status == "done" or (status == "failed" and not args.retry_failed):
+                continue
+            try:
+                pending[jid] = normalize_job(spec, default_size, args.buffer_km)
+            except (ValueError, TypeError) as e:
+                state.finish_job(jid, [], f"especificación inválida: {e}")
+        skipped = len(order) - len(pending)
+        logging.info(f"Manifiesto {manifest}: {len(order)} trabajos, {len(pending)} pendientes, {skipped} ya cerrados")
+        if pending:
+            _run_pending(args, out_dir, script_dir, state, pending)
+    finally:
+        report = out_dir / REPORT_NAME
+        counts = state.write_report(order, report)
+        state.close()
+        logging.info(f"Lote: {counts.get('done', 0)} completos, {counts.get('failed', 0)} con fallas, "
+                     f"{counts.get('pending', 0)} pendientes. Reporte: {report}")
+
+def _run_pending(args, out_dir: Path, script_dir: Path, state: BatchState, pending: Dict[str, Dict]):
+    # 2) Trabajo compartido: geocodificación (en paralelo) y GetCapabilities, una vez por lote
+    places = sorted({job["place"] for job in pending.values() if job["bbox"] is None})
+    geocoded, geo_cache = _resolve_places(args, script_dir, places) if places else (None, None)
+    cache = None if args.no_cache else CapabilitiesCache(script_dir / CACHE_DIR_NAME / "getcap.sqlite")
+    try:
+        rows = load_layer_rows(gibs_Fer.session, out_dir, cache, args.getcap_ttl)
+    except Exception as e:
+        logging.error(f"No se pudo descargar GetCapabilities: {e}; los trabajos quedan pendientes")
+        return
+    finally:
+        if cache is not None:
+            cache.close()
+    resolved = geocoded.result() if geocoded is not None else {}
+    if geo_cache is not None:
+        geo_cache.close()
+    rows_by_id = {r['id']: r for r in rows}
+    indexes: Dict[str, Optional[TimeIndex]] = {}
+
+    # 3) Expandir cada trabajo a sus instantes TIME
+    plan: Dict[str, Tuple[Dict, List[str], List[str]]] = {}
+    for jid, job in pending.items():
+        try:
+            rec = rows_by_id.get(job["layer"])
+            if rec is None:
+                raise ValueError(f"capa {job['layer']} no encontrada en GetCapabilities")
+            if job["layer"] not in indexes:
+                indexes[job["layer"]] = TimeIndex.from_values(rec.get('time_values'))
+            bbox = job["bbox"] or resolved.get(job["place"])
+            if not bbox:
+                raise ValueError(f"no se obtuvo bbox para '{job['place']}'")
+            job["bbox"] = expand_bbox_km(bbox, job["buffer_km"])
+            times = job_times(job, indexes[job["layer"]], args.max_steps)
+        except ValueError as e:
+            state.finish_job(jid, [], str(e))
+            logging.warning(f"Trabajo {jid}: {e}")
+            continue
+        done = state.done_times(jid)
+        todo = [t for t in times if t not in done]
+        if todo:
+            plan[jid] = (job, times, todo)
+        else:
+            state.finish_job(jid, times)
+    total = sum(len(todo) for _, _, todo in plan.values())
+    if not total:
+        return
+
+    # 4) Un solo pool para todas las descargas del lote
+    workers = max(1, args.workers)
+    logging.info(f"Lote: {total} descargas en {len(plan)} trabajos, {workers} workers, {args.per_host} por host")
+    download_fn = configure_downloads(args, out_dir, script_dir)
+    session = create_session(pool_size=max(10, workers))
+    cancel = threading.Event()
+    remaining = {jid: len(todo) for jid, (_, _, todo) in plan.items()}
+    closed = {"done": 0, "failed": 0}
+
+    def tasks() -> Iterator[Tuple[str, str]]:
+        for jid, (_, _, todo) in plan.items():
+            for time_param in todo:
+                yield jid, time_param
+
+    def run_task(jid: str, time_param: str) -> Optional[Path]:
+        job = plan[jid][0]
+        job_dir = out_dir / JOBS_DIR_NAME / jid
+        job_dir.mkdir(parents=True, exist_ok=True)
+        return download_fn(session, job_dir, job["layer"], time_param, job["bbox"], job["size"], cancel)
+
+    pending_tasks = tasks()
+    in_flight = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gibs-batch") as pool:
+            def submit_next() -> bool:
+                for task in pending_tasks:
+                    in_flight[pool.submit(run_task, *task)] = task
+                    return True
+                return False
+
+            try:
+                while len(in_flight) < workers and submit_next():
+                    pass
+                while in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        jid, time_param = in_flight.pop(fut)
+                        try:
+                            path, error = fut.result(), None
+                        except Exception as e:
+                            logging.warning(f"Trabajo {jid} TIME={time_param}: {e}")
+                            path, error = None, f"{type(e).__name__}: {e}"
+                        state.record_task(jid, time_param, path, error)
+                        remaining[jid] -= 1
+                        if remaining[jid] == 0:
+                            status = state.finish_job(jid, plan[jid][1])
+                            closed[status] += 1
+                            logging.info(f"Trabajo {jid}: {status}")
+                        while len(in_flight) < workers and submit_next():
+                            pass
+            except KeyboardInterrupt:
+                cancel.set()
+                for fut in in_flight:
+                    fut.cancel()
+                logging.warning("Interrumpido por usuario; el lote se reanuda en la próxima corrida.")
+    finally:
+        release_downloads()
+    logging.info(f"Esta corrida cerró {closed['done']} trabajos completos y {closed['failed']} con fallas")
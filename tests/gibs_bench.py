@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# gibs_bench.py
+"""
+Benchmarks offline del descargador GIBS (gibs_Fer.py), sin red externa.
+Un servidor local imita los tres servicios:
+ - GetCapabilities: un XML grabado (--getcap-fixture, p.ej. Test_gibs/getcap_raw.xml)
+   o uno sintético con --layers capas
+ - image-download: JPEG sintéticos de --image-kb KB con latencia (--latency-ms)
+   y tasa de errores HTTP 500 (--error-rate) configurables
+ - Nominatim /search: respuestas enlatadas a partir de gazetteer.csv
+Mide:
+ - parse_capabilities y collect_layers_with_dates sobre el catálogo completo
+ - load_layer_rows con caché de GetCapabilities fría y caliente
+ - descarga de imágenes: MB/s e imágenes/s para cada valor de --workers
+ - gibs_Fer.main de punta a punta (barrido --collect-all)
+Los resultados se guardan como JSON (línea base); --compare marca regresiones.
+
+Uso:
+  python gibs_bench.py --out bench_baselines/base.json
+  python gibs_bench.py --compare bench_baselines/base.json --tolerance 0.2
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import gibs_Fer
+from gibs_geocode import load_gazetteer, normalize_place
+
+# Métricas donde "más alto es mejor"; el resto son latencias (más bajo es mejor)
+HIGHER_IS_BETTER = ("mb_per_s", "images_per_s")
+
+# -------------------- SERVIDOR LOCAL ---------------------
+def synthetic_capabilities(n_layers: int) -> bytes:
+    """GetCapabilities WMTS con n capas, cada una con dimensión Time en rangos ISO 8601."""
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<Capabilities xmlns="http://www.opengis.net/wmts/1.0" '
+             'xmlns:ows="http://www.opengis.net/ows/1.1" version="1.0.0"><Contents>']
+    for i in range(n_layers):
+        daily = i % 3 != 0
+        values = ("<Value>2002-07-04/2015-12-31/P1D</Value><Value>2016-01-01/2025-10-0%d/P1D</Value>" % (1 + i % 9)
+                  if daily else "<Value>2000-01-01/2025-09-01/P1M</Value>")
+        parts.append(
+            f'<Layer><ows:Title>Synthetic layer {i}</ows:Title><ows:Identifier>BENCH_Layer_{i:05d}</ows:Identifier>'
+            '<Style isDefault="true"><ows:Identifier>default</ows:Identifier></Style><Format>image/jpeg</Format>'
+            f'<Dimension><ows:Identifier>Time</ows:Identifier><UOM>ISO8601</UOM><Default>2025-10-01</Default>'
+            f'<Current>false</Current>{values}</Dimension>'
+            '<TileMatrixSetLink><TileMatrixSet>250m</TileMatrixSet></TileMatrixSetLink>'
+            f'<ResourceURL format="image/jpeg" resourceType="tile" template="https://example/{i}/default/'
+            '{Time}/{TileMatrixSet}/{TileMatrix}/{TileRow}/{TileCol}.jpg"/></Layer>')
+    parts.append('</Contents></Capabilities>')
+    return "".join(parts).encode("utf-8")
+
+class StandIn:
+    """Servidor HTTP local (hilo de fondo) que imita GIBS y Nominatim."""
+    def __init__(self, getcap: bytes, image_kb: int = 150, latency_ms: float = 0.0,
+                 error_rate: float = 0.0, seed: int = 0):
+        self.getcap = getcap
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        # JPEG "sintético": cabecera SOI + bytes aleatorios (pasa el filtro de imágenes vacías)
+        self.image = b"\xff\xd8\xff\xe0" + os.urandom(max(1, image_kb * 1024 - 4))
+        self.gazetteer = load_gazetteer()
+        self.stats = {"requests": 0, "errors": 0, "images": 0, "bytes": 0}
+        self._stats_lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stand_in._handle(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="stand-in", daemon=True)
+
+    @property
+    def base(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _fail(self) -> bool:
+        with self._rng_lock:
+            return self.rng.random() < self.error_rate
+
+    def _handle(self, h: BaseHTTPRequestHandler):
+        url = urlparse(h.path)
+        status, ctype, body = 404, "text/plain", b"not found"
+        if url.path.endswith("wmts.cgi"):
+            status, ctype, body = 200, "application/xml", self.getcap
+        elif url.path.endswith("image-download"):
+            if self.latency:
+                time.sleep(self.latency)
+            if self._fail():
+                status, ctype, body = 500, "text/plain", b"synthetic error"
+            else:
+                status, ctype, body = 200, "image/jpeg", self.image
+        elif url.path.endswith("search"):
+            place = parse_qs(url.query).get("q", [""])[0]
+            bbox = self.gazetteer.get(normalize_place(place))
+            hits = [] if bbox is None else [{"display_name": place, "boundingbox":
+                                             [str(bbox[1]), str(bbox[3]), str(bbox[0]), str(bbox[2])]}]
+            status, ctype, body = 200, "application/json", json.dumps(hits).encode("utf-8")
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            self.stats["errors"] += status >= 500
+            self.stats["images"] += status == 200 and ctype == "image/jpeg"
+            self.stats["bytes"] += len(body) if status == 200 else 0
+        h.send_response(status)
+        h.send_header("Content-Type", ctype)
+        h.send_header("Content-Length", str(len(body)))
+        h.end_headers()
+        h.wfile.write(body)
+
+    def __enter__(self):
+        self.thread.start()
+        self._saved = (gibs_Fer.GIBS_GETCAP_URL, gibs_Fer.IMAGE_DOWNLOAD_BASE, gibs_Fer.NOMINATIM_URL)
+        gibs_Fer.GIBS_GETCAP_URL = f"{self.base}/wmts/epsg4326/best/wmts.cgi?request=GetCapabilities"
+        gibs_Fer.IMAGE_DOWNLOAD_BASE = f"{self.base}/image-download"
+        gibs_Fer.NOMINATIM_URL = f"{self.base}/search"
+        return self
+
+    def __exit__(self, *exc):
+        gibs_Fer.GIBS_GETCAP_URL, gibs_Fer.IMAGE_DOWNLOAD_BASE, gibs_Fer.NOMINATIM_URL = self._saved
+        self.server.shutdown()
+        self.server.server_close()
+        return False
+
+# -------------------- MEDICIONES ------------------------
+def timed(fn: Callable, repeat: int) -> Dict[str, float]:
+    """Segundos por llamada: mínimo, mediana y p95 de repeat ejecuciones."""
+    samples = []
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    return {"min_s": samples[0], "median_s": statistics.median(samples),
+            "p95_s": samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))]}
+
+def bench_parsing(xml_text: str, repeat: int) -> Dict[str, Dict]:
+    n_layers = len(gibs_Fer.parse_capabilities(xml_text))
+    return {
+        "parse_capabilities": {**timed(lambda: gibs_Fer.parse_capabilities(xml_text), repeat), "layers": n_layers},
+        "collect_layers_with_dates": timed(lambda: gibs_Fer.collect_layers_with_dates(xml_text), repeat),
+    }
+
+def bench_load_layer_rows(out_dir: Path, repeat: int) -> Dict[str, Dict]:
+    """
+    load_layer_rows contra el servidor local:
+    - cold: caché SQLite nueva en cada llamada (descarga + parseo en streaming)
+    - warm: caché ya poblada y vigente (sin red ni XML)
+    """
+    session = gibs_Fer.create_session()
+    runs = itertools.count()
+
+    def cold():
+        cache = gibs_Fer.CapabilitiesCache(out_dir / "getcap_cold" / f"{next(runs)}.sqlite")
+        try:
+            return gibs_Fer.load_layer_rows(session, out_dir, cache)
+        finally:
+            cache.close()
+
+    warm_cache = gibs_Fer.CapabilitiesCache(out_dir / "getcap_warm.sqlite")
+    try:
+        n_layers = len(gibs_Fer.load_layer_rows(session, out_dir, warm_cache))
+        return {
+            "cold": {**timed(cold, repeat), "layers": n_layers},
+            "warm": timed(lambda: gibs_Fer.load_layer_rows(session, out_dir, warm_cache, ttl=3600.0), repeat),
+        }
+    finally:
+        warm_cache.close()
+
+def bench_downloads(stand_in: StandIn, out_dir: Path, n_images: int, workers: int) -> Dict[str, float]:
+    """n_images descargas distintas (bbox distintas) con run_attempts_concurrent --collect-all."""
+    gibs_Fer.set_image_cache(None)
+    gibs_Fer.set_per_host_limit(max(workers, 1))
+    attempts = [("BENCH_Layer_00000", "2025-10-01", [-90.0 - i * 0.01, 13.0, -88.0, 15.0], (800, 600))
+                for i in range(n_images)]
+    session = gibs_Fer.create_session(pool_size=max(10, workers))
+    before = dict(stand_in.stats)
+    t0 = time.perf_counter()
+    paths = gibs_Fer.run_attempts_concurrent(session, out_dir, attempts, workers, collect_all=True)
+    elapsed = time.perf_counter() - t0
+    size = sum(p.stat().st_size for p in paths)
+    return {"seconds": elapsed, "images": len(paths), "mb_per_s": size / 1e6 / elapsed,
+            "images_per_s": len(paths) / elapsed,
+            "server_errors": stand_in.stats["errors"] - before["errors"]}
+
+def bench_main(stand_in: StandIn, out_dir: Path, workers: int, places: str, max_layers: int) -> Dict[str, float]:
+    """
+    gibs_Fer.main de punta a punta, sin cachés, barriendo todas las combinaciones.
+    Los lugares se resuelven con el gazetteer local (--offline) para no medir
+    el límite de 1 solicitud/s de Nominatim.
+    Las imágenes se cuentan en el servidor (incluye las descartadas como sin datos).
+    """
+    argv = ["--places", places, "--offline", "--workers", str(workers), "--collect-all", "--no-cache",
+            "--max-layers", str(max_layers), "--sizes", "800x600", "--out-dir", str(out_dir)]
+    gibs_Fer.set_image_cache(None)
+    before = dict(stand_in.stats)
+    t0 = time.perf_counter()
+    gibs_Fer.main(argv)
+    elapsed = time.perf_counter() - t0
+    images = stand_in.stats["images"] - before["images"]
+    return {"seconds": elapsed, "images": images, "images_per_s": images / elapsed if elapsed else 0.0}
+
+# -------------------- LÍNEAS BASE -----------------------
+def flatten(results: Dict, prefix: str = "") -> Dict[str, float]:
+    out = {}
+    for k, v in results.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(flatten(v, key + "."))
+        elif isinstance(v, (int, float)):
+            out[key] = float(v)
+    return out
+
+def compare(current: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Lista de regresiones (métricas de tiempo/throughput peores que la tolerancia)."""
+    cur, base = flatten(current), flatten(baseline)
+    regressions = []
+    for key, old in sorted(base.items()):
+        new = cur.get(key)
+        metric = key.rsplit(".", 1)[-1]
+        if new is None or old <= 0 or metric not in HIGHER_IS_BETTER + ("min_s", "median_s", "p95_s", "seconds"):
+            continue
+        change = (new - old) / old
+        worse = change < -tolerance if metric in HIGHER_IS_BETTER else change > tolerance
+        flag = "REGRESIÓN" if worse else "ok"
+        print(f"{flag:>10}  {key:<55} {old:>10.4f} -> {new:>10.4f} ({change:+.1%})")
+        if worse:
+            regressions.append(key)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks offline del descargador GIBS.")
+    parser.add_argument("--getcap-fixture", default="", help="GetCapabilities grabado (por defecto uno sintético)")
+    parser.add_argument("--layers", type=int, default=5000, help="Capas del GetCapabilities sintético")
+    parser.add_argument("--image-kb", type=int, default=150, help="Tamaño de cada JPEG sintético")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Latencia simulada de image-download")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="Fracción de respuestas HTTP 500")
+    parser.add_argument("--images", type=int, default=40, help="Imágenes por medición de descarga")
+    parser.add_argument("--workers", default="1,4,8", help="Valores de --workers a medir")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeticiones de las mediciones de latencia")
+    parser.add_argument("--places", default="Guatemala,Honduras,El Salvador",
+                        help="Lugares del barrido de punta a punta (deben estar en gazetteer.csv)")
+    parser.add_argument("--main-layers", type=int, default=3, help="--max-layers del barrido de punta a punta")
+    parser.add_argument("--skip-main", action="store_true", help="No medir gibs_Fer.main")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="", help="JSON de resultados (por defecto bench_baselines/<fecha>.json)")
+    parser.add_argument("--compare", default="", help="Línea base JSON contra la cual comparar")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Empeoramiento relativo tolerado")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    getcap = Path(args.getcap_fixture).read_bytes() if args.getcap_fixture else synthetic_capabilities(args.layers)
+    workers_list = [int(w) for w in args.workers.split(",") if w.strip()]
+    results: Dict = {}
+    with tempfile.TemporaryDirectory(prefix="gibs_bench_") as tmp, \
+            StandIn(getcap, args.image_kb, args.latency_ms, args.error_rate, args.seed) as stand_in:
+        tmp = Path(tmp)
+        xml_text = getcap.decode("utf-8")
+        print("Midiendo parse_capabilities / collect_layers_with_dates ...")
+        results.update(bench_parsing(xml_text, args.repeat))
+        print("Midiendo load_layer_rows (caché fría / caliente) ...")
+        results["load_layer_rows"] = bench_load_layer_rows(tmp, args.repeat)
+        results["load_layer_rows"]["cold"]["bytes"] = len(getcap)
+        for w in workers_list:
+            print(f"Midiendo descargas con {w} workers ...")
+            out = tmp / f"dl_{w}"
+            out.mkdir()
+            results[f"download_w{w}"] = bench_downloads(stand_in, out, args.images, w)
+        if not args.skip_main:
+            for w in workers_list:
+                print(f"Midiendo gibs_Fer.main con {w} workers ...")
+                out = tmp / f"main_{w}"
+                out.mkdir()
+                results[f"main_w{w}"] = bench_main(stand_in, out, w, args.places, args.main_layers)
+        results["server"] = dict(stand_in.stats)
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "verbose")},
+        },
+        "results": results,
+    }
+    out_path = Path(args.out) if args.out else \
+        Path(__file__).resolve().parent / "bench_baselines" / f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Resultados guardados en {out_path}")
+
+    for key, value in sorted(flatten(results).items()):
+        print(f"  {key:<55} {value:.4f}")
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regressions = compare(results, baseline.get("results", {}), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regresiones sobre la tolerancia de {args.tolerance:.0%}")
+            sys.exit(1)
+        print("Sin regresiones.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+# gibs_composite.py
+"""
+Compuesto multi-día "mejor píxel" de las capas true color MODIS Terra/Aqua y
+VIIRS (las de LAYERS en gibs_auto-Fer.py) para una región.
+ - Las imágenes de los últimos --days días (misma bbox y tamaño: píxeles alineados)
+   se guardan en pilas .npy abiertas con memmap: stack_rgb (S, H, W, 3) y
+   stack_score (S, H, W), con S = días x capas.
+ - Puntaje de nube por píxel (uint8): brillo medio x (canal mínimo / canal máximo).
+   Alto en píxeles brillantes y blancos (nubes), bajo en superficie despejada.
+   Los píxeles casi negros (huecos entre pasadas, fuera del swath) son NODATA.
+ - El compuesto toma por píxel el menor puntaje en una pasada vectorizada por
+   bloques de filas (argmin sobre la pila; en empate gana la fecha más reciente).
+ - Actualización diaria incremental: una imagen nueva reemplaza solo los píxeles
+   que mejora; solo se re-eligen los píxeles que venían de fechas que salen de la ventana.
+ - Las descargas pasan por gibs_Fer (caché de imágenes, cupo por host,
+   detector de imágenes sin datos); una fecha ya apilada no se vuelve a pedir.
+
+Uso:
+  python gibs_composite.py --place "Guatemala" --days 8 --size 1024x1024
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import gibs_Fer
+from gibs_Fer import (CACHE_DIR_NAME, DEFAULT_GETCAP_TTL, DEFAULT_IMAGE_CACHE_ENTRIES, DEFAULT_IMAGE_CACHE_MB,
+                      DEFAULT_LATEST_TTL, DEFAULT_PER_HOST, CapabilitiesCache, configure_downloads, create_session,
+                      expand_bbox_km, geocode_place, load_layer_rows, parse_sizes, release_downloads, setup_logging)
+from gibs_geocode import BatchGeocoder, GeocodeCache, DEFAULT_TTL_DAYS
+from gibs_time import TimeIndex
+
+# Capas true color de LAYERS en gibs_auto-Fer.py (BlueMarble no cambia y no aporta)
+LAYERS = (
+    "MODIS_Terra_CorrectedReflectance_TrueColor",
+    "MODIS_Aqua_CorrectedReflectance_TrueColor",
+    "VIIRS_SNPP_CorrectedReflectance_TrueColor",
+)
+DEFAULT_DAYS = 8
+DEFAULT_SIZE = (1024, 1024)
+DEFAULT_WORKERS = 6
+BLOCK_ROWS = 256
+NODATA = 255                 # puntaje de un píxel sin dato
+NODATA_MAX = 12              # canal máximo <= esto (negro con ruido JPEG) = sin dato
+MAX_SLOTS = 256              # la clave de selección (puntaje x S + rango) cabe en uint16
+RETRY_MISSING_S = 6 * 3600   # una fecha/capa sin imagen se vuelve a pedir pasado este tiempo
+
+def cloud_score(rgb: np.ndarray) -> np.ndarray:
+    """
+    Puntaje uint8 de un arreglo (..., 3) uint8: media * mín / máx de los canales
+    (0 = oscuro o saturado de color, ~254 = blanco brillante); NODATA si es casi negro.
+    """
+    c = rgb.astype(np.uint32)
+    mx = c.max(axis=-1)
+    mn = c.min(axis=-1)
+    score = c.sum(axis=-1)
+    score *= mn
+    score //= 3 * np.maximum(mx, 1)
+    np.minimum(score, NODATA - 1, out=score)
+    score[mx <= NODATA_MAX] = NODATA
+    return score.astype(np.uint8)
+
+def select_best(scores: np.ndarray, rank: np.ndarray) -> np.ndarray:
+    """
+    Índice (eje 0) del menor puntaje de cada píxel; en empate, el de menor rank
+    (fecha más reciente). Una sola pasada: argmin de puntaje * S + rank.
+    """
+    s = scores.shape[0]
+    key = scores.astype(np.uint16)
+    key *= s
+    key += rank.astype(np.uint16).reshape((s,) + (1,) * (scores.ndim - 1))
+    return key.argmin(axis=0)
+
+class CompositeStore:
+    """
+    Pilas, compuesto y estado (state.json) de una región bajo root. Antes de
+    tocar las pilas se marca dirty; si una corrida se corta, al abrir se
+    reconstruye el compuesto desde la pila.
+    """
+    def __init__(self, root: Path, bbox: List[float], size: Tuple[int,int], layers: Sequence[str], days: int):
+        self.root = root
+        self.state_path = root / "state.json"
+        capacity = days * len(layers)
+        if capacity > MAX_SLOTS:
+            raise ValueError(f"days x capas = {capacity} supera {MAX_SLOTS}")
+        width, height = size
+        state = json.loads(self.state_path.read_text(encoding="utf-8")) if self.state_path.exists() else None
+        fresh = state is None or state["bbox"] != list(bbox) or state["size"] != [width, height] \
+            or state["layers"] != list(layers) or state["capacity"] != capacity
+        if state is not None and fresh:
+            logging.warning(f"Cambió bbox/tamaño/capas/días de {root.name}; se reinicia la pila")
+            shutil.rmtree(root, ignore_errors=True)
+        root.mkdir(parents=True, exist_ok=True)
+        mode = "w+" if fresh else "r+"
+        om = np.lib.format.open_memmap
+
+        def arr(name, dtype, shape):
+            return om(root / f"{name}.npy", mode=mode, dtype=dtype, shape=shape if fresh else None)
+
+        self.rgb = arr("stack_rgb", np.uint8, (capacity, height, width, 3))
+        self.score = arr("stack_score", np.uint8, (capacity, height, width))
+        self.comp_rgb = arr("composite_rgb", np.uint8, (height, width, 3))
+        self.comp_score = arr("composite_score", np.uint8, (height, width))
+        self.comp_src = arr("composite_src", np.int16, (height, width))
+        if fresh:
+            self.score[:] = NODATA
+            self.comp_score[:] = NODATA
+            self.comp_src[:] = -1
+            self.state = {"bbox": list(bbox), "size": [width, height], "layers": list(layers),
+                          "capacity": capacity, "slots": [None] * capacity, "missing": {}, "dirty": False}
+            self._save()
+        else:
+            self.state = state
+            if state["dirty"]:
+                logging.warning(f"{root.name}: actualización interrumpida; se reconstruye el compuesto")
+                self.rebuild()
+
+    # ---- estado ----
+    def _save(self):
+        tmp = self.state_path.with_name(self.state_path.name + ".tmp")
+        tmp.write_text(json.dumps(self.state, indent=2), encoding="utf-8")
+        os.replace(tmp, self.state_path)
+
+    def _begin(self):
+        self.state["dirty"] = True
+        self._save()
+
+    def _commit(self):
+        self.flush()
+        self.state["dirty"] = False
+        self._save()
+
+    def flush(self):
+        for a in (self.rgb, self.score, self.comp_rgb, self.comp_score, self.comp_src):
+            a.flush()
+
+    @property
+    def slots(self) -> List[Optional[Dict]]:
+        return self.state["slots"]
+
+    def has(self, date_str: str, layer: str) -> bool:
+        return any(sl and sl["date"] == date_str and sl["layer"] == layer for sl in self.slots)
+
+    def should_fetch(self, date_str: str, layer: str) -> bool:
+        """False si ya está apilada o si se pidió hace poco sin obtener imagen."""
+        if self.has(date_str, layer):
+            return False
+        tried = self.state["missing"].get(f"{date_str}/{layer}")
+        return tried is None or time.time() - tried > RETRY_MISSING_S
+
+    def mark_missing(self, date_str: str, layer: str):
+        self.state["missing"][f"{date_str}/{layer}"] = time.time()
+        self._save()
+
+    def _rank(self) -> np.ndarray:
+        """Rango por slot para desempatar: 0 = fecha más reciente (y primera capa); vacíos al final."""
+        layers = self.state["layers"]
+
+        def key(i):
+            sl = self.slots[i]
+            if sl is None:
+                return (1, 0, 0)
+            return (0, -date.fromisoformat(sl["date"]).toordinal(), layers.index(sl["layer"]))
+        rank = np.empty(len(self.slots), dtype=np.intp)
+        rank[sorted(range(len(self.slots)), key=key)] = np.arange(len(self.slots))
+        return rank
+
+    # ---- compuesto ----
+    def rebuild(self):
+        """Recalcula el compuesto completo desde la pila, por bloques de filas."""
+        self._begin()
+        for i, sl in enumerate(self.slots):
+            if sl is None:
+                self.score[i] = NODATA
+        rank = self._rank()
+        height = self.comp_score.shape[0]
+        for r0 in range(0, height, BLOCK_ROWS):
+            rows = slice(r0, min(height, r0 + BLOCK_ROWS))
+            scores = np.asarray(self.score[:, rows])
+            best = select_best(scores, rank)
+            sc = np.take_along_axis(scores, best[None], axis=0)[0]
+            rgb = np.take_along_axis(np.asarray(self.rgb[:, rows]), best[None, ..., None], axis=0)[0]
+            empty = sc == NODATA
+            rgb[empty] = 0
+            self.comp_rgb[rows] = rgb
+            self.comp_score[rows] = sc
+            self.comp_src[rows] = np.where(empty, -1, best)
+        self._commit()
+
+    def _reselect(self, r0: int, stale: np.ndarray, rank: np.ndarray, cs: np.ndarray, src: np.ndarray) -> int:
+        """Vuelve a elegir entre todos los slots solo los píxeles marcados en stale (bloque desde la fila r0)."""
+        r, c = np.nonzero(stale)
+        if not r.size:
+            return 0
+        scores = self.score[:, r + r0, c]
+        best = select_best(scores, rank)
+        sc = scores[best, np.arange(r.size)]
+        empty = sc == NODATA
+        px = self.rgb[best, r + r0, c]
+        px[empty] = 0
+        cs[r, c] = sc
+        src[r, c] = np.where(empty, -1, best)
+        self.comp_rgb[r + r0, c] = px
+        return int(r.size)
+
+    def add(self, date_str: str, layer: str, rgb: np.ndarray) -> int:
+        """
+        Apila una imagen (H, W, 3) uint8 y actualiza el compuesto sin recalcularlo:
+        solo cambian los píxeles que la imagen mejora (y los del slot reemplazado).
+        Retorna la cantidad de píxeles del compuesto que cambiaron.
+        """
+        slots = self.slots
+        free = [i for i, sl in enumerate(slots) if sl is None]
+        s = free[0] if free else int(np.argmax(self._rank()))   # sin lugar: se reemplaza el más antiguo
+        evicted = slots[s] is not None
+        slots[s] = None
+        self._begin()
+        score = cloud_score(rgb)
+        self.rgb[s] = rgb
+        self.score[s] = score
+        slots[s] = {"date": date_str, "layer": layer}
+        self.state["missing"].pop(f"{date_str}/{layer}", None)
+        rank = self._rank()
+        changed = 0
+        height = self.comp_score.shape[0]
+        for r0 in range(0, height, BLOCK_ROWS):
+            rows = slice(r0, min(height, r0 + BLOCK_ROWS))
+            cs = np.asarray(self.comp_score[rows]).copy()
+            src = np.asarray(self.comp_src[rows]).copy()
+            new = score[rows]
+            # En empate gana la más reciente; si src = -1 el puntaje actual es NODATA y no hay empate válido
+            better = (new < cs) | ((new == cs) & (new != NODATA) & (rank[s] < rank.take(np.maximum(src, 0))))
+            if evicted:
+                stale = src == s
+                better &= ~stale
+                changed += self._reselect(r0, stale, rank, cs, src)
+            if better.any():
+                cs[better] = new[better]
+                src[better] = s
+                block = self.comp_rgb[rows]
+                block[better] = rgb[rows][better]
+                changed += int(better.sum())
+            self.comp_score[rows] = cs
+            self.comp_src[rows] = src
+        self._commit()
+        return changed
+
+    def expire(self, oldest: str) -> int:
+        """Libera los slots con fecha < oldest; solo se re-eligen los píxeles que venían de ellos."""
+        gone = [i for i, sl in enumerate(self.slots) if sl and sl["date"] < oldest]
+        self.state["missing"] = {k: v for k, v in self.state["missing"].items() if k.split("/", 1)[0] >= oldest}
+        if not gone:
+            self._save()
+            return 0
+        self._begin()
+        for i in gone:
+            self.slots[i] = None
+            self.score[i] = NODATA
+        rank = self._rank()
+        changed = 0
+        height = self.comp_score.shape[0]
+        for r0 in range(0, height, BLOCK_ROWS):
+            rows = slice(r0, min(height, r0 + BLOCK_ROWS))
+            cs = np.asarray(self.comp_score[rows]).copy()
+            src = np.asarray(self.comp_src[rows]).copy()
+            changed += self._reselect(r0, np.isin(src, gone), rank, cs, src)
+            self.comp_score[rows] = cs
+            self.comp_src[rows] = src
+        self._commit()
+        return changed
+
+    def summary(self) -> Dict:
+        src = np.asarray(self.comp_src)
+        valid = src >= 0
+        counts = np.bincount(src[valid].ravel(), minlength=len(self.slots))
+        sources = {f"{sl['date']}/{sl['layer']}": int(counts[i]) for i, sl in enumerate(self.slots) if sl}
+        scores = np.asarray(self.comp_score)[valid]
+        return {
+            "bbox": self.state["bbox"],
+            "size": self.state["size"],
+            "coverage": float(valid.mean()),
+            "mean_score": float(scores.mean()) if scores.size else None,
+            "sources": {k: v for k, v in sorted(sources.items()) if v},
+        }
+
+    def export(self, path: Path):
+        """Escribe el compuesto como imagen (formato según la extensión) y un _meta.json al lado."""
+        if Image is None:
+            raise RuntimeError("Se necesita Pillow para exportar el compuesto")
+        tmp = path.with_name(path.name + ".tmp")
+        Image.fromarray(np.asarray(self.comp_rgb)).save(tmp, format=Image.registered_extensions()[path.suffix.lower()])
+        os.replace(tmp, path)
+        meta = path.with_name(path.stem + "_meta.json")
+        tmp = meta.with_name(meta.name + ".tmp")
+        tmp.write_text(json.dumps({**self.summary(), "file": str(path)}, indent=2, ensure_ascii=False),
+                       encoding="utf-8")
+        os.replace(tmp, meta)
+
+def load_rgb(path: Path, size: Tuple[int,int]) -> np.ndarray:
+    """Imagen como arreglo (H, W, 3) uint8 del tamaño pedido."""
+    with Image.open(path) as im:
+        im = im.convert("RGB")
+        if im.size != tuple(size):
+            im = im.resize(tuple(size))
+        return np.asarray(im, dtype=np.uint8)
+
+def candidate_dates(indexes: Dict[str, Optional[TimeIndex]], layers: Sequence[str],
+                    end: date, days: int) -> List[Tuple[str, str]]:
+    """(fecha, capa) de la ventana, más reciente primero; con índice TIME solo las disponibles."""
+    out = []
+    for k in range(days):
+        d = end - timedelta(days=k)
+        for layer in layers:
+            index = indexes.get(layer)
+            if index is None or index.contains(d):
+                out.append((d.strftime("%Y-%m-%d"), layer))
+    return out
+
+def region_key(name: str, size: Tuple[int,int]) -> str:
+    slug = re.sub(r"[^\w.-]+", "_", name.strip().lower()).strip("_") or "region"
+    return f"{slug}_{size[0]}x{size[1]}"
+
+def update_composite(args, store: CompositeStore, bbox: List[float], size: Tuple[int,int],
+                     indexes: Dict[str, Optional[TimeIndex]], end: date, download_dir: Path,
+                     download_fn) -> int:
+    """Descarga las fechas/capas nuevas de la ventana y las agrega al compuesto; retorna imágenes agregadas."""
+    oldest = (end - timedelta(days=args.days - 1)).strftime("%Y-%m-%d")
+    changed = store.expire(oldest)
+    if changed:
+        logging.info(f"Fechas anteriores a {oldest} fuera de la ventana: {changed} píxeles re-elegidos")
+    todo = [(d, layer) for d, layer in candidate_dates(indexes, store.state["layers"], end, args.days)
+            if store.should_fetch(d, layer)]
+    if not todo:
+        logging.info("Compuesto al día: no hay fechas nuevas para descargar")
+        return 0
+    logging.info(f"Descargando {len(todo)} imágenes (fecha x capa) con {args.workers} workers")
+    session = create_session(pool_size=max(10, args.workers))
+    added = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="composite") as pool:
+        futs = {pool.submit(download_fn, session, download_dir, layer, d, bbox, size): (d, layer)
+                for d, layer in todo}
+        # Las imágenes se apilan en el hilo principal a medida que llegan
+        for fut in as_completed(futs):
+            d, layer = futs[fut]
+            path = fut.result()
+            if not path:
+                store.mark_missing(d, layer)
+                continue
+            changed = store.add(d, layer, load_rgb(path, size))
+            path.unlink(missing_ok=True)   # ya está en la pila (y en la caché de imágenes)
+            added += 1
+            logging.info(f"{d} {layer}: {changed} píxeles del compuesto mejorados")
+    return added
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compuesto multi-día sin nubes de capas true color GIBS.")
+    parser.add_argument("--place", type=str, default="", help="Lugar a geocodificar")
+    parser.add_argument("--bbox", type=str, default="", help="--bbox=minLon,minLat,maxLon,maxLat (en vez de --place)")
+    parser.add_argument("--buffer-km", type=float, default=0.0, help="Buffer en km para la bbox geocodificada")
+    parser.add_argument("--days", type=int, default=DEFAULT_DAYS, help="Días de la ventana del compuesto")
+    parser.add_argument("--end", type=str, default="", help="Último día (YYYY-MM-DD, por defecto hoy UTC)")
+    parser.add_argument("--size", type=str, default=f"{DEFAULT_SIZE[0]}x{DEFAULT_SIZE[1]}", help="WxH")
+    parser.add_argument("--layers", type=str, default=",".join(LAYERS), help="Capas separadas por comas")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Descargas simultáneas")
+    parser.add_argument("--per-host", type=int, default=DEFAULT_PER_HOST, help="Máx solicitudes simultáneas por host")
+    parser.add_argument("--engine", choices=("image", "tiles"), default="image",
+                        help="image-download o composición con teselas WMTS")
+    parser.add_argument("--tile-workers", type=int, default=8, help="Teselas descargadas en paralelo por imagen")
+    parser.add_argument("--getcap-ttl", type=float, default=DEFAULT_GETCAP_TTL, help="Segundos de validez de GetCapabilities")
+    parser.add_argument("--geocode-ttl-days", type=float, default=DEFAULT_TTL_DAYS)
+    parser.add_argument("--no-cache", action="store_true", help="No usar cachés en disco")
+    parser.add_argument("--offline", action="store_true", help="Geocodificar solo con caché y gazetteer")
+    parser.add_argument("--rebuild", action="store_true", help="Recalcular el compuesto completo desde la pila")
+    parser.add_argument("--format", choices=("png", "jpg"), default="png", help="Formato del compuesto exportado")
+    parser.add_argument("--out-dir", type=str, default="", help="Carpeta de salida (por defecto GIBS_Composites)")
+    parser.add_argument("--verbose", action="store_true")
+    parser.set_defaults(image_cache_mb=DEFAULT_IMAGE_CACHE_MB, image_cache_entries=DEFAULT_IMAGE_CACHE_ENTRIES,
+                        latest_ttl=DEFAULT_LATEST_TTL)
+    args = parser.parse_args(argv)
+    setup_logging(args.verbose)
+    if Image is None:
+        parser.error("se necesita Pillow")
+    if not args.place and not args.bbox:
+        parser.error("indique --place o --bbox")
+    sizes = parse_sizes(args.size)
+    if not sizes:
+        parser.error(f"tamaño inválido: {args.size}")
+    size = sizes[0]
+    layers = [l.strip() for l in args.layers.split(",") if l.strip()]
+    end = date.fromisoformat(args.end) if args.end else datetime.now(timezone.utc).date()
+    script_dir = Path(__file__).resolve().parent
+    out_dir = Path(args.out_dir) if args.out_dir else script_dir / "GIBS_Composites"
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.bbox:
+        try:
+            bbox = [float(v) for v in args.bbox.split(",")]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4:
+            parser.error(f"bbox inválida: {args.bbox}")
+    else:
+        geo_cache = None if args.no_cache else GeocodeCache(script_dir / CACHE_DIR_NAME / "geocode.sqlite",
+                                                            args.geocode_ttl_days)
+        try:
+            geocoder = BatchGeocoder(lambda p: geocode_place(p, raise_errors=True), cache=geo_cache,
+                                     offline=args.offline)
+            bbox = geocoder.resolve([args.place])[args.place]
+        finally:
+            if geo_cache is not None:
+                geo_cache.close()
+        if not bbox:
+            logging.error(f"No se obtuvo bbox para '{args.place}'")
+            return
+        bbox = expand_bbox_km(bbox, args.buffer_km)
+
+    # Índice TIME de cada capa (GetCapabilities desde la caché compartida con gibs_Fer)
+    cache = None if args.no_cache else CapabilitiesCache(script_dir / CACHE_DIR_NAME / "getcap.sqlite")
+    try:
+        rows = {r['id']: r for r in load_layer_rows(gibs_Fer.session, out_dir, cache, args.getcap_ttl)}
+    except Exception as e:
+        logging.warning(f"No se pudo leer GetCapabilities ({e}); se probarán todas las fechas")
+        rows = {}
+    finally:
+        if cache is not None:
+            cache.close()
+    indexes = {layer: TimeIndex.from_values(rows[layer].get('time_values')) if layer in rows else None
+               for layer in layers}
+
+    region = out_dir / region_key(args.place or args.bbox, size)
+    store = CompositeStore(region, bbox, size, layers, args.days)
+    if args.rebuild:
+        store.rebuild()
+    download_fn = configure_downloads(args, out_dir, script_dir)
+    try:
+        added = update_composite(args, store, bbox, size, indexes, end, region / "downloads", download_fn)
+    except KeyboardInterrupt:
+        logging.warning("Interrumpido por usuario; lo apilado hasta ahora se conserva.")
+        added = 0
+    finally:
+        release_downloads()
+    image = region / f"composite.{args.format}"
+    store.export(image)
+    summary = store.summary()
+    logging.info(f"[OK] {image}: {added} imágenes nuevas, cobertura {summary['coverage']:.1%}, "
+                 f"{len(summary['sources'])} fechas/capas aportan píxeles")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# gibs_download.py
+"""
+Escritura robusta de descargas de imágenes GIBS.
+ - Lectura con readinto sobre un búfer reutilizable de DOWNLOAD_CHUNK bytes
+   (en vez de miles de escrituras de 1 KB).
+ - Se escribe a un .part estable por solicitud; al terminar se hace fsync y
+   os.replace: nunca queda un JPEG truncado con el nombre final.
+ - Si la conexión se corta, se reintenta con Range/If-Range desde el byte ya
+   escrito; el .part también sobrevive entre corridas.
+ - BlankDetector rechaza de forma barata las respuestas "sin datos": XML de
+   error, firmas (SHA-1) ya conocidas y, solo para archivos sospechosamente
+   pequeños, una decodificación para medir la desviación estándar.
+"""
+from pathlib import Path
+from typing import Callable, Optional, Set, Tuple
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import requests
+import urllib3
+
+try:
+    from PIL import Image, ImageStat
+except ImportError:  # sin Pillow, un archivo sospechosamente pequeño se trata como vacío
+    Image = None
+
+DOWNLOAD_CHUNK = 256 * 1024
+RESUME_ATTEMPTS = 2          # reanudaciones por corte de conexión dentro de una llamada
+MIN_BYTES_PER_MPX = 40_000   # JPEG uniforme de 800x600: ~4-8 KB; imágenes reales: 50 KB o más
+BLANK_STD = 2.0              # desviación estándar por debajo de la cual la imagen es "sin datos"
+_IMAGE_MAGIC = (b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"II*\x00", b"MM\x00*")
+
+class DownloadCancelled(Exception):
+    """Se lanza dentro de una descarga cuando otro worker ya obtuvo imagen."""
+
+class _Truncated(Exception):
+    """La respuesta terminó antes de Content-Length."""
+
+class BlankDetector:
+    """
+    Decide si una imagen descargada es "sin datos". Las firmas de imágenes
+    vacías se recuerdan (en memoria y, si se da path, en un archivo de texto).
+    """
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.known: Set[str] = set()
+        if path is not None and path.exists():
+            self.known = {line.strip() for line in path.read_text(encoding="utf-8").splitlines() if line.strip()}
+
+    def _remember(self, digest: str):
+        with self._lock:
+            if digest in self.known:
+                return
+            self.known.add(digest)
+            if self.path is not None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with self.path.open("a", encoding="utf-8") as f:
+                    f.write(digest + "\n")
+
+    def is_blank(self, path: Path, digest: str, pixels: int, content_type: str = "") -> bool:
+        with path.open("rb") as f:
+            head = f.read(16)
+        if "xml" in content_type.lower() or "html" in content_type.lower() or not head.startswith(_IMAGE_MAGIC):
+            return True
+        if digest in self.known:
+            return True
+        if path.stat().st_size >= MIN_BYTES_PER_MPX * pixels / 1e6:
+            return False  # camino barato: una imagen con contenido real no es tan compresible
+        blank = True
+        if Image is not None:
+            try:
+                with Image.open(path) as im:
+                    if im.mode in ("RGBA", "LA") or "transparency" in im.info:
+                        if im.convert("RGBA").getchannel("A").getextrema()[1] == 0:
+                            self._remember(digest)
+                            return True
+                    gray = im.convert("L").resize((64, 64))
+                    blank = ImageStat.Stat(gray).stddev[0] < BLANK_STD
+            except Exception:
+                blank = True
+        if blank:
+            self._remember(digest)
+        return blank
+
+def _sidecar(part: Path) -> Path:
+    return part.with_name(part.name + ".json")
+
+def _cleanup(part: Path):
+    for p in (part, _sidecar(part)):
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.debug(f"No se pudo borrar {p}: {e}")
+
+def _hash_existing(part: Path, h):
+    with part.open("rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK), b""):
+            h.update(block)
+
+def stream_download(session: requests.Session, url: str, params: Optional[dict], dest: Path, part: Path,
+                    timeout: float, cancel: Optional[threading.Event] = None,
+                    validate: Optional[Callable[[Path, str, str], bool]] = None) -> Optional[Tuple[str, str]]:
+    """
+    Descarga url a dest pasando por part (reanudable). Retorna (sha1, url final)
+    o None si validate(part, sha1, content_type) rechaza el contenido.
+    Errores HTTP se propagan como requests.HTTPError; la cancelación como DownloadCancelled.
+    """
+    part.parent.mkdir(parents=True, exist_ok=True)
+    buf = bytearray(DOWNLOAD_CHUNK)
+    view = memoryview(buf)
+    for _ in range(RESUME_ATTEMPTS + 1):
+        offset = part.stat().st_size if part.exists() else 0
+        validator = None
+        if offset and _sidecar(part).exists():
+            validator = json.loads(_sidecar(part).read_text(encoding="utf-8")).get("validator")
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator} if offset and validator else {}
+        r = session.get(url, params=params, headers=headers, timeout=timeout, stream=True)
+        try:
+            if r.status_code == 206 and r.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+                mode = "ab"
+            elif r.status_code == 200:
+                mode, offset = "wb", 0
+            elif r.status_code in (206, 416):
+                _cleanup(part)   # el .part no corresponde a la versión actual
+                continue
+            else:
+                r.raise_for_status()
+                raise requests.HTTPError(f"HTTP {r.status_code} inesperado", response=r)
+            new_validator = r.headers.get("ETag") or r.headers.get("Last-Modified")
+            if new_validator:
+                _sidecar(part).write_text(json.dumps({"validator": new_validator}), encoding="utf-8")
+            expected = r.headers.get("Content-Length")
+            if r.headers.get("Content-Encoding", "identity") != "identity":
+                expected = None   # Content-Length cuenta bytes comprimidos
+            expected = offset + int(expected) if expected and expected.isdigit() else None
+            h = hashlib.sha1()
+            if mode == "ab":
+                _hash_existing(part, h)
+            r.raw.decode_content = True
+            with part.open(mode) as fd:
+                try:
+                    while True:
+                        if cancel is not None and cancel.is_set():
+                            raise DownloadCancelled()
+                        n = r.raw.readinto(buf)
+                        if not n:
+                            break
+                        fd.write(view[:n])
+                        h.update(view[:n])
+                    if expected is not None and fd.tell() != expected:
+                        raise _Truncated()
+                finally:
+                    fd.flush()
+                    os.fsync(fd.fileno())
+        except DownloadCancelled:
+            _cleanup(part)
+            raise
+        except (_Truncated, urllib3.exceptions.HTTPError, requests.ConnectionError, ConnectionError) as e:
+            logging.debug(f"Transferencia interrumpida ({type(e).__name__}); reanudando desde {part.stat().st_size if part.exists() else 0} bytes")
+            continue
+        finally:
+            r.close()
+        digest = h.hexdigest()
+        if validate is not None and not validate(part, digest, r.headers.get("Content-Type", "")):
+            _cleanup(part)
+            return None
+        os.replace(part, dest)
+        _cleanup(part)
+        return digest, r.url
+    raise requests.ConnectionError(f"Descarga incompleta tras {RESUME_ATTEMPTS + 1} intentos: {url}")
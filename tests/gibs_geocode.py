@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# gibs_geocode.py
+"""
+Caché y geocodificador por lotes para los lugares de --places.
+ - Caché persistente en SQLite (lugar normalizado -> bbox + timestamp), cargada
+   en memoria al abrir: un acierto es un lookup de diccionario.
+ - Los fallos de caché pasan por un token bucket (Nominatim permite ~1 req/s).
+ - El lote corre en un hilo aparte, en paralelo con la descarga de GetCapabilities.
+ - Sin red (o sin resultados) se usa el gazetteer local gazetteer.csv
+   (bboxes aproximadas de países/ciudades frecuentes).
+"""
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+import csv
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+
+DEFAULT_RATE = 1.0          # solicitudes por segundo (política de Nominatim)
+DEFAULT_TTL_DAYS = 30.0     # vigencia de un bbox en caché
+MISS_TTL = 24 * 3600        # un "sin resultados" se recuerda un día
+GAZETTEER_PATH = Path(__file__).resolve().parent / "gazetteer.csv"
+
+def normalize_place(place: str) -> str:
+    """Clave canónica: sin acentos, minúsculas y espacios colapsados."""
+    t = unicodedata.normalize("NFKD", place)
+    t = "".join(c for c in t if not unicodedata.combining(c))
+    return " ".join(t.casefold().split())
+
+class TokenBucket:
+    """Limitador token bucket seguro entre hilos: acquire() bloquea hasta tener ficha."""
+    def __init__(self, rate: float = DEFAULT_RATE, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class GeocodeCache:
+    """Caché persistente de geocodificación (bbox None = lugar sin resultados)."""
+    def __init__(self, path: Path, ttl_days: float = DEFAULT_TTL_DAYS):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl_days * 86400
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocode (
+                key TEXT PRIMARY KEY,
+                place TEXT,
+                minlon REAL, minlat REAL, maxlon REAL, maxlat REAL,
+                ts REAL NOT NULL
+            )""")
+        self._mem: Dict[str, tuple] = {}
+        for key, a, b, c, d, ts in self.conn.execute(
+                "SELECT key, minlon, minlat, maxlon, maxlat, ts FROM geocode"):
+            self._mem[key] = (None if a is None else [a, b, c, d], ts)
+
+    def get(self, place: str) -> tuple:
+        """
+        Retorna (encontrado, bbox). encontrado=False si no hay entrada vigente;
+        (True, None) significa que el lugar se consultó y no tuvo resultados.
+        """
+        hit = self._mem.get(normalize_place(place))
+        if hit is None:
+            return False, None
+        bbox, ts = hit
+        ttl = self.ttl if bbox is not None else MISS_TTL
+        if time.time() - ts > ttl:
+            return False, None
+        return True, bbox
+
+    def put(self, place: str, bbox: Optional[List[float]]):
+        key = normalize_place(place)
+        now = time.time()
+        vals = bbox if bbox is not None else [None] * 4
+        with self._lock:
+            self._mem[key] = (bbox, now)
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO geocode (key, place, minlon, minlat, maxlon, maxlat, ts) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", (key, place, *vals, now))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+def load_gazetteer(path: Path = GAZETTEER_PATH) -> Dict[str, List[float]]:
+    """Lee gazetteer.csv (place,minlon,minlat,maxlon,maxlat) indexado por nombre normalizado."""
+    table: Dict[str, List[float]] = {}
+    if not path.exists():
+        return table
+    with path.open(newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            try:
+                table[normalize_place(row['place'])] = [float(row['minlon']), float(row['minlat']),
+                                                        float(row['maxlon']), float(row['maxlat'])]
+            except (KeyError, TypeError, ValueError):
+                continue
+    return table
+
+class BatchGeocoder:
+    """
+    Resuelve una lista de lugares: caché -> geocodificador en vivo (limitado) -> gazetteer.
+    - geocode_fn: función lugar -> bbox o None si no hay resultados;
+      debe lanzar excepción en errores de red para no cachearlos
+    - offline: no consulta la red, solo caché y gazetteer
+    """
+    def __init__(self, geocode_fn: Callable[[str], Optional[List[float]]],
+                 cache: Optional[GeocodeCache] = None,
+                 bucket: Optional[TokenBucket] = None,
+                 gazetteer: Optional[Dict[str, List[float]]] = None,
+                 offline: bool = False):
+        self.geocode_fn = geocode_fn
+        self.cache = cache
+        self.bucket = bucket or TokenBucket()
+        self.gazetteer = load_gazetteer() if gazetteer is None else gazetteer
+        self.offline = offline
+
+    def resolve_one(self, place: str) -> Optional[List[float]]:
+        if self.cache is not None:
+            found, bbox = self.cache.get(place)
+            if found:
+                logging.debug(f"Geocode desde caché: '{place}' -> {bbox}")
+                return bbox or self.gazetteer.get(normalize_place(place))
+        bbox = None
+        if not self.offline:
+            self.bucket.acquire()
+            try:
+                bbox = self.geocode_fn(place)
+                if self.cache is not None:
+                    self.cache.put(place, bbox)
+            except Exception as e:
+                # Error de red: no se cachea, se intenta con el gazetteer
+                logging.warning(f"Error geocodificando '{place}': {e}")
+        if bbox is None:
+            bbox = self.gazetteer.get(normalize_place(place))
+            if bbox is not None:
+                logging.info(f"'{place}' resuelto con el gazetteer local")
+        return bbox
+
+    def resolve(self, places: List[str]) -> Dict[str, Optional[List[float]]]:
+        """Resuelve todos los lugares en orden (los fallos de caché respetan el rate limit)."""
+        return {place: self.resolve_one(place) for place in places}
+
+    def resolve_async(self, places: List[str]) -> Future:
+        """Lanza resolve() en un hilo de fondo y devuelve un Future con el dict resultado."""
+        fut: Future = Future()
+
+        def run():
+            try:
+                fut.set_result(self.resolve(places))
+            except BaseException as e:
+                fut.set_exception(e)
+        threading.Thread(target=run, name="geocoder", daemon=True).start()
+        return fut
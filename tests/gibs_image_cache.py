@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# gibs_image_cache.py
+"""
+Caché de imágenes GIBS direccionada por contenido de la solicitud.
+ - Clave: SHA-256 de la URL base + parámetros canónicos (orden y mayúsculas normalizados).
+ - Blobs en objects/ab/<clave>; índice SQLite que sobrevive reinicios.
+ - Límite por bytes y por número de entradas con desalojo LRU.
+ - Solicitudes TIME=latest caducan tras un TTL corto; las fechadas son inmutables.
+ - En un acierto el archivo se entrega con reflink o hardlink (copia solo como último recurso).
+"""
+from pathlib import Path
+from typing import Dict, Optional
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin reflink, se usa hardlink/copia
+    fcntl = None
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_LATEST_TTL = 900  # segundos
+_FICLONE = 0x40049409     # ioctl de Linux para reflink (btrfs, XFS, ...)
+
+def cache_key(base_url: str, params: Dict) -> str:
+    """Hash canónico de una solicitud (base + parámetros ordenados, claves en minúsculas)."""
+    canon = sorted((str(k).lower(), str(v)) for k, v in params.items())
+    blob = json.dumps([base_url, canon], separators=(',', ':'), ensure_ascii=True)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+def _reflink(src: Path, dst: Path) -> bool:
+    """Intenta clonar src en dst con FICLONE; False si el FS no lo soporta."""
+    if fcntl is None:
+        return False
+    try:
+        with src.open('rb') as fs, dst.open('wb') as fd:
+            fcntl.ioctl(fd.fileno(), _FICLONE, fs.fileno())
+        return True
+    except OSError:
+        if dst.exists():
+            dst.unlink()
+        return False
+
+def link_or_copy(src: Path, dst: Path):
+    """
+    Coloca src en dst sin duplicar bytes cuando se puede:
+    reflink -> hardlink -> copia. dst se reemplaza de forma atómica.
+    Si dst ya es un hardlink de src (acierto en caché caliente) no se toca.
+    """
+    try:
+        if os.path.samefile(src, dst):
+            return
+    except OSError:
+        pass   # dst aún no existe
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.{threading.get_ident()}.lnk")
+    if tmp.exists():
+        tmp.unlink()
+    if not _reflink(src, tmp):
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    if tmp.exists():
+        # rename(2) entre dos nombres del mismo inodo no hace nada y deja tmp
+        tmp.unlink()
+
+class ImageCache:
+    """
+    Caché LRU persistente de imágenes. Segura entre hilos (un lock por instancia),
+    de modo que el barrido concurrente puede compartirla.
+    """
+    def __init__(self, root: Path, max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, latest_ttl: float = DEFAULT_LATEST_TTL):
+        self.root = root
+        self.objects = root / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.latest_ttl = latest_ttl
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(root / "index.sqlite"), check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                expires_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access);
+        """)
+        row = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        self._count, self._bytes = row
+        self.hits = 0
+        self.misses = 0
+
+    def _blob(self, key: str) -> Path:
+        return self.objects / key[:2] / key
+
+    def get(self, key: str) -> Optional[Path]:
+        """Ruta del blob si hay entrada vigente; actualiza su posición LRU."""
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute("SELECT expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            blob = self._blob(key)
+            if row is None or (row[0] is not None and row[0] < now) or not blob.exists():
+                if row is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return blob
+
+    def fetch(self, key: str, dest: Path) -> bool:
+        """Si hay acierto, deja el blob en dest (reflink/hardlink) y retorna True."""
+        blob = self.get(key)
+        if blob is None:
+            return False
+        try:
+            link_or_copy(blob, dest)
+        except OSError as e:
+            logging.debug(f"Caché: no se pudo entregar {key[:12]}: {e}")
+            return False
+        return True
+
+    def put(self, key: str, src: Path, latest: bool = False):
+        """
+        Registra src bajo la clave (sin copiar bytes si el FS lo permite) y
+        desaloja por LRU hasta cumplir los límites.
+        """
+        blob = self._blob(key)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        link_or_copy(src, blob)
+        size = blob.stat().st_size
+        now = time.time()
+        expires = now + self.latest_ttl if latest else None
+        with self._lock:
+            old = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, size, created_at, last_access, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?)", (key, size, now, now, expires))
+            if old is not None:
+                self._bytes -= old[0]
+                self._count -= 1
+            self._bytes += size
+            self._count += 1
+            self._evict()
+
+    def _drop(self, key: str):
+        """Elimina una entrada y su blob (llamar con el lock tomado)."""
+        row = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        with self.conn:
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        if row is not None:
+            self._bytes -= row[0]
+            self._count -= 1
+        try:
+            self._blob(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        """Desaloja las entradas menos usadas mientras se excedan los límites."""
+        if self._bytes <= self.max_bytes and self._count <= self.max_entries:
+            return
+        cur = self.conn.execute("SELECT key, size FROM entries ORDER BY last_access")
+        victims = []
+        projected_bytes, projected_count = self._bytes, self._count
+        for key, size in cur:
+            if projected_bytes <= self.max_bytes and projected_count <= self.max_entries:
+                break
+            victims.append(key)
+            projected_bytes -= size
+            projected_count -= 1
+        for key in victims:
+            self._drop(key)
+        logging.debug(f"Caché: {len(victims)} entradas desalojadas "
+                      f"({self._count} entradas, {self._bytes / 1e6:.1f} MB)")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
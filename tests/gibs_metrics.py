@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# gibs_metrics.py
+"""
+Métricas y traza por solicitud para las sesiones HTTP de create_session.
+Por cada solicitud se registra host, layer, TIME, status, reintentos de
+urllib3 (Retry.history), tiempo hasta la cabecera (TTFB, incluye las esperas
+de backoff), tiempo total (hasta cerrar el cuerpo, también en stream=True) y bytes.
+ - export_prometheus: archivo de texto para el textfile collector de node_exporter
+   (histogramas por host y contadores por host/status/layer)
+ - export_json: resumen con percentiles por host y bytes por capa
+ - trace_path: una línea JSON por solicitud, escrita al terminar cada una
+"""
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+import bisect
+import json
+import os
+import threading
+import time
+
+import requests
+
+# Cubetas (segundos) pensadas para REQUEST_TIMEOUT de 5 s y backoff de 0.8 s
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+def request_labels(url: str) -> Tuple[str, Optional[str], Optional[str]]:
+    """(host, layer, TIME) de una URL de image-download, WMS o tesela WMTS REST."""
+    parts = urlsplit(url)
+    query = {k.lower(): v[0] for k, v in parse_qs(parts.query).items()}
+    layer = query.get("layers") or query.get("layer")
+    time_param = query.get("time")
+    if layer is None:
+        # Teselas REST: .../{layer}/default/{Time}/{TileMatrixSet}/{z}/{y}/{x}.jpg
+        segs = [s for s in parts.path.split("/") if s]
+        if "default" in segs:
+            k = segs.index("default")
+            layer = segs[k - 1] if k > 0 else None
+            time_param = segs[k + 1] if k + 1 < len(segs) else None
+    return parts.netloc, layer, time_param
+
+class _Histogram:
+    __slots__ = ("counts", "total", "n", "samples")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.n = 0
+        self.samples: List[float] = []
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(BUCKETS, v)] += 1
+        self.total += v
+        self.n += 1
+        self.samples.append(v)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        s = sorted(self.samples)
+        return s[min(len(s) - 1, int(round(q * (len(s) - 1))))]
+
+class RequestMetrics:
+    """Colector seguro entre hilos; opcionalmente escribe una traza JSONL."""
+    def __init__(self, trace_path: Optional[Path] = None):
+        self._lock = threading.Lock()
+        self.records: List[Dict] = []
+        self._trace = None
+        if trace_path is not None:
+            trace_path.parent.mkdir(parents=True, exist_ok=True)
+            self._trace = trace_path.open("a", encoding="utf-8")
+
+    def record(self, rec: Dict):
+        with self._lock:
+            self.records.append(rec)
+            if self._trace is not None:
+                self._trace.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                self._trace.flush()
+
+    # ---- agregación ----
+    def _aggregate(self):
+        with self._lock:
+            records = list(self.records)
+        hosts: Dict[str, Dict] = {}
+        layers: Dict[str, Dict] = {}
+        for r in records:
+            h = hosts.setdefault(r["host"], {"status": {}, "retries": 0, "bytes": 0,
+                                             "ttfb": _Histogram(), "total": _Histogram()})
+            key = str(r["status"] if r["status"] is not None else r.get("error") or "error")
+            h["status"][key] = h["status"].get(key, 0) + 1
+            h["retries"] += r["retries"]
+            h["bytes"] += r["bytes"]
+            if r["ttfb_s"] is not None:
+                h["ttfb"].observe(r["ttfb_s"])
+            h["total"].observe(r["total_s"])
+            if r.get("layer"):
+                lay = layers.setdefault(r["layer"], {"requests": 0, "bytes": 0, "seconds": 0.0})
+                lay["requests"] += 1
+                lay["bytes"] += r["bytes"]
+                lay["seconds"] += r["total_s"]
+        return hosts, layers
+
+    def summary(self) -> Dict:
+        hosts, layers = self._aggregate()
+        out = {"hosts": {}, "layers": layers}
+        for host, h in hosts.items():
+            n = h["total"].n
+            out["hosts"][host] = {
+                "requests": n,
+                "status": h["status"],
+                "retries": h["retries"],
+                "bytes": h["bytes"],
+                "ttfb_s": {f"p{int(q * 100)}": h["ttfb"].percentile(q) for q in (0.5, 0.95, 0.99)},
+                "total_s": {f"p{int(q * 100)}": h["total"].percentile(q) for q in (0.5, 0.95, 0.99)},
+                # tiempo esperando cabeceras vs. transfiriendo el cuerpo
+                "wait_s": h["ttfb"].total,
+                "transfer_s": max(0.0, h["total"].total - h["ttfb"].total),
+            }
+        return out
+
+    def export_json(self, path: Path):
+        _atomic_write(path, json.dumps(self.summary(), indent=2, ensure_ascii=False))
+
+    def export_prometheus(self, path: Path):
+        hosts, layers = self._aggregate()
+        lines = []
+
+        def esc(v) -> str:
+            return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines += ["# HELP gibs_http_requests_total Solicitudes HTTP por host y status.",
+                  "# TYPE gibs_http_requests_total counter"]
+        for host, h in hosts.items():
+            for status, n in sorted(h["status"].items()):
+                lines.append(f'gibs_http_requests_total{{host="{esc(host)}",status="{esc(status)}"}} {n}')
+        lines += ["# HELP gibs_http_retries_total Reintentos de urllib3 por host.",
+                  "# TYPE gibs_http_retries_total counter"]
+        lines += [f'gibs_http_retries_total{{host="{esc(host)}"}} {h["retries"]}' for host, h in hosts.items()]
+        lines += ["# HELP gibs_http_response_bytes_total Bytes de cuerpo recibidos por host.",
+                  "# TYPE gibs_http_response_bytes_total counter"]
+        lines += [f'gibs_http_response_bytes_total{{host="{esc(host)}"}} {h["bytes"]}' for host, h in hosts.items()]
+        lines += ["# HELP gibs_layer_bytes_total Bytes recibidos por capa.",
+                  "# TYPE gibs_layer_bytes_total counter"]
+        lines += [f'gibs_layer_bytes_total{{layer="{esc(layer)}"}} {v["bytes"]}' for layer, v in sorted(layers.items())]
+        for name, key, help_text in (("gibs_http_ttfb_seconds", "ttfb", "Tiempo hasta la cabecera (incluye backoff)."),
+                                     ("gibs_http_request_duration_seconds", "total", "Tiempo total de la solicitud.")):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for host, h in hosts.items():
+                hist = h[key]
+                cum = 0
+                for bound, c in zip(BUCKETS, hist.counts):
+                    cum += c
+                    lines.append(f'{name}_bucket{{host="{esc(host)}",le="{bound}"}} {cum}')
+                lines.append(f'{name}_bucket{{host="{esc(host)}",le="+Inf"}} {hist.n}')
+                lines.append(f'{name}_sum{{host="{esc(host)}"}} {hist.total:.6f}')
+                lines.append(f'{name}_count{{host="{esc(host)}"}} {hist.n}')
+        _atomic_write(path, "\n".join(lines) + "\n")
+
+    def export(self, path: Path):
+        """Exporta según la extensión: .json = resumen JSON; otra (.prom) = Prometheus."""
+        if path.suffix.lower() == ".json":
+            self.export_json(path)
+        else:
+            self.export_prometheus(path)
+
+    def close(self):
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+def _atomic_write(path: Path, text: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+class _CountingRaw:
+    """
+    Envuelve response.raw (urllib3) para contar bytes del cuerpo y registrar
+    la solicitud cuando se termina de leer o se cierra. Los atributos que no
+    son propios (p. ej. decode_content) se leen y escriben en el raw real.
+    """
+    _OWN = ("_raw", "_finish", "bytes")
+
+    def __init__(self, raw, finish):
+        object.__setattr__(self, "_raw", raw)
+        object.__setattr__(self, "_finish", finish)
+        object.__setattr__(self, "bytes", 0)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        if name in self._OWN:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._raw, name, value)
+
+    def read(self, *args, **kwargs):
+        data = self._raw.read(*args, **kwargs)
+        self.bytes += len(data)
+        if not data:
+            self._finish(self.bytes)
+        return data
+
+    def readinto(self, b):
+        n = self._raw.readinto(b)
+        self.bytes += n or 0
+        if not n:
+            self._finish(self.bytes)
+        return n
+
+    def stream(self, *args, **kwargs):
+        for chunk in self._raw.stream(*args, **kwargs):
+            self.bytes += len(chunk)
+            yield chunk
+        self._finish(self.bytes)
+
+    def close(self):
+        self._finish(self.bytes)
+        return self._raw.close()
+
+    def release_conn(self):
+        self._finish(self.bytes)
+        return self._raw.release_conn()
+
+def instrument_session(session: requests.Session, metrics: Optional[RequestMetrics]) -> requests.Session:
+    """
+    Envuelve session.send para registrar cada solicitud en metrics. Un colector
+    nuevo reemplaza al envoltorio anterior (no se apilan); None lo quita.
+    """
+    if getattr(session, "_gibs_metrics", None) is metrics:
+        return session
+    if "_gibs_metrics" in session.__dict__:
+        # Quitar el envoltorio anterior: vuelve el send de la clase (o el que hubiera antes)
+        previous = session.__dict__.pop("_gibs_previous_send")
+        del session._gibs_metrics
+        if previous is None:
+            del session.send
+        else:
+            session.send = previous
+    if metrics is None:
+        return session
+    previous = session.__dict__.get("send")
+    original_send = session.send
+
+    def send(request, **kwargs):
+        host, layer, time_param = request_labels(request.url)
+        base = {"ts": time.time(), "host": host, "layer": layer, "time": time_param, "method": request.method}
+        t0 = time.perf_counter()
+        try:
+            response = original_send(request, **kwargs)
+        except Exception as e:
+            metrics.record({**base, "status": None, "error": type(e).__name__, "retries": 0,
+                            "ttfb_s": None, "total_s": time.perf_counter() - t0, "bytes": 0})
+            raise
+        ttfb = response.elapsed.total_seconds()
+        history = getattr(getattr(response.raw, "retries", None), "history", None) or ()
+        rec = {**base, "status": response.status_code, "error": None, "retries": len(history), "ttfb_s": ttfb}
+        done = []
+
+        def finish(nbytes: int):
+            if done:
+                return
+            done.append(True)
+            metrics.record({**rec, "total_s": time.perf_counter() - t0, "bytes": nbytes})
+
+        if kwargs.get("stream"):
+            response.raw = _CountingRaw(response.raw, finish)
+        else:
+            finish(len(response.content or b""))
+        return response
+
+    session._gibs_previous_send = previous
+    session.send = send
+    session._gibs_metrics = metrics
+    return session
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# gibs_tiles.py
+"""
+Motor alternativo de descarga GIBS por teselas WMTS.
+ - Lee los TileMatrixSets y las ResourceURL de GetCapabilities (getcap_raw.xml).
+ - Cada bbox se resuelve en las teselas que cubre al nivel de zoom adecuado.
+ - Solo se piden al servidor las teselas que no están en disco (en paralelo).
+ - El mosaico y el recorte al extent pedido se hacen localmente con NumPy/Pillow,
+   así bboxes solapadas y tamaños repetidos reutilizan las mismas teselas.
+Requiere numpy y Pillow.
+"""
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import requests
+from PIL import Image
+
+NS_WMTS = '{http://www.opengis.net/wmts/1.0}'
+NS_OWS = '{http://www.opengis.net/ows/1.1}'
+METERS_PER_DEGREE = 2 * math.pi * 6378137 / 360  # OGC: escala en EPSG:4326
+PIXEL_SIZE_M = 0.00028                            # OGC: 0.28 mm por pixel
+WORLD = (-180.0, -90.0, 180.0, 90.0)
+DEFAULT_TILE_WORKERS = 8
+DEFAULT_MUTABLE_TTL = 900  # segundos de vigencia de teselas TIME=default
+
+# -------------------- GRID (GetCapabilities) -------------
+def _matrix_record(tm: ET.Element) -> Dict:
+    """Convierte un wmts:TileMatrix en dict con esquina superior izquierda en lon/lat."""
+    a, b = (float(v) for v in tm.findtext(NS_WMTS + 'TopLeftCorner').split()[:2])
+    # WMTS en EPSG:4326 debería ser lat lon, pero GIBS publica lon lat
+    left, top = (b, a) if abs(b) > 90 else (a, b)
+    return {
+        'id': tm.findtext(NS_OWS + 'Identifier'),
+        'scale': float(tm.findtext(NS_WMTS + 'ScaleDenominator')),
+        'left': left,
+        'top': top,
+        'tw': int(tm.findtext(NS_WMTS + 'TileWidth')),
+        'th': int(tm.findtext(NS_WMTS + 'TileHeight')),
+        'mw': int(tm.findtext(NS_WMTS + 'MatrixWidth')),
+        'mh': int(tm.findtext(NS_WMTS + 'MatrixHeight')),
+    }
+
+def parse_tile_grid(source) -> Dict:
+    """
+    Parser incremental de la parte teselada de GetCapabilities.
+    Retorna {'matrix_sets': {id: [matrices...]}, 'layers': {id: {tms, template, format}}}.
+    """
+    grid = {'matrix_sets': {}, 'layers': {}}
+    stack: List[ET.Element] = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        parent = stack[-1] if stack else None
+        if elem.tag == NS_WMTS + 'Layer':
+            layer_id = elem.findtext(NS_OWS + 'Identifier')
+            tms = elem.findtext(NS_WMTS + 'TileMatrixSetLink/' + NS_WMTS + 'TileMatrixSet')
+            for res in elem.findall(NS_WMTS + 'ResourceURL'):
+                if res.get('resourceType') == 'tile' and layer_id and tms:
+                    grid['layers'][layer_id] = {
+                        'tms': tms.strip(),
+                        'template': res.get('template'),
+                        'format': res.get('format'),
+                    }
+                    break
+        elif (elem.tag == NS_WMTS + 'TileMatrixSet' and parent is not None
+              and parent.tag == NS_WMTS + 'Contents'):
+            tms_id = elem.findtext(NS_OWS + 'Identifier')
+            matrices = [_matrix_record(tm) for tm in elem.findall(NS_WMTS + 'TileMatrix')]
+            if tms_id and matrices:
+                grid['matrix_sets'][tms_id] = matrices
+        else:
+            continue
+        elem.clear()
+        if parent is not None:
+            parent.remove(elem)
+    return grid
+
+def load_tile_grid(xml_path: Path, cache_path: Path) -> Optional[Dict]:
+    """
+    Devuelve la grilla desde cache_path (JSON) si es más nueva que xml_path;
+    si no, parsea getcap_raw.xml y guarda el JSON. None si no hay XML.
+    """
+    if cache_path.exists() and (not xml_path.exists()
+                                or cache_path.stat().st_mtime >= xml_path.stat().st_mtime):
+        with cache_path.open(encoding="utf-8") as f:
+            return json.load(f)
+    if not xml_path.exists():
+        return None
+    with xml_path.open("rb") as f:
+        grid = parse_tile_grid(f)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(grid, f)
+    os.replace(tmp, cache_path)
+    logging.info(f"Grilla WMTS: {len(grid['layers'])} capas, {len(grid['matrix_sets'])} TileMatrixSets")
+    return grid
+
+def pixel_degrees(matrix: Dict) -> float:
+    """Tamaño de pixel en grados de una TileMatrix (EPSG:4326)."""
+    return matrix['scale'] * PIXEL_SIZE_M / METERS_PER_DEGREE
+
+def choose_matrix(matrices: List[Dict], bbox: List[float], width: int, height: int) -> Dict:
+    """
+    Nivel más grueso cuya resolución alcanza la pedida (menos teselas);
+    si ninguno alcanza, el más fino disponible.
+    """
+    need = min((bbox[2] - bbox[0]) / width, (bbox[3] - bbox[1]) / height)
+    ordered = sorted(matrices, key=pixel_degrees, reverse=True)
+    for m in ordered:
+        if pixel_degrees(m) <= need:
+            return m
+    return ordered[-1]
+
+def tile_range(matrix: Dict, bbox: List[float]) -> Tuple[int, int, int, int]:
+    """(col0, row0, col1, row1) inclusivos de las teselas que cubren la bbox."""
+    px = pixel_degrees(matrix)
+    span_x, span_y = matrix['tw'] * px, matrix['th'] * px
+    col0 = int(math.floor((bbox[0] - matrix['left']) / span_x))
+    col1 = int(math.ceil((bbox[2] - matrix['left']) / span_x)) - 1
+    row0 = int(math.floor((matrix['top'] - bbox[3]) / span_y))
+    row1 = int(math.ceil((matrix['top'] - bbox[1]) / span_y)) - 1
+    clamp = lambda v, hi: max(0, min(v, hi - 1))
+    return clamp(col0, matrix['mw']), clamp(row0, matrix['mh']), clamp(col1, matrix['mw']), clamp(row1, matrix['mh'])
+
+# -------------------- FETCH + MOSAIC ---------------------
+class TileFetcher:
+    """
+    Descarga teselas faltantes a un almacén en disco y compone mosaicos.
+    - slot: función url -> context manager para limitar concurrencia por host
+    Las teselas fechadas son inmutables; las de TIME=default caducan tras mutable_ttl.
+    """
+    def __init__(self, session: requests.Session, grid: Dict, store: Path,
+                 workers: int = DEFAULT_TILE_WORKERS, timeout: float = 5,
+                 slot: Optional[Callable] = None, mutable_ttl: float = DEFAULT_MUTABLE_TTL):
+        self.session = session
+        self.grid = grid
+        self.store = store
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.slot = slot or (lambda url: contextlib.nullcontext())
+        self.mutable_ttl = mutable_ttl
+        self._inflight: Dict[Path, threading.Event] = {}
+        self._lock = threading.Lock()
+        self.fetched = 0
+        self.reused = 0
+
+    def supports(self, layer_id: str) -> bool:
+        info = self.grid['layers'].get(layer_id)
+        return bool(info and info['tms'] in self.grid['matrix_sets'])
+
+    def _tile_path(self, layer_id: str, time_key: str, info: Dict, matrix: Dict, row: int, col: int) -> Path:
+        ext = 'png' if 'png' in (info.get('format') or '') else 'jpg'
+        safe = layer_id.replace('/', '_')
+        return self.store / safe / time_key / info['tms'] / matrix['id'] / str(row) / f"{col}.{ext}"
+
+    def _fresh(self, path: Path, mutable: bool) -> bool:
+        if not path.exists():
+            return False
+        return not mutable or time.time() - path.stat().st_mtime < self.mutable_ttl
+
+    def _fetch_tile(self, url: str, path: Path, mutable: bool,
+                    cancel: Optional[threading.Event]) -> Optional[Path]:
+        """
+        Trae una tesela si falta. Si otro hilo ya la está bajando, espera a ese
+        hilo en vez de repetir la solicitud. Retorna None si el servidor no tiene datos.
+        """
+        while True:
+            if self._fresh(path, mutable):
+                with self._lock:
+                    self.reused += 1
+                return path
+            with self._lock:
+                ev = self._inflight.get(path)
+                owner = ev is None
+                if owner:
+                    ev = self._inflight[path] = threading.Event()
+            if owner:
+                break
+            ev.wait()
+            if not path.exists():
+                return None
+        try:
+            if cancel is not None and cancel.is_set():
+                return None
+            with self.slot(url):
+                r = self.session.get(url, timeout=self.timeout)
+            if r.status_code != 200 or not r.content:
+                logging.debug(f"Tesela HTTP {r.status_code}: {url}")
+                return None
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.part")
+            tmp.write_bytes(r.content)
+            os.replace(tmp, path)
+            with self._lock:
+                self.fetched += 1
+            return path
+        except Exception as e:
+            logging.debug(f"Error en tesela {url}: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._inflight.pop(path, None)
+            ev.set()
+
+    def render(self, layer_id: str, time_param: str, bbox: List[float], size: Tuple[int, int],
+               dest: Path, cancel: Optional[threading.Event] = None,
+               validate: Optional[Callable[[Path, str, str], bool]] = None) -> bool:
+        """
+        Compone la bbox pedida a partir de teselas y la guarda como JPEG en dest.
+        Retorna False si la capa no es teselada, no se obtuvo ninguna tesela o
+        validate(tmp, sha1, content_type) rechaza el mosaico (p.ej. imagen sin datos).
+        """
+        info = self.grid['layers'].get(layer_id)
+        if not info or info['tms'] not in self.grid['matrix_sets']:
+            return False
+        width, height = size
+        box = [max(bbox[0], WORLD[0]), max(bbox[1], WORLD[1]),
+               min(bbox[2], WORLD[2]), min(bbox[3], WORLD[3])]
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return False
+        matrix = choose_matrix(self.grid['matrix_sets'][info['tms']], box, width, height)
+        col0, row0, col1, row1 = tile_range(matrix, box)
+        mutable = time_param in ("latest", "default")
+        time_key = "default" if mutable else time_param
+        tw, th = matrix['tw'], matrix['th']
+
+        jobs = []
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                url = (info['template']
+                       .replace('{Time}', time_key).replace('{TileMatrixSet}', info['tms'])
+                       .replace('{TileMatrix}', matrix['id']).replace('{TileRow}', str(row))
+                       .replace('{TileCol}', str(col)).replace('{Style}', 'default')
+                       .replace('{Layer}', layer_id))
+                jobs.append((row, col, url, self._tile_path(layer_id, time_key, info, matrix, row, col)))
+        logging.debug(f"{layer_id} {time_key}: {len(jobs)} teselas nivel {matrix['id']} ({info['tms']})")
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(jobs))) as pool:
+            paths = list(pool.map(lambda j: self._fetch_tile(j[2], j[3], mutable, cancel), jobs))
+        if cancel is not None and cancel.is_set():
+            return False
+        if not any(paths):
+            return False
+
+        # Mosaico: cada tesela se copia por slicing en su ventana del lienzo
+        canvas = np.zeros(((row1 - row0 + 1) * th, (col1 - col0 + 1) * tw, 3), dtype=np.uint8)
+        for (row, col, _, _), path in zip(jobs, paths):
+            if path is None:
+                continue
+            try:
+                with Image.open(path) as im:
+                    tile = np.asarray(im.convert('RGB'))
+            except Exception as e:
+                logging.debug(f"Tesela ilegible {path}: {e}")
+                continue
+            tile = tile[:th, :tw]
+            y, x = (row - row0) * th, (col - col0) * tw
+            canvas[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+
+        # Recorte exacto al extent y remuestreo al tamaño pedido
+        px = pixel_degrees(matrix)
+        origin_x = matrix['left'] + col0 * tw * px
+        origin_y = matrix['top'] - row0 * th * px
+        crop = ((box[0] - origin_x) / px, (origin_y - box[3]) / px,
+                (box[2] - origin_x) / px, (origin_y - box[1]) / px)
+        out = Image.fromarray(canvas).resize((width, height), Image.BILINEAR, box=crop)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f"{dest.name}.{os.getpid()}.{threading.get_ident()}.part")
+        out.save(tmp, format='JPEG', quality=90)
+        if validate is not None:
+            digest = hashlib.sha1(tmp.read_bytes()).hexdigest()
+            if not validate(tmp, digest, 'image/jpeg'):
+                tmp.unlink()
+                return False
+        os.replace(tmp, dest)
+        return True
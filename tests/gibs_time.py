@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# gibs_time.py
+"""
+Índice de disponibilidad temporal para capas GIBS.
+ - Se construye con los valores ISO 8601 de la dimensión TIME de GetCapabilities
+   (p.ej. "2000-02-24/2000-08-03/P1D,2000-08-05/2025-10-05/P1D").
+ - Los intervalos no se expanden: cada consulta resuelve el paso con aritmética.
+ - "¿Hay dato para la fecha D?" y "fecha disponible más cercana <= D" en O(log n).
+"""
+from bisect import bisect_right
+from datetime import datetime, date, timedelta
+from typing import Iterable, Iterator, List, Optional, Union
+import re
+
+_DURATION_RE = re.compile(
+    r'^P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+_TIME_FMTS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d", "%Y-%m", "%Y")
+_ONE_DAY = timedelta(days=1)
+_EPSILON = timedelta(microseconds=1)
+
+DateLike = Union[date, datetime]
+
+def parse_instant(token: str) -> Optional[datetime]:
+    """Convierte un instante ISO 8601 (con o sin hora/Z) a datetime naive UTC."""
+    token = token.strip().rstrip('Z')
+    if '.' in token:
+        token = token.split('.', 1)[0]
+    for f in _TIME_FMTS:
+        try:
+            return datetime.strptime(token, f)
+        except ValueError:
+            continue
+    return None
+
+def parse_duration(token: str) -> Optional[tuple]:
+    """
+    Interpreta un periodo ISO 8601 (P1D, PT1H, P1M, P8D, P1Y...).
+    Retorna (meses, timedelta) o None si no es válido / es nulo.
+    """
+    m = _DURATION_RE.match(token.strip().upper())
+    if not m:
+        return None
+    y, mo, w, d, h, mi, s = (int(g) if g else 0 for g in m.groups())
+    months = y * 12 + mo
+    delta = timedelta(weeks=w, days=d, hours=h, minutes=mi, seconds=s)
+    if months == 0 and delta == timedelta(0):
+        return None
+    return months, delta
+
+def _add_months(t: datetime, months: int) -> datetime:
+    """Suma meses respetando el fin de mes (31 ene + 1 mes = 28/29 feb)."""
+    y, m = divmod(t.month - 1 + months, 12)
+    y += t.year
+    m += 1
+    last = (date(y + m // 12, m % 12 + 1, 1) - _ONE_DAY).day
+    return t.replace(year=y, month=m, day=min(t.day, last))
+
+def _as_datetime(d: DateLike) -> datetime:
+    if isinstance(d, datetime):
+        return d.replace(tzinfo=None)
+    return datetime(d.year, d.month, d.day)
+
+class Interval:
+    """
+    Un intervalo start/end/period. Sin periodo representa un único instante.
+    """
+    __slots__ = ('start', 'end', 'months', 'delta', '_last')
+
+    def __init__(self, start: datetime, end: datetime, period: Optional[tuple] = None):
+        self.start = start
+        self.end = max(start, end)
+        self.months, self.delta = period if period else (0, None)
+        self._last = None
+        if self.delta is not None or self.months:
+            self._last = self.step(self.floor_index(self.end))
+
+    @property
+    def periodic(self) -> bool:
+        return self.months > 0 or self.delta is not None
+
+    def step(self, k: int) -> datetime:
+        """Instante k-ésimo del intervalo (k = 0 es start)."""
+        t = self.start
+        if self.months:
+            t = _add_months(t, k * self.months)
+        if self.delta:
+            t = t + k * self.delta
+        return t
+
+    def floor_index(self, t: datetime) -> int:
+        """Mayor k con step(k) <= t (t >= start)."""
+        if not self.months:
+            return (t - self.start) // self.delta
+        k = ((t.year - self.start.year) * 12 + t.month - self.start.month) // self.months
+        k = max(k, 0)
+        while k > 0 and self.step(k) > t:
+            k -= 1
+        while self.step(k + 1) <= t:
+            k += 1
+        return k
+
+    def floor(self, t: datetime) -> Optional[datetime]:
+        """Último instante disponible <= t dentro del intervalo, o None."""
+        if t < self.start:
+            return None
+        if t >= self.end:
+            return self._last if self.periodic else self.end
+        if not self.periodic:
+            return t
+        return self.step(self.floor_index(t))
+
+    def __repr__(self):
+        return f"Interval({self.start.isoformat()}, {self.end.isoformat()}, months={self.months}, delta={self.delta})"
+
+class TimeIndex:
+    """
+    Índice de disponibilidad de una capa. Intervalos ordenados por inicio;
+    las búsquedas usan bisect sobre los inicios (O(log n)).
+    """
+    def __init__(self, intervals: Iterable[Interval]):
+        self.intervals: List[Interval] = sorted(intervals, key=lambda iv: iv.start)
+        self._starts = [iv.start for iv in self.intervals]
+        self.subdaily = any(iv.start.time() != datetime.min.time() or
+                            (iv.delta is not None and not iv.months and iv.delta < _ONE_DAY)
+                            for iv in self.intervals)
+
+    @classmethod
+    def from_values(cls, values: Union[str, Iterable[str], None]) -> Optional["TimeIndex"]:
+        """
+        Construye el índice a partir de los <Value> de la dimensión TIME
+        (lista o texto separado por comas). Retorna None si no hay fechas válidas.
+        """
+        if not values:
+            return None
+        if isinstance(values, str):
+            values = values.split(',')
+        intervals = []
+        for raw in values:
+            for token in raw.split(','):
+                parts = [p.strip() for p in token.strip().split('/')]
+                if not parts[0]:
+                    continue
+                start = parse_instant(parts[0])
+                if start is None:
+                    continue
+                end = parse_instant(parts[1]) if len(parts) >= 2 else start
+                period = parse_duration(parts[2]) if len(parts) >= 3 else None
+                if period is None and end is not None and end != start:
+                    period = (0, _ONE_DAY)  # rango sin periodo: se asume diario
+                intervals.append(Interval(start, end or start, period))
+        return cls(intervals) if intervals else None
+
+    def __bool__(self):
+        return bool(self.intervals)
+
+    def floor(self, t: DateLike) -> Optional[datetime]:
+        """Instante disponible más reciente <= t (datetime) o None."""
+        t = _as_datetime(t)
+        i = bisect_right(self._starts, t) - 1
+        while i >= 0:
+            found = self.intervals[i].floor(t)
+            if found is not None:
+                return found
+            i -= 1
+        return None
+
+    def nearest_before(self, d: DateLike) -> Optional[datetime]:
+        """
+        Fecha disponible más cercana <= d. Si d es una fecha (sin hora)
+        cuenta cualquier instante de ese día.
+        """
+        if isinstance(d, datetime):
+            return self.floor(d)
+        return self.floor(_as_datetime(d) + _ONE_DAY - _EPSILON)
+
+    def contains(self, d: DateLike) -> bool:
+        """¿Hay dato en d? Para fechas sin hora basta un instante dentro del día."""
+        if isinstance(d, datetime):
+            return self.floor(d) == _as_datetime(d)
+        found = self.nearest_before(d)
+        return found is not None and found >= _as_datetime(d)
+
+    def latest(self) -> Optional[datetime]:
+        """Último instante disponible de la capa."""
+        if not self.intervals:
+            return None
+        return self.floor(max(iv.end for iv in self.intervals))
+
+    def iter_before(self, d: DateLike) -> Iterator[datetime]:
+        """Recorre hacia atrás los instantes disponibles <= d (expansión perezosa)."""
+        t = self.nearest_before(d)
+        while t is not None:
+            yield t
+            t = self.floor(t - _EPSILON)
+
+    def recent(self, n: int, before: DateLike) -> List[datetime]:
+        """Hasta n instantes disponibles <= before, del más reciente al más antiguo."""
+        out = []
+        for t in self.iter_before(before):
+            if len(out) >= n:
+                break
+            out.append(t)
+        return out
+
+    def time_param(self, t: datetime) -> str:
+        """Formato para el parámetro TIME: fecha si la capa es diaria, ISO con Z si no."""
+        if self.subdaily:
+            return t.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return t.strftime("%Y-%m-%d")
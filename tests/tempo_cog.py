@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# tempo_cog.py
+"""
+Exportación de granulos TEMPO L3 a Cloud-Optimized GeoTIFF (COG).
+ - Un archivo por paso de tiempo y por variable del grupo 'product'
+   ({variable}_{YYYYMMDDTHHMMSSZ}.tif), recortado opcionalmente a un bbox,
+   norte arriba, float32 con NaN como nodata (relleno y QA enmascarados).
+ - Teselado interno de BLOCKSIZE x BLOCKSIZE, compresión con predictor de punto
+   flotante y overviews internos (promedio) hasta que el nivel cabe en una tesela:
+   un visor pide solo los rangos de bytes de la zona y el zoom que muestra.
+ - Los archivos se generan en un pool de procesos (una tarea = granulo x paso x
+   variable); con varios workers cada proceso usa un solo hilo de GDAL.
+ - Cada archivo se escribe a un temporal, se valida como COG (rio-cogeo si está
+   instalado; si no, teselado, overviews internos y layout COG de GDAL) y recién
+   entonces toma su nombre final. Los COG válidos ya existentes se saltan si
+   sus etiquetas (fuente, bbox, qa_max) coinciden con la exportación pedida.
+Requiere rasterio (driver COG con GDAL >= 3.1; antes, GTiff con COPY_SRC_OVERVIEWS).
+
+Uso:
+  python tempo_cog.py data_tempo/*.nc --out data_tempo/cog --bbox -93 8 -87 19 --workers 8
+  python tempo_cog.py --data-dir data_tempo --vars vertical_column_troposphere,main_data_quality_flag
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from tempo_grid import NO2_VAR, QA_VAR, RegularGrid, mask_fill, open_product
+
+DEFAULT_VARS = (NO2_VAR,)
+BLOCKSIZE = 512
+DEFAULT_COMPRESS = "DEFLATE"   # ZSTD si el GDAL instalado lo trae
+
+def cog_name(variable: str, time_iso: Optional[str]) -> str:
+    stamp = time_iso.replace("-", "").replace(":", "") if time_iso else "notime"
+    return f"{variable}_{stamp}.tif"
+
+def overview_levels(width: int, height: int, blocksize: int = BLOCKSIZE) -> List[int]:
+    """Factores 2, 4, 8... hasta que el nivel más chico cabe en una tesela."""
+    levels, f = [], 2
+    while max(width, height) / (f // 2) > blocksize:
+        levels.append(f)
+        f *= 2
+    return levels
+
+def plan_exports(nc_paths: Iterable[Path], variables: Sequence[str]) -> List[Tuple[str, int, str, Optional[str]]]:
+    """(granulo, índice de tiempo, variable, instante ISO) de cada archivo a escribir."""
+    import xarray as xr
+    tasks = []
+    for nc in sorted(nc_paths):
+        with xr.open_dataset(nc) as root:
+            times = np.atleast_1d(root["time"].values) if "time" in root.variables else [None]
+        for k, t in enumerate(times):
+            iso = f"{np.datetime64(t, 's')}Z" if t is not None else None
+            tasks.extend((str(nc), k, v, iso) for v in variables)
+    return tasks
+
+def read_field(nc: Path, t_index: int, variable: str, bbox=None,
+               qa_max: Optional[int] = 0) -> Tuple[np.ndarray, RegularGrid]:
+    """Paso t_index de una variable (float32, NaN = sin dato) y su grilla, recortados a bbox."""
+    ds = open_product(nc)
+    try:
+        step = ds.isel(time=t_index) if "time" in ds.dims else ds
+        grid = RegularGrid.from_coords(step["latitude"].values, step["longitude"].values)
+        rows, cols = grid.window(bbox) if bbox is not None else (slice(None), slice(None))
+        values = mask_fill(step[variable].isel(latitude=rows, longitude=cols).values)
+        if qa_max is not None and variable != QA_VAR and QA_VAR in step:
+            qa = step[QA_VAR].isel(latitude=rows, longitude=cols).values
+            values[~(qa <= qa_max)] = np.nan
+        sub = RegularGrid.from_coords(step["latitude"].values[rows], step["longitude"].values[cols])
+        return values, sub
+    finally:
+        ds.close()
+
+def write_cog(values: np.ndarray, grid: RegularGrid, dest: Path, compress: str = DEFAULT_COMPRESS,
+              blocksize: int = BLOCKSIZE, tags: Optional[Dict] = None, num_threads: str = "1"):
+    """Escribe values (filas = latitud de la grilla) como COG norte arriba en dest."""
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.env import GDALVersion
+    from rasterio.io import MemoryFile
+    from rasterio.shutil import copy as rio_copy
+    from rasterio.transform import from_origin
+
+    if grid.dlat > 0:
+        values = values[::-1]   # TEMPO guarda la latitud ascendente
+    north = max(grid.lat0, grid.lat0 + (grid.nlat - 1) * grid.dlat) + abs(grid.dlat) / 2
+    west = grid.lon0 - grid.dlon / 2
+    height, width = values.shape
+    profile = {
+        "driver": "GTiff", "width": width, "height": height, "count": 1, "dtype": "float32",
+        "crs": "EPSG:4326", "transform": from_origin(west, north, grid.dlon, abs(grid.dlat)),
+        "nodata": np.nan, "tiled": True, "blockxsize": blocksize, "blockysize": blocksize,
+    }
+    with rasterio.Env(GDAL_NUM_THREADS=num_threads), MemoryFile() as mem:
+        with mem.open(**profile) as ds:
+            ds.write(np.ascontiguousarray(values, dtype=np.float32), 1)
+            ds.update_tags(**(tags or {}))
+            levels = overview_levels(width, height, blocksize)
+            if levels:
+                ds.build_overviews(levels, Resampling.average)
+                ds.update_tags(ns="rio_overview", resampling="average")
+        with mem.open() as src:
+            if GDALVersion.runtime().at_least("3.1"):
+                # PREDICTOR=YES = predictor de punto flotante para float32; AUTO reutiliza los overviews ya armados
+                rio_copy(src, str(dest), driver="COG", COMPRESS=compress, PREDICTOR="YES", BLOCKSIZE=str(blocksize),
+                         OVERVIEWS="AUTO", RESAMPLING="AVERAGE", NUM_THREADS=num_threads)
+            else:
+                rio_copy(src, str(dest), driver="GTiff", TILED="YES", BLOCKXSIZE=str(blocksize),
+                         BLOCKYSIZE=str(blocksize), COMPRESS=compress, PREDICTOR="3",
+                         COPY_SRC_OVERVIEWS="YES", NUM_THREADS=num_threads)
+
+def validate_cog(path: Path) -> List[str]:
+    """Errores que impiden tratar el archivo como COG (lista vacía = válido)."""
+    try:
+        from rio_cogeo.cogeo import cog_validate
+    except ImportError:
+        cog_validate = None
+    if cog_validate is not None:
+        _, errors, _ = cog_validate(str(path), quiet=True)
+        return list(errors)
+    import rasterio
+    errors = []
+    if path.with_name(path.name + ".ovr").exists():
+        errors.append("overviews externos (.ovr)")
+    with rasterio.open(path) as src:
+        if src.driver != "GTiff":
+            errors.append(f"driver {src.driver}, se esperaba GTiff")
+        block_h, block_w = src.block_shapes[0]
+        if not src.profile.get("tiled") and max(src.width, src.height) > block_w:
+            errors.append("sin teselado interno")
+        if max(src.width, src.height) > max(block_h, block_w) and not src.overviews(1):
+            errors.append("sin overviews internos")
+        if src.compression is None:
+            errors.append("sin compresión")
+        layout = src.tags(ns="IMAGE_STRUCTURE").get("LAYOUT")
+        if layout is not None and layout.upper() != "COG":
+            errors.append(f"layout {layout}, se esperaba COG")
+    return errors
+
+def export_tags(task: Dict) -> Dict[str, str]:
+    """Etiquetas GDAL de un COG: identifican la exportación (un cambio de bbox o QA obliga a reescribir)."""
+    return {
+        "variable": task["variable"],
+        "time": task["time"] or "",
+        "source": Path(task["nc"]).name,
+        "bbox": ",".join(f"{v:g}" for v in task["bbox"]) if task["bbox"] is not None else "",
+        "qa_max": "" if task["qa_max"] is None else str(task["qa_max"]),
+    }
+
+def tags_match(path: Path, tags: Dict[str, str]) -> bool:
+    import rasterio
+    with rasterio.open(path) as src:
+        stored = src.tags()
+    return all(stored.get(k) == v for k, v in tags.items())
+
+def export_one(task: Dict) -> Dict:
+    """Tarea del pool: escribe y valida un COG. Nunca lanza; el error va en el resultado."""
+    dest = Path(task["out_dir"]) / cog_name(task["variable"], task["time"])
+    result = {"path": str(dest), "nc": task["nc"], "variable": task["variable"], "time": task["time"]}
+    tags = export_tags(task)
+    if dest.exists() and not task["overwrite"]:
+        try:
+            if tags_match(dest, tags) and not validate_cog(dest):
+                return {**result, "status": "skipped"}
+        except Exception:
+            pass   # archivo ilegible: se reescribe
+    tmp = dest.with_name(f"{dest.stem}.{os.getpid()}.tmp.tif")
+    try:
+        values, grid = read_field(Path(task["nc"]), task["t_index"], task["variable"], task["bbox"], task["qa_max"])
+        write_cog(values, grid, tmp, task["compress"], task["blocksize"], tags, task["num_threads"])
+        errors = validate_cog(tmp)
+        if errors:
+            return {**result, "status": "invalid", "errors": errors}
+        os.replace(tmp, dest)
+        return {**result, "status": "ok", "bytes": dest.stat().st_size,
+                "valid_fraction": float(np.isfinite(values).mean()) if values.size else 0.0}
+    except Exception as e:
+        return {**result, "status": "error", "errors": [f"{type(e).__name__}: {e}"]}
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+def _mp_context():
+    """
+    fork donde exista: los workers solo necesitan este módulo y así no se
+    re-ejecuta el script que llama (earthAccess_manuel.py no tiene guarda __main__).
+    """
+    import multiprocessing as mp
+    return mp.get_context("fork") if "fork" in mp.get_all_start_methods() else None
+
+def export_cogs(nc_paths: Iterable[Path], out_dir: Path, variables: Sequence[str] = DEFAULT_VARS,
+                bbox=None, qa_max: Optional[int] = 0, workers: Optional[int] = None,
+                compress: str = DEFAULT_COMPRESS, blocksize: int = BLOCKSIZE,
+                overwrite: bool = False) -> List[Dict]:
+    """
+    Exporta cada paso de tiempo y variable de los granulos a out_dir como COG,
+    en paralelo. Retorna un dict por archivo con status ok/skipped/invalid/error.
+    """
+    import rasterio  # noqa: F401  (falla temprano si no está instalado)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    plan = plan_exports([Path(p) for p in nc_paths], variables)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(plan) or 1))
+    tasks = [{"nc": nc, "t_index": k, "variable": v, "time": iso, "out_dir": str(out_dir),
+              "bbox": tuple(bbox) if bbox is not None else None, "qa_max": qa_max, "compress": compress,
+              "blocksize": blocksize, "overwrite": overwrite,
+              "num_threads": "1" if workers > 1 else "ALL_CPUS"}
+             for nc, k, v, iso in plan]
+    logging.info(f"Exportando {len(tasks)} COG con {workers} procesos")
+    results = []
+    if workers == 1:
+        results = [export_one(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context()) as pool:
+            for fut in as_completed([pool.submit(export_one, t) for t in tasks]):
+                results.append(fut.result())
+    for r in sorted(results, key=lambda r: r["path"]):
+        if r["status"] in ("ok", "skipped"):
+            logging.info(f"[{r['status'].upper()}] {r['path']}")
+        else:
+            logging.error(f"[{r['status'].upper()}] {r['path']}: {'; '.join(r['errors'])}")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exporta granulos TEMPO a Cloud-Optimized GeoTIFF.")
+    parser.add_argument("paths", nargs="*", help="Granulos .nc (por defecto todos los de --data-dir)")
+    parser.add_argument("--data-dir", default="./data_tempo")
+    parser.add_argument("--out", default="", help="Carpeta de salida (por defecto data-dir/cog)")
+    parser.add_argument("--vars", default=",".join(DEFAULT_VARS), help="Variables del grupo product, separadas por comas")
+    parser.add_argument("--bbox", nargs=4, type=float, default=None, metavar=("MINLON", "MINLAT", "MAXLON", "MAXLAT"))
+    parser.add_argument("--qa-max", type=int, default=0, help="Máximo main_data_quality_flag (-1 = sin filtro)")
+    parser.add_argument("--workers", type=int, default=0, help="Procesos (0 = uno por CPU)")
+    parser.add_argument("--compress", default=DEFAULT_COMPRESS, help="DEFLATE, ZSTD, LZW...")
+    parser.add_argument("--blocksize", type=int, default=BLOCKSIZE)
+    parser.add_argument("--overwrite", action="store_true", help="Reescribir aunque ya exista un COG válido")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    data_dir = Path(args.data_dir)
+    out_dir = Path(args.out) if args.out else data_dir / "cog"
+    paths = [Path(p) for p in args.paths] or [p for p in data_dir.rglob("*.nc") if p.is_file()]
+    if not paths:
+        parser.error(f"no hay granulos .nc en {data_dir}")
+    try:
+        results = export_cogs(paths, out_dir, [v.strip() for v in args.vars.split(",") if v.strip()],
+                              args.bbox, None if args.qa_max < 0 else args.qa_max, args.workers or None,
+                              args.compress, args.blocksize, args.overwrite)
+    except ImportError as e:
+        parser.error(f"se necesita rasterio para escribir COG ({e})")
+    failed = [r for r in results if r["status"] not in ("ok", "skipped")]
+    logging.info(f"{len(results) - len(failed)} COG listos, {len(failed)} con errores en {out_dir}")
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# tempo_colocate.py
+"""
+Colocación por lotes de observaciones de estaciones (OpenAQ) con TEMPO NO2.
+Para cada observación (lat, lon, time) retorna:
+ - no2_nearest:  pixel más cercano del escaneo más cercano en el tiempo
+ - no2_bilinear: interpolación bilineal entre los 4 pixeles vecinos
+                 (los vecinos sin dato se excluyen y se renormalizan los pesos)
+ - scan_time, offset_s: instante del escaneo usado y diferencia en segundos
+Las observaciones se agrupan por escaneo: cada granulo se abre una sola vez y
+los valores se obtienen con un gather vectorizado sobre índices calculados por
+aritmética de grilla. Si la grilla no es regular se usa un KD-tree (scipy) con
+vecino más cercano e IDW de 4 vecinos en lugar de bilineal.
+
+Uso:
+  python tempo_colocate.py --stations estaciones.csv --data-dir ./data_tempo --out colocado.csv
+  (CSV con columnas lat, lon, time en ISO 8601 UTC; las demás se conservan)
+"""
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+import argparse
+import logging
+
+import numpy as np
+
+from tempo_grid import NO2_VAR, QA_VAR, RegularGrid, mask_fill, open_product
+
+DEFAULT_MAX_OFFSET = 3600   # segundos; más lejos que esto no se coloca
+
+def scan_index(nc_paths: Sequence[Path]) -> Tuple[np.ndarray, List[Tuple[Path, int]]]:
+    """Instantes de escaneo ordenados (datetime64[s]) y su (granulo, índice time)."""
+    import xarray as xr
+    entries = []
+    for nc in nc_paths:
+        with xr.open_dataset(nc) as root:
+            if "time" not in root.variables:
+                continue
+            for k, t in enumerate(np.atleast_1d(root["time"].values)):
+                entries.append((np.datetime64(t, "s"), nc, k))
+    entries.sort(key=lambda e: e[0])
+    times = np.array([e[0] for e in entries], dtype="datetime64[s]")
+    return times, [(e[1], e[2]) for e in entries]
+
+def nearest_scan(obs_times: np.ndarray, scan_times: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Para cada observación: índice del escaneo más cercano y offset en segundos (obs - scan)."""
+    obs = obs_times.astype("datetime64[s]").astype(np.int64)
+    scans = scan_times.astype(np.int64)
+    hi = np.clip(np.searchsorted(scans, obs), 1, max(1, scans.size - 1))
+    lo = hi - 1
+    if scans.size == 1:
+        k = np.zeros(obs.size, dtype=np.int64)
+    else:
+        k = np.where(np.abs(obs - scans[lo]) <= np.abs(scans[hi] - obs), lo, hi)
+    return k, obs - scans[k]
+
+def sample_regular(field: np.ndarray, grid: RegularGrid, lat: np.ndarray, lon: np.ndarray):
+    """Vecino más cercano y bilineal (NaN-aware) sobre una grilla regular."""
+    i, j, valid = grid.index(lat, lon)
+    nearest = np.where(valid, field[i, j], np.nan)
+
+    fi, fj = grid.fractional_index(lat, lon)
+    i0 = np.floor(fi).astype(np.int64)
+    j0 = np.floor(fj).astype(np.int64)
+    di, dj = fi - i0, fj - j0
+    num = np.zeros(lat.shape)
+    den = np.zeros(lat.shape)
+    for oi, oj, w in ((0, 0, (1 - di) * (1 - dj)), (0, 1, (1 - di) * dj),
+                      (1, 0, di * (1 - dj)), (1, 1, di * dj)):
+        ii, jj = i0 + oi, j0 + oj
+        inside = (ii >= 0) & (ii < grid.nlat) & (jj >= 0) & (jj < grid.nlon)
+        v = np.full(lat.shape, np.nan)
+        v[inside] = field[ii[inside], jj[inside]]
+        ok = np.isfinite(v)
+        num[ok] += w[ok] * v[ok]
+        den[ok] += w[ok]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bilinear = np.where(valid & (den > 0), num / den, np.nan)
+    return nearest, bilinear
+
+class IrregularSampler:
+    """Muestreo sobre coordenadas 2-D irregulares con KD-tree (construido una vez por grilla)."""
+    def __init__(self, lat2d: np.ndarray, lon2d: np.ndarray):
+        from scipy.spatial import cKDTree
+        self.shape = lat2d.shape
+        self.tree = cKDTree(np.column_stack([lat2d.ravel(), lon2d.ravel()]))
+        # distancia máxima aceptada: ~1 pixel típico
+        self.max_dist = float(np.nanmedian(np.abs(np.diff(lat2d, axis=0)))) * 1.5 or np.inf
+
+    def sample(self, field: np.ndarray, lat: np.ndarray, lon: np.ndarray):
+        flat = field.ravel()
+        d, idx = self.tree.query(np.column_stack([lat, lon]), k=4, distance_upper_bound=self.max_dist)
+        found = np.isfinite(d)
+        vals = np.full(d.shape, np.nan)
+        vals[found] = flat[idx[found]]
+        nearest = vals[:, 0]
+        w = np.where(found & np.isfinite(vals), 1.0 / np.maximum(d, 1e-12), 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            idw = np.where(w.sum(axis=1) > 0, np.nansum(w * np.nan_to_num(vals), axis=1) / w.sum(axis=1), np.nan)
+        return nearest, idw
+
+def load_field(nc: Path, t: int, variable: str, qa_max: Optional[int]):
+    """Campo 2-D enmascarado y sus coordenadas lat/lon para el paso t de un granulo."""
+    wanted = [variable] + ([QA_VAR] if qa_max is not None else [])
+    ds = open_product(nc, variables=wanted)
+    try:
+        step = ds.isel(time=t) if "time" in ds.dims else ds
+        field = mask_fill(step[variable].values)
+        if qa_max is not None and QA_VAR in step:
+            field[~(step[QA_VAR].values <= qa_max)] = np.nan
+        return field, ds["latitude"].values, ds["longitude"].values
+    finally:
+        ds.close()
+
+def colocate(lat, lon, times, nc_paths: Sequence[Path], variable: str = NO2_VAR,
+             qa_max: Optional[int] = 0, max_offset: Optional[float] = DEFAULT_MAX_OFFSET) -> Dict[str, np.ndarray]:
+    """Colocación vectorizada; retorna arrays alineados con las observaciones."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    times = np.asarray(times, dtype="datetime64[s]")
+    n = lat.size
+    out = {"no2_nearest": np.full(n, np.nan), "no2_bilinear": np.full(n, np.nan),
+           "scan_time": np.full(n, np.datetime64("NaT"), dtype="datetime64[s]"),
+           "offset_s": np.full(n, np.nan)}
+    scan_times, scans = scan_index(nc_paths)
+    if scan_times.size == 0 or n == 0:
+        return out
+    k, offset = nearest_scan(times, scan_times)
+    use = ~np.isnat(times)
+    if max_offset is not None:
+        use &= np.abs(offset) <= max_offset
+    out["scan_time"][use] = scan_times[k[use]]
+    out["offset_s"][use] = offset[use]
+
+    # Agrupar por escaneo: un solo orden y cortes contiguos
+    rows = np.flatnonzero(use)
+    order = rows[np.argsort(k[rows], kind="stable")]
+    ks = k[order]
+    cuts = np.flatnonzero(np.diff(ks)) + 1
+    samplers: Dict[tuple, object] = {}
+    for group in np.split(order, cuts):
+        if group.size == 0:
+            continue
+        nc, t = scans[k[group[0]]]
+        field, lat_c, lon_c = load_field(nc, t, variable, qa_max)
+        key = (lat_c.shape, float(lat_c.ravel()[0]), float(lon_c.ravel()[0]))
+        sampler = samplers.get(key)
+        if sampler is None:
+            try:
+                sampler = RegularGrid.from_coords(lat_c, lon_c)
+            except ValueError:
+                lat2d, lon2d = (lat_c, lon_c) if lat_c.ndim == 2 else np.meshgrid(lat_c, lon_c, indexing="ij")
+                sampler = IrregularSampler(lat2d, lon2d)
+            samplers[key] = sampler
+        if isinstance(sampler, RegularGrid):
+            near, interp = sample_regular(field, sampler, lat[group], lon[group])
+        else:
+            near, interp = sampler.sample(field, lat[group], lon[group])
+        out["no2_nearest"][group] = near
+        out["no2_bilinear"][group] = interp
+        logging.debug(f"{nc.name}[{t}]: {group.size} observaciones")
+    return out
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Colocación de estaciones con TEMPO NO2.")
+    parser.add_argument("--stations", required=True, help="CSV con lat, lon, time (ISO 8601 UTC)")
+    parser.add_argument("--data-dir", default="./data_tempo", help="Carpeta con granulos .nc")
+    parser.add_argument("--out", default="colocado.csv")
+    parser.add_argument("--var", default=NO2_VAR)
+    parser.add_argument("--qa-max", type=int, default=0, help="Máximo main_data_quality_flag (-1 = sin filtro)")
+    parser.add_argument("--max-offset", type=float, default=DEFAULT_MAX_OFFSET,
+                        help="Segundos máximos entre observación y escaneo (<=0 = sin límite)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    import pandas as pd
+    df = pd.read_csv(args.stations)
+    times = pd.to_datetime(df["time"], utc=True, errors="coerce").dt.tz_localize(None).to_numpy("datetime64[s]")
+    paths = sorted(p for p in Path(args.data_dir).rglob("*.nc") if p.is_file())
+    res = colocate(df["lat"].to_numpy(), df["lon"].to_numpy(), times, paths, args.var,
+                   None if args.qa_max < 0 else args.qa_max,
+                   None if args.max_offset <= 0 else args.max_offset)
+    for name, values in res.items():
+        df[name] = values
+    df.to_csv(args.out, index=False)
+    ok = int(np.isfinite(res["no2_nearest"]).sum())
+    logging.info(f"{ok}/{len(df)} observaciones colocadas -> {args.out}")
+
+if __name__ == "__main__":
+    main()
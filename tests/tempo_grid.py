@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# tempo_grid.py
+"""
+Utilidades comunes para granulos TEMPO L3 (NetCDF/HDF5):
+ - open_product: abre el grupo 'product' con las coordenadas lat/lon/time del grupo raíz
+   (en los archivos L3 las coordenadas viven en la raíz, no en 'product').
+ - RegularGrid: grilla lat/lon regular; convierte coordenadas a índices con
+   aritmética directa (sin .sel ni búsquedas), vectorizado sobre arrays NumPy.
+ - snapshot: guarda una variable 2-D como .npy + .json para abrirla con mmap
+   sin volver a tocar el NetCDF.
+"""
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+import json
+import os
+
+import numpy as np
+
+PRODUCT_GROUP = "product"
+NO2_VAR = "vertical_column_troposphere"   # molecules/cm^2
+QA_VAR = "main_data_quality_flag"         # 0 = bueno
+FILL_THRESHOLD = -1e29                    # _FillValue de TEMPO es -1e30
+
+def open_product(path, variables: Optional[Iterable[str]] = None, chunks=None):
+    """
+    Abre el grupo 'product' de un granulo y le asigna latitude/longitude/time
+    de la raíz. variables limita las variables cargadas.
+    """
+    import xarray as xr
+    root = xr.open_dataset(path, chunks=chunks)
+    ds = xr.open_dataset(path, group=PRODUCT_GROUP, chunks=chunks)
+    if variables is not None:
+        ds = ds[list(variables)]
+    coords = {c: root[c] for c in ("time", "latitude", "longitude") if c in root.variables and c in ds.dims}
+    return ds.assign_coords(coords)
+
+def mask_fill(values: np.ndarray) -> np.ndarray:
+    """Copia float32 con los valores de relleno convertidos a NaN."""
+    out = np.asarray(values, dtype=np.float32).copy()
+    out[~np.isfinite(out) | (out < FILL_THRESHOLD)] = np.nan
+    return out
+
+class RegularGrid:
+    """Grilla regular: centro del primer pixel (lat0, lon0), paso (dlat, dlon) y tamaño."""
+    __slots__ = ("lat0", "dlat", "nlat", "lon0", "dlon", "nlon")
+
+    def __init__(self, lat0: float, dlat: float, nlat: int, lon0: float, dlon: float, nlon: int):
+        self.lat0, self.dlat, self.nlat = float(lat0), float(dlat), int(nlat)
+        self.lon0, self.dlon, self.nlon = float(lon0), float(dlon), int(nlon)
+
+    @classmethod
+    def from_coords(cls, lat: np.ndarray, lon: np.ndarray) -> "RegularGrid":
+        """Construye la grilla a partir de los vectores de coordenadas (deben ser regulares)."""
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        for name, v in (("latitude", lat), ("longitude", lon)):
+            if v.size < 2:
+                raise ValueError(f"{name}: se necesitan al menos 2 valores")
+            d = np.diff(v)
+            if not np.allclose(d, d[0], rtol=1e-4, atol=1e-6):
+                raise ValueError(f"{name} no es regular")
+        return cls(lat[0], (lat[-1] - lat[0]) / (lat.size - 1), lat.size,
+                   lon[0], (lon[-1] - lon[0]) / (lon.size - 1), lon.size)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.nlat, self.nlon
+
+    def lats(self) -> np.ndarray:
+        return self.lat0 + self.dlat * np.arange(self.nlat)
+
+    def lons(self) -> np.ndarray:
+        return self.lon0 + self.dlon * np.arange(self.nlon)
+
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """(minlon, minlat, maxlon, maxlat) de los bordes exteriores de la grilla."""
+        lats = (self.lat0 - self.dlat / 2, self.lat0 + self.dlat * (self.nlat - 0.5))
+        lons = (self.lon0 - self.dlon / 2, self.lon0 + self.dlon * (self.nlon - 0.5))
+        return min(lons), min(lats), max(lons), max(lats)
+
+    def fractional_index(self, lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+        """Índices fraccionarios (fila, columna) de cada punto; 0.0 = centro del primer pixel."""
+        fi = (np.asarray(lat, dtype=np.float64) - self.lat0) / self.dlat
+        fj = (np.asarray(lon, dtype=np.float64) - self.lon0) / self.dlon
+        return fi, fj
+
+    def index(self, lat, lon) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Pixel más cercano de cada punto: (filas, columnas, válido)."""
+        fi, fj = self.fractional_index(lat, lon)
+        i = np.rint(fi).astype(np.int64)
+        j = np.rint(fj).astype(np.int64)
+        valid = (i >= 0) & (i < self.nlat) & (j >= 0) & (j < self.nlon)
+        return np.where(valid, i, 0), np.where(valid, j, 0), valid
+
+    def window(self, bbox) -> Tuple[slice, slice]:
+        """Slices (filas, columnas) que cubren bbox = (minlon, minlat, maxlon, maxlat)."""
+        i_a, j_a = self.fractional_index(bbox[1], bbox[0])
+        i_b, j_b = self.fractional_index(bbox[3], bbox[2])
+        i0, i1 = sorted((float(i_a), float(i_b)))
+        j0, j1 = sorted((float(j_a), float(j_b)))
+        rows = slice(max(0, int(np.ceil(i0 - 0.5))), min(self.nlat, int(np.floor(i1 + 0.5)) + 1))
+        cols = slice(max(0, int(np.ceil(j0 - 0.5))), min(self.nlon, int(np.floor(j1 + 0.5)) + 1))
+        return rows, cols
+
+    def to_dict(self) -> Dict:
+        return {s: getattr(self, s) for s in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "RegularGrid":
+        return cls(**{s: d[s] for s in cls.__slots__})
+
+# -------------------- SNAPSHOTS (.npy + .json) -----------
+def write_snapshot(values: np.ndarray, grid: RegularGrid, meta: Dict, out_base: Path) -> Path:
+    """
+    Escribe out_base.npy (float32, NaN = sin dato) y out_base.json (grilla + meta).
+    Se escribe a temporales y se renombra: un lector nunca ve un snapshot a medias.
+    """
+    out_base.parent.mkdir(parents=True, exist_ok=True)
+    npy = out_base.with_suffix(".npy")
+    side = out_base.with_suffix(".json")
+    tmp_npy = npy.with_name(npy.name + ".tmp")
+    with tmp_npy.open("wb") as f:
+        np.save(f, np.ascontiguousarray(values, dtype=np.float32))
+    tmp_side = side.with_name(side.name + ".tmp")
+    tmp_side.write_text(json.dumps({"grid": grid.to_dict(), **meta}), encoding="utf-8")
+    os.replace(tmp_npy, npy)
+    os.replace(tmp_side, side)
+    return npy
+
+def open_snapshot(npy: Path) -> Tuple[np.ndarray, RegularGrid, Dict]:
+    """Abre un snapshot con mmap (solo lectura); no carga el arreglo en RAM."""
+    meta = json.loads(npy.with_suffix(".json").read_text(encoding="utf-8"))
+    grid = RegularGrid.from_dict(meta.pop("grid"))
+    return np.load(npy, mmap_mode="r"), grid, meta
+
+def granule_time_iso(ds) -> Optional[str]:
+    """Primer instante de 'time' del dataset en ISO 8601 con Z, o None."""
+    if "time" not in ds.coords or ds["time"].size == 0:
+        return None
+    t = np.datetime64(ds["time"].values.ravel()[0], "s")
+    return f"{t}Z"
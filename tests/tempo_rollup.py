@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# tempo_rollup.py
+"""
+Compuestos TEMPO NO2 diarios, semanales y mensuales, fuera de memoria e incrementales.
+ - Cada granulo se lee por bloques de filas; se enmascaran relleno y
+   main_data_quality_flag y se actualizan acumuladores por celda
+   (suma, conteo, mínimo, máximo) del día, la semana ISO y el mes del escaneo.
+ - Los acumuladores son .npy en disco abiertos con memmap: la memoria queda
+   acotada a un bloque de filas sin importar la longitud de la ventana.
+ - Un manifiesto SQLite registra qué granulo se aplicó a qué período; un granulo
+   nuevo solo toca sus 3 períodos. Si una corrida se corta a mitad de un granulo,
+   el período afectado se reconstruye desde sus granulos ya registrados.
+ - Los compuestos (mean, min, max, count) se escriben como snapshots
+   .npy + .json (formato de tempo_grid.open_snapshot).
+
+Uso:
+  python tempo_rollup.py --data-dir ./data_tempo --out ./data_tempo/rollups
+"""
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import argparse
+import json
+import logging
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+
+from tempo_grid import FILL_THRESHOLD, NO2_VAR, QA_VAR, RegularGrid, open_product
+
+BLOCK_ROWS = 256
+PERIODS = ("daily", "weekly", "monthly")
+STATS = ("mean", "min", "max", "count")
+
+def period_keys(t: np.datetime64) -> Dict[str, str]:
+    """Claves de día, semana ISO y mes (UTC) de un instante."""
+    d = datetime.fromtimestamp(int(t.astype("datetime64[s]").astype(np.int64)), tz=timezone.utc)
+    year, week, _ = d.isocalendar()
+    return {"daily": d.strftime("%Y-%m-%d"), "weekly": f"{year}-W{week:02d}", "monthly": d.strftime("%Y-%m")}
+
+class Accumulator:
+    """Suma/conteo/mín/máx por celda en memmaps bajo un directorio."""
+    def __init__(self, root: Path, shape: Tuple[int, int]):
+        self.root = root
+        fresh = not (root / "count.npy").exists()
+        root.mkdir(parents=True, exist_ok=True)
+        mode = "w+" if fresh else "r+"
+        om = np.lib.format.open_memmap
+        self.sum = om(root / "sum.npy", mode=mode, dtype=np.float64, shape=shape if fresh else None)
+        self.count = om(root / "count.npy", mode=mode, dtype=np.int32, shape=shape if fresh else None)
+        self.min = om(root / "min.npy", mode=mode, dtype=np.float32, shape=shape if fresh else None)
+        self.max = om(root / "max.npy", mode=mode, dtype=np.float32, shape=shape if fresh else None)
+        if fresh:
+            self.min[:] = np.inf
+            self.max[:] = -np.inf
+
+    def update(self, rows: slice, block: np.ndarray):
+        """Agrega un bloque de filas (NaN = sin dato)."""
+        ok = np.isfinite(block)
+        s = self.sum[rows]
+        np.add(s, np.where(ok, block, 0.0), out=s)
+        c = self.count[rows]
+        np.add(c, ok, out=c, casting="unsafe")
+        mn = self.min[rows]
+        np.fmin(mn, block, out=mn)
+        mx = self.max[rows]
+        np.fmax(mx, block, out=mx)
+
+    def flush(self):
+        for a in (self.sum, self.count, self.min, self.max):
+            a.flush()
+
+    def write_composites(self, grid: RegularGrid, meta: Dict, out_base: Path):
+        """Escribe out_base_{mean,min,max,count}.npy/.json por bloques (sin cargar todo)."""
+        out_base.parent.mkdir(parents=True, exist_ok=True)
+        shape = self.count.shape
+        for stat in STATS:
+            npy = out_base.with_name(f"{out_base.name}_{stat}.npy")
+            tmp = npy.with_name(npy.name + ".tmp")
+            dest = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=shape)
+            for r0 in range(0, shape[0], BLOCK_ROWS):
+                rows = slice(r0, min(shape[0], r0 + BLOCK_ROWS))
+                c = np.asarray(self.count[rows])
+                if stat == "count":
+                    dest[rows] = c
+                    continue
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    vals = self.sum[rows] / c if stat == "mean" else np.asarray(getattr(self, stat)[rows])
+                dest[rows] = np.where(c > 0, vals, np.nan)
+            dest.flush()
+            del dest
+            side = npy.with_suffix(".json")
+            tmp_side = side.with_name(side.name + ".tmp")
+            tmp_side.write_text(json.dumps({"grid": grid.to_dict(), "stat": stat, **meta}), encoding="utf-8")
+            os.replace(tmp, npy)
+            os.replace(tmp_side, side)
+
+class RollupStore:
+    """Acumuladores, manifiesto y compuestos bajo out_dir."""
+    def __init__(self, out_dir: Path, variable: str = NO2_VAR, qa_max: Optional[int] = 0):
+        self.out_dir = out_dir
+        self.variable = variable
+        self.qa_max = qa_max
+        out_dir.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(out_dir / "rollups.sqlite"))
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS applied (
+                granule TEXT NOT NULL,
+                path TEXT NOT NULL,
+                period TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                PRIMARY KEY (granule, period, key)
+            );
+        """)
+        grid_path = out_dir / "grid.json"
+        self.grid = RegularGrid.from_dict(json.loads(grid_path.read_text())) if grid_path.exists() else None
+
+    def _acc(self, period: str, key: str) -> Accumulator:
+        return Accumulator(self.out_dir / "acc" / period / key, self.grid.shape)
+
+    def _set_grid(self, grid: RegularGrid) -> bool:
+        """Fija la grilla del almacén con el primer granulo; False si grid no coincide con ella."""
+        if self.grid is None:
+            self.grid = grid
+            (self.out_dir / "grid.json").write_text(json.dumps(grid.to_dict()), encoding="utf-8")
+        return self.grid.to_dict() == grid.to_dict()
+
+    def _apply(self, nc: Path, targets: List[Tuple[str, str]], t_index: int):
+        """Lee el paso t_index del granulo por bloques y actualiza los acumuladores indicados."""
+        wanted = [self.variable] + ([QA_VAR] if self.qa_max is not None else [])
+        ds = open_product(nc, variables=wanted)
+        try:
+            step = ds.isel(time=t_index) if "time" in ds.dims else ds
+            accs = [self._acc(p, k) for p, k in targets]
+            var = step[self.variable]
+            qa = step[QA_VAR] if self.qa_max is not None and QA_VAR in step else None
+            for r0 in range(0, self.grid.nlat, BLOCK_ROWS):
+                rows = slice(r0, min(self.grid.nlat, r0 + BLOCK_ROWS))
+                block = np.asarray(var.isel(latitude=rows).values, dtype=np.float32)
+                bad = ~np.isfinite(block) | (block < FILL_THRESHOLD)
+                if qa is not None:
+                    bad |= ~(qa.isel(latitude=rows).values <= self.qa_max)
+                block[bad] = np.nan
+                for acc in accs:
+                    acc.update(rows, block)
+            for acc in accs:
+                acc.flush()
+        finally:
+            ds.close()
+
+    def _recover(self) -> Set[Tuple[str, str]]:
+        """Reconstruye los períodos con granulos a medio aplicar (corrida interrumpida)."""
+        broken = self.conn.execute("SELECT DISTINCT period, key FROM applied WHERE state = 'applying'").fetchall()
+        for period, key in broken:
+            logging.warning(f"Reconstruyendo {period}/{key} tras una corrida interrumpida")
+            shutil.rmtree(self.out_dir / "acc" / period / key, ignore_errors=True)
+            with self.conn:
+                self.conn.execute("DELETE FROM applied WHERE period = ? AND key = ? AND state = 'applying'",
+                                  (period, key))
+            for granule, path in self.conn.execute(
+                    "SELECT granule, path FROM applied WHERE period = ? AND key = ?", (period, key)).fetchall():
+                t_index = int(granule.rsplit("#", 1)[1])
+                self._apply(Path(path), [(period, key)], t_index)
+        return set(broken)
+
+    def update(self, nc_paths: Iterable[Path]) -> Set[Tuple[str, str]]:
+        """Aplica los granulos nuevos; retorna los (período, clave) modificados."""
+        import xarray as xr
+        dirty = self._recover() if self.grid is not None else set()
+        for nc in sorted(nc_paths):
+            try:
+                with xr.open_dataset(nc) as root:
+                    times = np.atleast_1d(root["time"].values) if "time" in root.variables else []
+                    grid = RegularGrid.from_coords(root["latitude"].values, root["longitude"].values)
+            except (OSError, KeyError, ValueError) as e:
+                logging.warning(f"Se omite {nc.name}: no se pudo leer su grilla ({e})")
+                continue
+            if not self._set_grid(grid):
+                logging.warning(f"Se omite {nc.name}: no comparte la grilla del almacén de compuestos")
+                continue
+            for t_index, t in enumerate(times):
+                granule = f"{nc.name}#{t_index}"
+                keys = period_keys(np.datetime64(t))
+                known = {p for (p,) in self.conn.execute(
+                    "SELECT period FROM applied WHERE granule = ? AND state = 'done'", (granule,))}
+                targets = [(p, keys[p]) for p in PERIODS if p not in known]
+                if not targets:
+                    continue
+                with self.conn:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO applied (granule, path, period, key, state) VALUES (?, ?, ?, ?, 'applying')",
+                        [(granule, str(nc), p, k) for p, k in targets])
+                self._apply(nc, targets, t_index)
+                with self.conn:
+                    self.conn.execute("UPDATE applied SET state = 'done' WHERE granule = ?", (granule,))
+                dirty.update(targets)
+                logging.info(f"[OK] {granule} -> {', '.join(k for _, k in targets)}")
+        return dirty
+
+    def finalize(self, dirty: Iterable[Tuple[str, str]]):
+        """Reescribe solo los compuestos de los períodos modificados."""
+        for period, key in sorted(dirty):
+            n = self.conn.execute("SELECT COUNT(*) FROM applied WHERE period = ? AND key = ? AND state = 'done'",
+                                  (period, key)).fetchone()[0]
+            meta = {"period": period, "key": key, "granules": n, "variable": self.variable}
+            self._acc(period, key).write_composites(self.grid, meta, self.out_dir / period / key)
+            logging.info(f"Compuesto {period}/{key} ({n} escaneos)")
+
+    def close(self):
+        self.conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compuestos TEMPO diarios/semanales/mensuales incrementales.")
+    parser.add_argument("--data-dir", default="./data_tempo", help="Carpeta con granulos .nc")
+    parser.add_argument("--out", default="", help="Carpeta de salida (por defecto data-dir/rollups)")
+    parser.add_argument("--var", default=NO2_VAR)
+    parser.add_argument("--qa-max", type=int, default=0, help="Máximo main_data_quality_flag (-1 = sin filtro)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    data_dir = Path(args.data_dir)
+    out_dir = Path(args.out) if args.out else data_dir / "rollups"
+    paths = [p for p in data_dir.rglob("*.nc") if p.is_file() and out_dir not in p.parents]
+    store = RollupStore(out_dir, args.var, None if args.qa_max < 0 else args.qa_max)
+    try:
+        dirty = store.update(paths)
+        store.finalize(dirty)
+        logging.info(f"{len(dirty)} compuestos actualizados")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# tempo_service.py
+"""
+Servicio local de muestreo TEMPO NO2 para sampleTempoNo2 (src/services/tempo.ts).
+ - GET  {base}/no2?lat=..&lon=..          -> {"no2": float|null, "timeISO": "..."}
+ - POST {base}/no2  {"points": [[lat, lon], ...]} o [{"lat":..,"lon":..}, ...]
+                                          -> {"no2": [...], "timeISO": "..."}
+ - GET  {base}/health                     -> granulo activo
+El granulo más reciente de --data-dir se convierte una vez a .npy y se abre con
+mmap; cada consulta es aritmética de índices sobre la grilla regular, sin NetCDF.
+Cuando llega un granulo nuevo se convierte en segundo plano y se cambia de forma atómica.
+
+Uso:
+  python tempo_service.py --data-dir ./data_tempo --port 8787
+  (en .env: VITE_TEMPO_API_BASE="http://localhost:8787/tempo")
+"""
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import asyncio
+import json
+import logging
+import math
+
+import numpy as np
+
+from tempo_grid import NO2_VAR, RegularGrid, granule_time_iso, mask_fill, open_product, \
+    open_snapshot, write_snapshot
+
+DEFAULT_PORT = 8787
+DEFAULT_POLL = 60           # segundos entre revisiones de --data-dir
+MAX_BODY = 8 * 1024 * 1024  # bytes aceptados en un POST
+MAX_POINTS = 200_000
+
+# -------------------- GRANULOS -> SNAPSHOT ---------------
+def snapshot_granule(nc_path: Path, serve_dir: Path) -> Path:
+    """Extrae vertical_column_troposphere (primer time) de un granulo a serve_dir/<stem>.npy."""
+    out_base = serve_dir / nc_path.stem
+    npy = out_base.with_suffix(".npy")
+    if npy.exists() and npy.stat().st_mtime >= nc_path.stat().st_mtime:
+        return npy
+    ds = open_product(nc_path, variables=[NO2_VAR])
+    try:
+        var = ds[NO2_VAR]
+        if "time" in var.dims:
+            var = var.isel(time=0)
+        grid = RegularGrid.from_coords(ds["latitude"].values, ds["longitude"].values)
+        values = mask_fill(var.values)
+        meta = {"timeISO": granule_time_iso(ds), "source": nc_path.name}
+    finally:
+        ds.close()
+    logging.info(f"Snapshot {nc_path.name}: grilla {grid.nlat}x{grid.nlon}")
+    return write_snapshot(values, grid, meta, out_base)
+
+def latest_granule(data_dir: Path) -> Optional[Path]:
+    """Granulo .nc más reciente (por nombre, que en TEMPO incluye la hora de escaneo)."""
+    files = sorted((p for p in data_dir.rglob("*.nc") if p.is_file()), key=lambda p: p.name)
+    return files[-1] if files else None
+
+def prune_snapshots(serve_dir: Path, keep: Path):
+    """Borra los snapshots (.npy + .json) que no son el activo."""
+    for npy in serve_dir.glob("*.npy"):
+        if npy.name == keep.name:
+            continue
+        try:
+            npy.unlink()
+        except OSError as e:
+            # En Windows un .npy aún mapeado no se puede borrar; queda para la próxima vez
+            logging.debug(f"No se pudo borrar {npy.name}: {e}")
+            continue
+        npy.with_suffix(".json").unlink(missing_ok=True)
+        logging.info(f"Snapshot anterior eliminado: {npy.name}")
+
+class NO2Store:
+    """
+    Grilla activa. El estado es una sola tupla (arreglo, grilla, meta); cambiarla
+    es una asignación atómica, así las consultas en curso terminan con la anterior.
+    """
+    def __init__(self):
+        self.current: Optional[Tuple[np.ndarray, RegularGrid, Dict]] = None
+
+    def swap(self, npy: Path):
+        self.current = open_snapshot(npy)
+        logging.info(f"Granulo activo: {self.current[2].get('source')} ({self.current[2].get('timeISO')})")
+
+    def sample(self, lats, lons) -> Tuple[List[Optional[float]], Optional[str]]:
+        """Valores NO2 del pixel más cercano para arrays de lat/lon (None fuera de grilla o sin dato)."""
+        state = self.current
+        if state is None:
+            return [None] * len(lats), None
+        values, grid, meta = state
+        i, j, valid = grid.index(lats, lons)
+        out = np.asarray(values[i, j], dtype=np.float64)
+        out[~valid] = np.nan
+        return [None if math.isnan(v) else v for v in out.tolist()], meta.get("timeISO")
+
+async def watch_granules(store: NO2Store, data_dir: Path, serve_dir: Path, poll: float):
+    """Revisa data_dir periódicamente; un granulo nuevo se convierte fuera del event loop."""
+    loop = asyncio.get_running_loop()
+    active = None
+    while True:
+        nc = latest_granule(data_dir)
+        if nc is not None and nc != active:
+            try:
+                npy = await loop.run_in_executor(None, snapshot_granule, nc, serve_dir)
+                store.swap(npy)
+                active = nc
+                prune_snapshots(serve_dir, npy)
+            except Exception as e:
+                logging.error(f"No se pudo cargar {nc.name}: {e}")
+        await asyncio.sleep(poll)
+
+# -------------------- HTTP -------------------------------
+def parse_points(body: bytes) -> Tuple[List[float], List[float]]:
+    """Acepta {"points": [[lat, lon], ...]}, [[lat, lon], ...] o [{"lat":..,"lon":..}, ...]."""
+    data = json.loads(body.decode("utf-8"))
+    if isinstance(data, dict):
+        data = data.get("points", [])
+    if not isinstance(data, list) or len(data) > MAX_POINTS:
+        raise ValueError(f"se espera una lista de hasta {MAX_POINTS} puntos")
+    lats, lons = [], []
+    for p in data:
+        if isinstance(p, dict):
+            lats.append(float(p["lat"]))
+            lons.append(float(p["lon"]))
+        else:
+            lats.append(float(p[0]))
+            lons.append(float(p[1]))
+    return lats, lons
+
+def route(store: NO2Store, method: str, target: str, body: bytes) -> Tuple[int, Dict]:
+    """Resuelve una solicitud y retorna (status, payload JSON)."""
+    url = urlsplit(target)
+    path = url.path.rstrip("/")
+    if path.endswith("/health") or path == "":
+        state = store.current
+        meta = state[2] if state else {}
+        return 200, {"ok": state is not None, "source": meta.get("source"), "timeISO": meta.get("timeISO")}
+    if not path.endswith("/no2"):
+        return 404, {"error": "not found"}
+    if method == "GET":
+        q = parse_qs(url.query)
+        try:
+            lat = float(q["lat"][0])
+            lon = float(q["lon"][0])
+        except (KeyError, IndexError, ValueError):
+            return 400, {"error": "lat y lon numéricos requeridos"}
+        values, time_iso = store.sample([lat], [lon])
+        return 200, {"no2": values[0], "timeISO": time_iso}
+    if method == "POST":
+        try:
+            lats, lons = parse_points(body)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            return 400, {"error": f"cuerpo inválido: {e}"}
+        values, time_iso = store.sample(lats, lons)
+        return 200, {"no2": values, "timeISO": time_iso}
+    return 405, {"error": "método no permitido"}
+
+_REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found",
+            405: "Method Not Allowed", 413: "Payload Too Large"}
+
+def _response(status: int, payload: Optional[Dict], keep_alive: bool) -> bytes:
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else b""
+    headers = [
+        f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+        "Content-Type: application/json; charset=utf-8",
+        f"Content-Length: {len(body)}",
+        "Access-Control-Allow-Origin: *",
+        "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+        "Access-Control-Allow-Headers: Content-Type",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    return ("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body
+
+async def handle(store: NO2Store, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Conexión HTTP/1.1 mínima con keep-alive."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2:
+                break
+            method, target = parts[0].upper(), parts[1]
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = line.decode("latin-1").partition(":")
+                headers[k.strip().lower()] = v.strip()
+            keep_alive = headers.get("connection", "").lower() != "close"
+            length = int(headers.get("content-length", "0") or 0)
+            if length > MAX_BODY:
+                writer.write(_response(413, {"error": "cuerpo demasiado grande"}, False))
+                await writer.drain()
+                break
+            body = await reader.readexactly(length) if length else b""
+            if method == "OPTIONS":
+                status, payload = 204, None
+            else:
+                status, payload = route(store, method, target, body)
+            writer.write(_response(status, payload, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(args):
+    data_dir = Path(args.data_dir)
+    serve_dir = Path(args.serve_dir) if args.serve_dir else data_dir / "serve"
+    store = NO2Store()
+    # Arranque en caliente: último snapshot ya convertido, si existe
+    snaps = sorted(serve_dir.glob("*.npy"), key=lambda p: p.name) if serve_dir.exists() else []
+    if snaps:
+        store.swap(snaps[-1])
+    watcher = asyncio.create_task(watch_granules(store, data_dir, serve_dir, args.poll))
+    server = await asyncio.start_server(lambda r, w: handle(store, r, w), args.host, args.port)
+    logging.info(f"Servicio TEMPO NO2 en http://{args.host}:{args.port}/tempo/no2")
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            watcher.cancel()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servicio de muestreo puntual TEMPO NO2.")
+    parser.add_argument("--data-dir", default="./data_tempo", help="Carpeta con granulos TEMPO L3 (.nc)")
+    parser.add_argument("--serve-dir", default="", help="Carpeta de snapshots .npy (por defecto data-dir/serve)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--poll", type=float, default=DEFAULT_POLL, help="Segundos entre revisiones de granulos nuevos")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        logging.info("Servicio detenido.")
+
+if __name__ == "__main__":
+    main()
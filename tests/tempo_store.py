@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# tempo_store.py
+"""
+Almacén local de granulos TEMPO sobre earthaccess (ea.search_data / descarga HTTPS).
+ - Manifiesto SQLite: concept ID, granule ID (GranuleUR), rango temporal, tamaño,
+   checksum, URL, ruta local y estado.
+ - Un granulo ya presente y verificado no se vuelve a descargar.
+ - Los faltantes de una ventana de tiempo se bajan en paralelo, a archivos .part
+   que se reanudan con Range si la descarga se corta.
+ - sync: modo incremental "desde la última corrida" por colección.
+
+Uso:
+  python tempo_store.py fetch --start 2025-10-01 --end 2025-10-08
+  python tempo_store.py sync              # desde el último granulo registrado
+  python tempo_store.py verify
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CONCEPT_ID = "C3685896708-LARC_CLOUD"   # TEMPO NO2 L3 V04
+DEFAULT_ROOT = "./data_tempo"
+DEFAULT_WORKERS = 6
+CHUNK = 1024 * 1024
+SYNC_OVERLAP = timedelta(hours=2)   # margen para granulos publicados con retraso
+_HASHES = {"MD5": "md5", "SHA-1": "sha1", "SHA-256": "sha256", "SHA-512": "sha512"}
+
+def granule_record(g, concept_id: str) -> Dict:
+    """Extrae del UMM de un granulo de earthaccess los campos del manifiesto."""
+    umm = g.get("umm", {}) if hasattr(g, "get") else {}
+    rng = umm.get("TemporalExtent", {}).get("RangeDateTime", {})
+    info = (umm.get("DataGranule", {}).get("ArchiveAndDistributionInformation") or [{}])[0]
+    checksum = info.get("Checksum") or {}
+    links = g.data_links(access="external") if hasattr(g, "data_links") else []
+    url = next((u for u in links if u.endswith((".nc", ".nc4", ".h5"))), links[0] if links else None)
+    # Solo SizeInBytes es exacto; Size/SizeUnit viene redondeado ("4.2 MB") y no sirve
+    # para comparar con st_size, así que sin él se confía en el checksum
+    size = info.get("SizeInBytes")
+    return {
+        "granule_ur": umm.get("GranuleUR") or (url.rsplit("/", 1)[-1] if url else None),
+        "concept_id": concept_id,
+        "granule_concept_id": g.get("meta", {}).get("concept-id") if hasattr(g, "get") else None,
+        "begin": rng.get("BeginningDateTime"),
+        "end": rng.get("EndingDateTime"),
+        "size": size,
+        "checksum": checksum.get("Value"),
+        "algorithm": checksum.get("Algorithm"),
+        "url": url,
+    }
+
+def file_digest(path: Path, algorithm: str) -> str:
+    h = hashlib.new(_HASHES.get(algorithm.upper(), algorithm.lower().replace("-", "")))
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(CHUNK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class GranuleStore:
+    """Granulos en root/, manifiesto en root/manifest.sqlite."""
+    def __init__(self, root: Path):
+        self.root = root
+        root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(root / "manifest.sqlite"), check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS granules (
+                granule_ur TEXT PRIMARY KEY,
+                concept_id TEXT NOT NULL,
+                granule_concept_id TEXT,
+                begin TEXT,
+                end TEXT,
+                size INTEGER,
+                checksum TEXT,
+                algorithm TEXT,
+                url TEXT,
+                path TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                verified_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS granules_time ON granules (concept_id, begin);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                concept_id TEXT PRIMARY KEY,
+                last_end TEXT,
+                last_run REAL
+            );
+        """)
+        self._session = None
+
+    # ---- manifiesto ----
+    def register(self, records: Iterable[Dict]):
+        """Inserta granulos nuevos como 'pending'; los ya conocidos conservan su estado."""
+        with self._lock, self.conn:
+            for r in records:
+                if not r.get("granule_ur") or not r.get("url"):
+                    continue
+                self.conn.execute("""
+                    INSERT INTO granules (granule_ur, concept_id, granule_concept_id, begin, end,
+                                          size, checksum, algorithm, url)
+                    VALUES (:granule_ur, :concept_id, :granule_concept_id, :begin, :end,
+                            :size, :checksum, :algorithm, :url)
+                    ON CONFLICT(granule_ur) DO UPDATE SET
+                        url = excluded.url,
+                        size = excluded.size,  -- descarta tamaños aproximados de manifiestos viejos
+                        checksum = COALESCE(excluded.checksum, checksum),
+                        algorithm = COALESCE(excluded.algorithm, algorithm)
+                """, r)
+
+    def rows(self, where: str = "1", params=()) -> List[Dict]:
+        with self._lock:
+            cur = self.conn.execute(f"SELECT * FROM granules WHERE {where} ORDER BY begin", params)
+            cols = [c[0] for c in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def _mark(self, granule_ur: str, status: str, path: Optional[Path]):
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE granules SET status = ?, path = ?, verified_at = ? WHERE granule_ur = ?",
+                              (status, str(path) if path else None,
+                               time.time() if status == "done" else None, granule_ur))
+
+    # ---- verificación ----
+    def local_path(self, row: Dict) -> Path:
+        return self.root / row["url"].rsplit("/", 1)[-1]
+
+    def verify_file(self, row: Dict, path: Path) -> bool:
+        """Tamaño y, si el UMM lo publica, checksum."""
+        if not path.exists():
+            return False
+        if row.get("size") and path.stat().st_size != int(row["size"]):
+            return False
+        if row.get("checksum") and row.get("algorithm"):
+            try:
+                return file_digest(path, row["algorithm"]).lower() == row["checksum"].lower()
+            except ValueError:
+                logging.debug(f"Algoritmo de checksum no soportado: {row['algorithm']}")
+        return True
+
+    def reconcile(self, rows: List[Dict]) -> List[Dict]:
+        """Marca como 'done' los que ya están en disco y verifican; retorna los faltantes."""
+        missing = []
+        for row in rows:
+            path = Path(row["path"]) if row.get("path") else self.local_path(row)
+            if row["status"] == "done" and path.exists():
+                continue
+            if self.verify_file(row, path):
+                self._mark(row["granule_ur"], "done", path)
+            else:
+                missing.append(row)
+        return missing
+
+    # ---- descarga ----
+    def _http(self):
+        if self._session is None:
+            import earthaccess as ea
+            self._session = ea.get_requests_https_session()
+        return self._session
+
+    def _download(self, row: Dict) -> Optional[Path]:
+        """Descarga reanudable: continúa el .part existente con Range."""
+        path = self.local_path(row)
+        part = path.with_name(path.name + ".part")
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self._http().get(row["url"], headers=headers, stream=True, timeout=60) as r:
+            if r.status_code == 416:  # el .part ya está completo
+                pass
+            elif r.status_code == 206 and offset:
+                with part.open("ab") as f:
+                    for block in r.iter_content(CHUNK):
+                        f.write(block)
+            else:
+                r.raise_for_status()
+                with part.open("wb") as f:
+                    for block in r.iter_content(CHUNK):
+                        f.write(block)
+        if not self.verify_file(row, part):
+            logging.warning(f"Verificación fallida: {path.name}; se descarta el .part")
+            part.unlink()
+            return None
+        os.replace(part, path)
+        self._mark(row["granule_ur"], "done", path)
+        return path
+
+    def download(self, rows: List[Dict], workers: int = DEFAULT_WORKERS) -> List[Path]:
+        """Descarga en paralelo los granulos indicados (ya filtrados por reconcile)."""
+        done: List[Path] = []
+        if not rows:
+            return done
+        total = sum(int(r["size"] or 0) for r in rows)
+        logging.info(f"Descargando {len(rows)} granulos ({total / 1e9:.2f} GB) con {workers} workers")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futs = {pool.submit(self._download, r): r for r in rows}
+            for fut in as_completed(futs):
+                row = futs[fut]
+                try:
+                    path = fut.result()
+                except Exception as e:
+                    logging.error(f"Error descargando {row['granule_ur']}: {e}")
+                    continue
+                if path:
+                    logging.info(f"[OK] {path.name}")
+                    done.append(path)
+        return done
+
+    # ---- flujos de alto nivel ----
+    def ensure(self, granules, concept_id: str = DEFAULT_CONCEPT_ID,
+               workers: int = DEFAULT_WORKERS) -> List[Path]:
+        """
+        Registra resultados de ea.search_data, baja solo lo faltante y devuelve
+        las rutas locales en el mismo orden.
+        """
+        records = [granule_record(g, concept_id) for g in granules]
+        self.register(records)
+        urs = [r["granule_ur"] for r in records if r.get("granule_ur")]
+        rows = [r for r in self.rows() if r["granule_ur"] in set(urs)]
+        self.download(self.reconcile(rows), workers)
+        by_ur = {r["granule_ur"]: r for r in self.rows() if r["granule_ur"] in set(urs)}
+        return [Path(by_ur[u]["path"]) for u in urs if by_ur.get(u, {}).get("status") == "done"]
+
+    def fetch_window(self, concept_id: str, start: datetime, end: datetime,
+                     workers: int = DEFAULT_WORKERS) -> List[Path]:
+        """Busca todos los granulos de la ventana y asegura que estén en disco."""
+        import earthaccess as ea
+        t0, t1 = start.strftime("%Y-%m-%dT%H:%M:%SZ"), end.strftime("%Y-%m-%dT%H:%M:%SZ")
+        results = ea.search_data(concept_id=concept_id, temporal=(t0, t1))
+        logging.info(f"{len(results)} granulos en {t0} .. {t1}")
+        return self.ensure(results, concept_id, workers)
+
+    def sync(self, concept_id: str = DEFAULT_CONCEPT_ID, since: Optional[datetime] = None,
+             default_days: int = 7, workers: int = DEFAULT_WORKERS) -> List[Path]:
+        """
+        Sincronización incremental: desde el fin del último granulo visto
+        (menos un margen) hasta ahora. La primera vez cubre default_days.
+        Antes se reintentan los granulos del manifiesto que no están 'done'
+        (descargas fallidas o devueltos a 'pending' por verify_all), y last_end
+        no avanza más allá del primer granulo que siga pendiente.
+        """
+        now = datetime.now(timezone.utc)
+        pending = self.rows("concept_id = ? AND status != 'done'", (concept_id,))
+        if pending:
+            logging.info(f"Reintentando {len(pending)} granulos pendientes del manifiesto")
+            self.download(self.reconcile(pending), workers)
+        if since is None:
+            with self._lock:
+                row = self.conn.execute("SELECT last_end FROM sync_state WHERE concept_id = ?",
+                                        (concept_id,)).fetchone()
+            if row and row[0]:
+                since = datetime.fromisoformat(row[0].replace("Z", "+00:00")) - SYNC_OVERLAP
+            else:
+                since = now - timedelta(days=default_days)
+        paths = self.fetch_window(concept_id, since, now, workers)
+        with self._lock:
+            last = self.conn.execute("SELECT MAX(end) FROM granules WHERE concept_id = ? AND status = 'done'",
+                                     (concept_id,)).fetchone()[0]
+            first_missing = self.conn.execute(
+                "SELECT MIN(begin) FROM granules WHERE concept_id = ? AND status != 'done'",
+                (concept_id,)).fetchone()[0]
+            if first_missing and (last is None or first_missing < last):
+                last = first_missing
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO sync_state (concept_id, last_end, last_run) VALUES (?, ?, ?)",
+                                  (concept_id, last, time.time()))
+        return paths
+
+    def verify_all(self) -> int:
+        """Re-verifica los 'done'; los que fallan vuelven a 'pending'. Retorna cuántos fallaron."""
+        bad = 0
+        for row in self.rows("status = 'done'"):
+            if not self.verify_file(row, Path(row["path"])):
+                self._mark(row["granule_ur"], "pending", None)
+                bad += 1
+        return bad
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+def _parse_day(s: str) -> datetime:
+    return datetime.fromisoformat(s).replace(tzinfo=timezone.utc)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Almacén de granulos TEMPO con manifiesto.")
+    parser.add_argument("--root", default=DEFAULT_ROOT, help="Carpeta de granulos")
+    parser.add_argument("--concept-id", default=DEFAULT_CONCEPT_ID)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--verbose", action="store_true")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    f = sub.add_parser("fetch", help="Asegurar todos los granulos de una ventana")
+    f.add_argument("--start", required=True, help="YYYY-MM-DD[THH:MM]")
+    f.add_argument("--end", required=True, help="YYYY-MM-DD[THH:MM] (exclusivo)")
+    s = sub.add_parser("sync", help="Traer lo nuevo desde la última corrida")
+    s.add_argument("--since", default="", help="Forzar inicio (YYYY-MM-DD)")
+    s.add_argument("--days", type=int, default=7, help="Ventana de la primera sincronización")
+    sub.add_parser("verify", help="Re-verificar granulos marcados como descargados")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    store = GranuleStore(Path(args.root))
+    try:
+        if args.cmd == "verify":
+            bad = store.verify_all()
+            logging.info(f"Verificación terminada: {bad} granulos a re-descargar")
+            return
+        import earthaccess as ea
+        ea.login(strategy="netrc")
+        if args.cmd == "fetch":
+            paths = store.fetch_window(args.concept_id, _parse_day(args.start), _parse_day(args.end), args.workers)
+        else:
+            since = _parse_day(args.since) if args.since else None
+            paths = store.sync(args.concept_id, since, args.days, args.workers)
+        logging.info(f"{len(paths)} granulos disponibles localmente")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
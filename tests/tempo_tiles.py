@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# tempo_tiles.py
+"""
+Pirámide de teselas XYZ (Web Mercator) de TEMPO NO2 para VITE_TEMPO_TILE_URL.
+ - El granulo se lee una sola vez; la pirámide se arma con medias por bloques 2x2
+   vectorizadas (ignorando NaN) y cada nivel queda en disco como .npy (mmap).
+ - build: renderiza las teselas PNG (colormap fijo) en un pool de procesos y las
+   guarda en un árbol {z}/{x}/{y}.png o en un archivo MBTiles (SQLite).
+ - serve: sirve /tempo/{z}/{x}/{y}.png; lo que no está en el almacén se renderiza
+   al vuelo desde la pirámide y queda en un LRU de teselas calientes.
+
+Uso:
+  python tempo_tiles.py build data_tempo/granulo.nc --out data_tempo/tiles --max-zoom 7
+  python tempo_tiles.py build data_tempo/granulo.nc --out data_tempo/tempo.mbtiles
+  python tempo_tiles.py serve data_tempo/granulo.nc --store data_tempo/tiles --port 8788
+  (en .env: VITE_TEMPO_TILE_URL="http://localhost:8788/tempo/{z}/{x}/{y}.png")
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import io
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+from PIL import Image
+
+from tempo_grid import NO2_VAR, RegularGrid, granule_time_iso, mask_fill, open_product, \
+    open_snapshot, write_snapshot
+
+TILE_SIZE = 256
+MAX_MERCATOR_LAT = 85.0511287798
+VMIN, VMAX = 0.0, 1.5e16  # molecules/cm^2, rango del colormap
+DEFAULT_MIN_ZOOM = 0
+DEFAULT_MAX_ZOOM = 7
+DEFAULT_LRU = 2048        # teselas en memoria en modo serve
+DEFAULT_PORT = 8788
+# Paradas del colormap (tipo viridis): posición 0..1 -> RGB
+_CMAP_STOPS = [
+    (0.00, (68, 1, 84)), (0.25, (59, 82, 139)), (0.50, (33, 145, 140)),
+    (0.75, (94, 201, 98)), (1.00, (253, 231, 37)),
+]
+
+def _build_lut() -> np.ndarray:
+    pos = np.array([p for p, _ in _CMAP_STOPS])
+    rgb = np.array([c for _, c in _CMAP_STOPS], dtype=np.float64)
+    x = np.linspace(0, 1, 256)
+    return np.stack([np.interp(x, pos, rgb[:, k]) for k in range(3)], axis=1).astype(np.uint8)
+
+LUT = _build_lut()
+
+# -------------------- PIRÁMIDE ---------------------------
+def block_mean(values: np.ndarray) -> np.ndarray:
+    """Media 2x2 ignorando NaN (se rellena con NaN si la dimensión es impar)."""
+    h, w = values.shape
+    padded = np.full((h + h % 2, w + w % 2), np.nan, dtype=np.float32)
+    padded[:h, :w] = values
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    finite = np.isfinite(blocks)
+    total = np.where(finite, blocks, 0).sum(axis=(1, 3), dtype=np.float64)
+    count = finite.sum(axis=(1, 3))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = (total / count).astype(np.float32)
+    out[count == 0] = np.nan
+    return out
+
+def build_pyramid(nc_path: Path, work_dir: Path, levels: int = 6) -> List[Path]:
+    """
+    Lee NO2 una vez y escribe work_dir/level{k}.npy (k=0 resolución nativa,
+    cada nivel con la mitad de resolución). Reutiliza niveles ya construidos.
+    """
+    paths = [work_dir / f"level{k}.npy" for k in range(levels + 1)]
+    if all(p.exists() and p.stat().st_mtime >= nc_path.stat().st_mtime for p in paths):
+        return paths
+    ds = open_product(nc_path, variables=[NO2_VAR])
+    try:
+        var = ds[NO2_VAR]
+        if "time" in var.dims:
+            var = var.isel(time=0)
+        grid = RegularGrid.from_coords(ds["latitude"].values, ds["longitude"].values)
+        values = mask_fill(var.values)
+        meta = {"timeISO": granule_time_iso(ds), "source": nc_path.name}
+    finally:
+        ds.close()
+    for k, path in enumerate(paths):
+        if k > 0:
+            values = block_mean(values)
+            grid = RegularGrid(grid.lat0 + grid.dlat / 2, grid.dlat * 2, values.shape[0],
+                               grid.lon0 + grid.dlon / 2, grid.dlon * 2, values.shape[1])
+        write_snapshot(values, grid, {**meta, "level": k}, path.with_suffix(""))
+    logging.info(f"Pirámide {nc_path.name}: {levels + 1} niveles en {work_dir}")
+    return paths
+
+def load_pyramid(paths: List[Path]) -> List[Tuple[np.ndarray, RegularGrid]]:
+    """Abre los niveles con mmap (ordenados de fino a grueso)."""
+    return [open_snapshot(p)[:2] for p in paths]
+
+# -------------------- RENDER -----------------------------
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(minlon, minlat, maxlon, maxlat) de una tesela XYZ."""
+    n = 2 ** z
+    lon = lambda v: v / n * 360.0 - 180.0
+    lat = lambda v: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * v / n))))
+    return lon(x), lat(y + 1), lon(x + 1), lat(y)
+
+def tiles_covering(bounds: Tuple[float, float, float, float], z: int) -> Iterator[Tuple[int, int, int]]:
+    """Teselas XYZ del nivel z que intersectan bounds."""
+    n = 2 ** z
+    minlon, minlat, maxlon, maxlat = bounds
+    minlat, maxlat = max(minlat, -MAX_MERCATOR_LAT), min(maxlat, MAX_MERCATOR_LAT)
+    to_x = lambda lon: int(np.clip(math.floor((lon + 180.0) / 360.0 * n), 0, n - 1))
+    to_y = lambda lat: int(np.clip(math.floor(
+        (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n), 0, n - 1))
+    for x in range(to_x(minlon), to_x(maxlon) + 1):
+        for y in range(to_y(maxlat), to_y(minlat) + 1):
+            yield z, x, y
+
+def colorize(values: np.ndarray) -> np.ndarray:
+    """NO2 -> RGBA uint8 con el LUT fijo; NaN queda transparente."""
+    finite = np.isfinite(values)
+    scaled = np.clip((np.where(finite, values, VMIN) - VMIN) / (VMAX - VMIN), 0, 1)
+    rgba = np.empty(values.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = LUT[(scaled * 255).astype(np.uint8)]
+    rgba[..., 3] = np.where(finite, 200, 0)
+    return rgba
+
+def render_tile(pyramid: List[Tuple[np.ndarray, RegularGrid]], z: int, x: int, y: int,
+                size: int = TILE_SIZE) -> Optional[bytes]:
+    """
+    PNG de la tesela (z, x, y) o None si no tiene datos. Usa el nivel más
+    grueso cuya celda no supera el tamaño de pixel de la tesela.
+    """
+    n = 2 ** z
+    frac = (np.arange(size) + 0.5) / size
+    lons = (x + frac) / n * 360.0 - 180.0
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + frac) / n))))
+    px_deg = 360.0 / (size * n)
+    values, grid = pyramid[0]
+    for lvl_values, lvl_grid in pyramid:
+        if abs(lvl_grid.dlon) <= px_deg:
+            values, grid = lvl_values, lvl_grid
+    fi, fj = grid.fractional_index(lats, lons)
+    i = np.rint(fi).astype(np.int64)
+    j = np.rint(fj).astype(np.int64)
+    row_ok = (i >= 0) & (i < grid.nlat)
+    col_ok = (j >= 0) & (j < grid.nlon)
+    if not row_ok.any() or not col_ok.any():
+        return None
+    tile = np.asarray(values[np.clip(i, 0, grid.nlat - 1)[:, None], np.clip(j, 0, grid.nlon - 1)[None, :]])
+    tile = np.where(row_ok[:, None] & col_ok[None, :], tile, np.nan)
+    if not np.isfinite(tile).any():
+        return None
+    buf = io.BytesIO()
+    Image.fromarray(colorize(tile), "RGBA").save(buf, format="PNG", optimize=False)
+    return buf.getvalue()
+
+# -------------------- ALMACENES --------------------------
+class DirTileStore:
+    """Árbol {root}/{z}/{x}/{y}.png."""
+    def __init__(self, root: Path):
+        self.root = root
+
+    def get(self, z: int, x: int, y: int) -> Optional[bytes]:
+        p = self.root / str(z) / str(x) / f"{y}.png"
+        return p.read_bytes() if p.exists() else None
+
+    def put(self, z: int, x: int, y: int, data: bytes):
+        p = self.root / str(z) / str(x) / f"{y}.png"
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_name(f"{p.name}.{os.getpid()}.{threading.get_ident()}.tmp")  # serve usa varios hilos
+        tmp.write_bytes(data)
+        os.replace(tmp, p)
+
+    def set_metadata(self, meta: Dict):
+        pass
+
+    def close(self):
+        pass
+
+class MBTilesStore:
+    """Almacén MBTiles (SQLite); las filas siguen el esquema TMS (y invertida)."""
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (
+                zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)
+            );
+        """)
+
+    def get(self, z: int, x: int, y: int) -> Optional[bytes]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, 2 ** z - 1 - y)).fetchone()
+        return row[0] if row else None
+
+    def put(self, z: int, x: int, y: int, data: bytes):
+        self.put_many([(z, x, y, data)])
+
+    def put_many(self, tiles: List[Tuple[int, int, int, bytes]]):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                [(z, x, 2 ** z - 1 - y, sqlite3.Binary(d)) for z, x, y, d in tiles])
+
+    def set_metadata(self, meta: Dict):
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                                  [(k, str(v)) for k, v in meta.items()])
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+def open_store(path: Path):
+    """MBTiles si la ruta termina en .mbtiles; árbol de directorios en otro caso."""
+    return MBTilesStore(path) if path.suffix == ".mbtiles" else DirTileStore(path)
+
+# -------------------- BUILD (pool de procesos) -----------
+_worker_pyramid = None
+
+def _init_worker(paths: List[str]):
+    global _worker_pyramid
+    _worker_pyramid = load_pyramid([Path(p) for p in paths])
+
+def _render_batch(batch: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int, bytes]]:
+    out = []
+    for z, x, y in batch:
+        data = render_tile(_worker_pyramid, z, x, y)
+        if data is not None:
+            out.append((z, x, y, data))
+    return out
+
+def build_tiles(nc_path: Path, out: Path, min_zoom: int, max_zoom: int,
+                workers: int = 0, batch: int = 64) -> int:
+    """Renderiza todas las teselas con datos entre min_zoom y max_zoom. Retorna cuántas escribió."""
+    paths = build_pyramid(nc_path, out.parent / f".{nc_path.stem}_pyramid")
+    base_grid = load_pyramid(paths[:1])[0][1]
+    bounds = base_grid.bounds()
+    jobs = [t for z in range(min_zoom, max_zoom + 1) for t in tiles_covering(bounds, z)]
+    batches = [jobs[k:k + batch] for k in range(0, len(jobs), batch)]
+    store = open_store(out)
+    written = 0
+    try:
+        store.set_metadata({"name": nc_path.stem, "format": "png", "minzoom": min_zoom,
+                            "maxzoom": max_zoom, "bounds": ",".join(f"{v:.4f}" for v in bounds)})
+        with ProcessPoolExecutor(max_workers=workers or None, initializer=_init_worker,
+                                 initargs=([str(p) for p in paths],)) as pool:
+            for tiles in pool.map(_render_batch, batches):
+                if isinstance(store, MBTilesStore):
+                    store.put_many(tiles)
+                else:
+                    for z, x, y, data in tiles:
+                        store.put(z, x, y, data)
+                written += len(tiles)
+    finally:
+        store.close()
+    logging.info(f"{written} teselas con datos de {len(jobs)} candidatas -> {out}")
+    return written
+
+# -------------------- SERVE (bajo demanda) ---------------
+class TileLRU:
+    """LRU de teselas PNG en memoria, seguro entre hilos."""
+    def __init__(self, max_items: int = DEFAULT_LRU):
+        self.max_items = max_items
+        self._items: "OrderedDict[Tuple[int, int, int], Optional[bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return False, None
+            self._items.move_to_end(key)
+            return True, self._items[key]
+
+    def put(self, key, data: Optional[bytes]):
+        with self._lock:
+            self._items[key] = data
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+_TILE_RE = re.compile(r"/(\d+)/(\d+)/(\d+)\.png$")
+
+def make_handler(pyramid, store, lru: TileLRU, write_through: bool):
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            m = _TILE_RE.search(self.path.split("?", 1)[0])
+            if not m:
+                self.send_error(404)
+                return
+            z, x, y = (int(g) for g in m.groups())
+            if z > 22 or x >= 2 ** z or y >= 2 ** z:
+                self.send_error(404)
+                return
+            found, data = lru.get((z, x, y))
+            if not found:
+                data = store.get(z, x, y) if store is not None else None
+                if data is None:
+                    data = render_tile(pyramid, z, x, y)
+                    if data is not None and store is not None and write_through:
+                        store.put(z, x, y, data)
+                lru.put((z, x, y), data)
+            if data is None:
+                self.send_response(204)
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Cache-Control", "public, max-age=600")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt, *args):
+            logging.debug(fmt % args)
+    return TileHandler
+
+def serve_tiles(nc_path: Path, store_path: Optional[Path], host: str, port: int,
+                lru_size: int, write_through: bool):
+    work = (store_path.parent if store_path else nc_path.parent) / f".{nc_path.stem}_pyramid"
+    pyramid = load_pyramid(build_pyramid(nc_path, work))
+    store = open_store(store_path) if store_path else None
+    server = ThreadingHTTPServer((host, port), make_handler(pyramid, store, TileLRU(lru_size), write_through))
+    logging.info(f"Teselas TEMPO en http://{host}:{port}/tempo/{{z}}/{{x}}/{{y}}.png")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Servidor detenido.")
+    finally:
+        server.server_close()
+        if store is not None:
+            store.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pirámide de teselas XYZ de TEMPO NO2.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="Pre-renderizar teselas a un árbol o MBTiles")
+    b.add_argument("granule", help="Granulo TEMPO L3 (.nc)")
+    b.add_argument("--out", required=True, help="Carpeta de teselas o archivo .mbtiles")
+    b.add_argument("--min-zoom", type=int, default=DEFAULT_MIN_ZOOM)
+    b.add_argument("--max-zoom", type=int, default=DEFAULT_MAX_ZOOM)
+    b.add_argument("--workers", type=int, default=0, help="Procesos (0 = núcleos disponibles)")
+    s = sub.add_parser("serve", help="Servir teselas, renderizando bajo demanda las que falten")
+    s.add_argument("granule", help="Granulo TEMPO L3 (.nc)")
+    s.add_argument("--store", default="", help="Carpeta o .mbtiles pre-renderizado (opcional)")
+    s.add_argument("--write-through", action="store_true", help="Guardar en --store las teselas renderizadas")
+    s.add_argument("--lru", type=int, default=DEFAULT_LRU, help="Teselas calientes en memoria")
+    s.add_argument("--host", default="127.0.0.1")
+    s.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    if args.cmd == "build":
+        build_tiles(Path(args.granule), Path(args.out), args.min_zoom, args.max_zoom, args.workers)
+    else:
+        serve_tiles(Path(args.granule), Path(args.store) if args.store else None,
+                    args.host, args.port, args.lru, args.write_through)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# tempo_zarr.py
+"""
+Ingesta de granulos TEMPO L3 a un único almacén Zarr con eje time acumulativo.
+ - Las variables (time, latitude, longitude) del grupo 'product' se agregan
+   al final del eje time, un granulo por paso; los ya ingeridos se saltan.
+   Un granulo anterior al último instante (backfill) obliga a reescribir el
+   almacén ordenado, así time siempre es creciente.
+ - Chunks espaciales pensados para consultas regionales (país x semana):
+   1 paso de tiempo x TILE x TILE pixeles, comprimidos con Blosc/zstd.
+ - Metadatos consolidados: abrir el almacén es una sola lectura.
+ - query abre con dask de forma perezosa y solo lee los chunks que cubren el bbox.
+
+Uso:
+  python tempo_zarr.py ingest --data-dir ./data_tempo --store ./data_tempo/tempo_no2.zarr
+  python tempo_zarr.py query --store ./data_tempo/tempo_no2.zarr \
+      --bbox -93 8 -87 19 --start 2025-10-01 --end 2025-10-08
+  python tempo_zarr.py check --data-dir ./data_tempo   # ida y vuelta en un almacén temporal
+"""
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence
+import argparse
+import logging
+import shutil
+import tempfile
+
+import numpy as np
+
+from tempo_grid import NO2_VAR, QA_VAR, RegularGrid, open_product
+
+DEFAULT_VARS = (NO2_VAR, QA_VAR)
+TILE = 256          # pixeles por lado de cada chunk espacial (~0.02° -> ~5°)
+TIME_CHUNK = 1      # un granulo por chunk: agregar no reescribe chunks existentes
+CLEVEL = 5
+
+def _compression(zarr_format: int) -> dict:
+    """Encoding de compresión según la versión de formato Zarr instalada."""
+    if zarr_format >= 3:
+        from zarr.codecs import BloscCodec
+        return {"compressors": (BloscCodec(cname="zstd", clevel=CLEVEL, shuffle="shuffle"),)}
+    from numcodecs import Blosc
+    return {"compressor": Blosc(cname="zstd", clevel=CLEVEL, shuffle=Blosc.SHUFFLE)}
+
+def _zarr_format() -> int:
+    import zarr
+    return int(zarr.__version__.split(".")[0]) if zarr.__version__[0].isdigit() else 2
+
+def ingested_times(store: Path) -> set:
+    """Instantes ya presentes en el almacén (vacío si aún no existe)."""
+    if not store.exists():
+        return set()
+    import xarray as xr
+    ds = xr.open_zarr(store, consolidated=True)
+    try:
+        return set(ds["time"].values.astype("datetime64[s]").tolist())
+    finally:
+        ds.close()
+
+def load_granule(nc_path: Path, variables: Sequence[str]):
+    """Variables del grupo 'product' con dims (time, latitude, longitude), en float32/compactas."""
+    ds = open_product(nc_path, variables=variables)
+    keep = [v for v in ds.data_vars if {"latitude", "longitude"} <= set(ds[v].dims)]
+    ds = ds[keep]
+    for v in keep:
+        if ds[v].dtype == np.float64:
+            ds[v] = ds[v].astype(np.float32)
+    if "time" not in ds.dims:
+        ds = ds.expand_dims("time")
+    ds.attrs = {"source": nc_path.name}
+    return ds
+
+def _encoding(ds, fmt: int) -> dict:
+    """Chunks (1 paso x TILE x TILE) y compresión de cada variable."""
+    ny, nx = ds.sizes["latitude"], ds.sizes["longitude"]
+    chunks = (TIME_CHUNK, min(TILE, ny), min(TILE, nx))
+    return {v: {"chunks": chunks, **_compression(fmt)} for v in ds.data_vars}
+
+def _rebuild_sorted(store: Path, late: List[Path], variables: Sequence[str], done: set, fmt: int):
+    """
+    Reescribe el almacén con los granulos atrasados intercalados en orden de tiempo.
+    Se escribe al lado (store.rebuild) y se cambia por el original al terminar,
+    así una interrupción deja el almacén anterior intacto.
+    """
+    import xarray as xr
+    tmp = store.with_name(store.name + ".rebuild")
+    old = store.with_name(store.name + ".old")
+    for d in (tmp, old):
+        if d.exists():
+            shutil.rmtree(d)
+    parts = [open_store(store)] if store.exists() else []
+    try:
+        for nc in late:
+            ds = load_granule(nc, variables)
+            times = ds["time"].values.astype("datetime64[s]").tolist()
+            parts.append(ds.isel(time=[k for k, t in enumerate(times) if t not in done]))
+        # join="exact": un granulo con otra grilla falla aquí, antes de tocar el almacén
+        merged = xr.concat(parts, dim="time", join="exact").sortby("time")
+        merged.attrs = {}
+        for v in merged.variables.values():
+            v.encoding = {}
+        merged = merged.chunk({"time": TIME_CHUNK, "latitude": TILE, "longitude": TILE})
+        merged.to_zarr(tmp, mode="w", encoding=_encoding(merged, fmt), consolidated=True)
+    finally:
+        for ds in parts:
+            ds.close()
+    if store.exists():
+        store.rename(old)
+    tmp.rename(store)
+    if old.exists():
+        shutil.rmtree(old)
+
+def ingest(nc_paths: Iterable[Path], store: Path, variables: Sequence[str] = DEFAULT_VARS) -> int:
+    """
+    Agrega al almacén los granulos que falten (en orden temporal: el nombre TEMPO
+    lleva la hora de escaneo). Retorna cuántos pasos de tiempo se escribieron.
+    Los granulos posteriores al último instante guardado se agregan al final; los
+    atrasados (backfill) se juntan y el almacén se reescribe una vez, ordenado.
+    Todos deben compartir grilla.
+    """
+    done = ingested_times(store)
+    last = max(done) if done else None
+    fmt = _zarr_format()
+    written = 0
+    late: List[Path] = []
+    for nc in sorted(nc_paths, key=lambda p: p.name):
+        ds = load_granule(nc, variables)
+        try:
+            times = ds["time"].values.astype("datetime64[s]").tolist()
+            if all(t in done for t in times):
+                logging.debug(f"Ya ingerido: {nc.name}")
+                continue
+            if times != sorted(times) or (last is not None and times[0] <= last):
+                logging.info(f"Atrasado, se intercala al final: {nc.name} ({times[0]} <= {last})")
+                late.append(nc)
+                continue
+            if store.exists():
+                ds.to_zarr(store, mode="a", append_dim="time", consolidated=True)
+            else:
+                ds.to_zarr(store, mode="w", encoding=_encoding(ds, fmt), consolidated=True)
+            done.update(times)
+            last = times[-1]
+            written += len(times)
+            logging.info(f"[OK] {nc.name} -> {store.name} ({ds.sizes['latitude']}x{ds.sizes['longitude']})")
+        finally:
+            ds.close()
+    if late:
+        before = len(done)
+        _rebuild_sorted(store, late, variables, done, fmt)
+        added = len(ingested_times(store)) - before
+        written += added
+        logging.info(f"[OK] {len(late)} granulos atrasados intercalados ({added} pasos); {store.name} reescrito en orden")
+    return written
+
+def open_store(store: Path):
+    """Abre el almacén de forma perezosa (dask, chunks nativos del Zarr)."""
+    import xarray as xr
+    return xr.open_zarr(store, consolidated=True, chunks={})
+
+def subset(ds, bbox: Optional[Sequence[float]] = None, start: Optional[str] = None,
+           end: Optional[str] = None):
+    """
+    Recorte perezoso por bbox = (minlon, minlat, maxlon, maxlat) y rango [start, end).
+    Se usa isel con la ventana calculada por aritmética de grilla, sin importar
+    si latitude es creciente o decreciente; el rango de tiempo es una máscara,
+    correcta aunque el eje time no esté ordenado.
+    """
+    if start or end:
+        t = ds["time"].values
+        keep = np.ones(t.size, dtype=bool)
+        if start:
+            keep &= t >= np.datetime64(start)
+        if end:
+            keep &= t < np.datetime64(end)
+        ds = ds.isel(time=np.flatnonzero(keep))
+    if bbox is not None:
+        grid = RegularGrid.from_coords(ds["latitude"].values, ds["longitude"].values)
+        rows, cols = grid.window(bbox)
+        ds = ds.isel(latitude=rows, longitude=cols)
+    return ds
+
+def regional_mean(store: Path, bbox: Sequence[float], start: Optional[str], end: Optional[str],
+                  variable: str = NO2_VAR, qa_max: Optional[int] = 0) -> List[tuple]:
+    """Media espacial por paso de tiempo dentro del bbox (con máscara de calidad opcional)."""
+    ds = subset(open_store(store), bbox, start, end)
+    values = ds[variable]
+    if qa_max is not None and QA_VAR in ds:
+        values = values.where(ds[QA_VAR] <= qa_max)
+    means = values.mean(dim=("latitude", "longitude")).compute()
+    return [(f"{np.datetime64(t, 's')}Z", float(m)) for t, m in zip(means["time"].values, means.values)]
+
+def roundtrip_check(nc_paths: Sequence[Path], variables: Sequence[str] = DEFAULT_VARS) -> List[str]:
+    """
+    Ingiere los granulos en un almacén temporal, lo reabre y compara cada paso
+    (vía subset por tiempo) con el granulo original. Primero entra la mitad más
+    reciente y luego el resto, así también se prueba el backfill (reescritura
+    ordenada). Lista vacía = todo coincide.
+    """
+    errors = []
+    ordered = sorted(nc_paths, key=lambda p: p.name)
+    with tempfile.TemporaryDirectory(prefix="tempo_zarr_") as tmp:
+        store = Path(tmp) / "check.zarr"
+        ingest(ordered[len(ordered) // 2:], store, variables)
+        ingest(ordered, store, variables)
+        ds = open_store(store)
+        try:
+            t = ds["time"].values
+            if t.size > 1 and not (np.diff(t) > np.timedelta64(0)).all():
+                errors.append("eje time no estrictamente creciente")
+            for nc in nc_paths:
+                src = load_granule(nc, variables)
+                try:
+                    for k, when in enumerate(src["time"].values.astype("datetime64[s]")):
+                        got = subset(ds, start=str(when), end=str(when + np.timedelta64(1, "s")))
+                        if got.sizes["time"] != 1:
+                            errors.append(f"{nc.name} {when}Z: {got.sizes['time']} pasos en el almacén")
+                            continue
+                        for v in src.data_vars:
+                            a = np.asarray(src[v].isel(time=k).values)
+                            b = np.asarray(got[v].isel(time=0).values)
+                            if a.shape != b.shape or not np.array_equal(a, b, equal_nan=a.dtype.kind == "f"):
+                                errors.append(f"{nc.name} {when}Z: {v} difiere")
+                finally:
+                    src.close()
+        finally:
+            ds.close()
+    return errors
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Almacén Zarr de granulos TEMPO.")
+    parser.add_argument("--store", default="./data_tempo/tempo_no2.zarr", help="Ruta del almacén Zarr")
+    parser.add_argument("--verbose", action="store_true")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    i = sub.add_parser("ingest", help="Agregar granulos nuevos al almacén")
+    i.add_argument("--data-dir", default="./data_tempo", help="Carpeta con granulos .nc")
+    i.add_argument("--vars", default=",".join(DEFAULT_VARS), help="Variables del grupo product")
+    q = sub.add_parser("query", help="Media regional por paso de tiempo")
+    q.add_argument("--bbox", type=float, nargs=4, required=True, metavar=("MINLON", "MINLAT", "MAXLON", "MAXLAT"))
+    q.add_argument("--start", default=None, help="Inicio (incluido), ISO 8601")
+    q.add_argument("--end", default=None, help="Fin (excluido), ISO 8601")
+    q.add_argument("--var", default=NO2_VAR)
+    c = sub.add_parser("check", help="Ida y vuelta: ingerir en un almacén temporal y comparar con los granulos")
+    c.add_argument("--data-dir", default="./data_tempo", help="Carpeta con granulos .nc")
+    c.add_argument("--vars", default=",".join(DEFAULT_VARS), help="Variables del grupo product")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    store = Path(args.store)
+    if args.cmd == "check":
+        paths = [p for p in Path(args.data_dir).rglob("*.nc") if p.is_file()]
+        errors = roundtrip_check(paths, [v for v in args.vars.split(",") if v])
+        for e in errors:
+            logging.error(e)
+        logging.info(f"Ida y vuelta de {len(paths)} granulos: {'OK' if not errors else f'{len(errors)} diferencias'}")
+        raise SystemExit(1 if errors else 0)
+    if args.cmd == "ingest":
+        paths = [p for p in Path(args.data_dir).rglob("*.nc") if p.is_file()]
+        n = ingest(paths, store, [v for v in args.vars.split(",") if v])
+        logging.info(f"{n} pasos de tiempo agregados a {store}")
+    else:
+        for t, m in regional_mean(store, args.bbox, args.start, args.end, args.var):
+            print(f"{t}\t{m:.4e}")
+
+if __name__ == "__main__":
+    main()
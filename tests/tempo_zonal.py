@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# tempo_zonal.py
+"""
+Estadísticas zonales TEMPO NO2 para muchas regiones a la vez.
+ - Las regiones (GeoJSON: países, departamentos, municipios; puntos = ciudades con
+   buffer_km) se rasterizan una sola vez sobre la grilla TEMPO y la grilla de
+   etiquetas se guarda en caché (.npy) para las siguientes corridas.
+ - Por cada paso de tiempo: un gather de los pixeles etiquetados, bincount para
+   count/mean/std y un único lexsort para min/percentiles/max de todas las regiones.
+   El costo por región casi no cambia al agregar regiones.
+ - Salida en tabla "tidy" (CSV) escrita fila a fila mientras se procesan granulos.
+
+Cada archivo GeoJSON es un nivel; dentro de un nivel las regiones no deberían
+traslaparse (si se traslapan, el pixel queda en la primera). Para países y
+departamentos a la vez, pasar dos archivos.
+
+Uso:
+  python tempo_zonal.py --regions paises.geojson deptos.geojson --data-dir ./data_tempo --out zonal.csv
+"""
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import math
+import os
+
+import numpy as np
+
+from tempo_grid import NO2_VAR, QA_VAR, RegularGrid, granule_time_iso, mask_fill, open_product
+
+PERCENTILES = (10, 50, 90)
+DEFAULT_BUFFER_KM = 10.0
+KM_PER_DEG = 111.32
+FIELDS = ["time", "level", "region", "count", "mean", "std", "min"] + \
+         [f"p{q}" for q in PERCENTILES] + ["max"]
+
+# -------------------- REGIONES -> ETIQUETAS ---------------
+def load_regions(path: Path, name_field: str = "name") -> Tuple[List[str], list]:
+    """Lee un GeoJSON y retorna (nombres, geometrías shapely); los puntos se convierten en buffers."""
+    from shapely.geometry import shape
+    data = json.loads(path.read_text(encoding="utf-8"))
+    feats = data["features"] if data.get("type") == "FeatureCollection" else [data]
+    names, geoms = [], []
+    for n, feat in enumerate(feats):
+        props = feat.get("properties") or {}
+        geom = shape(feat["geometry"])
+        if geom.geom_type in ("Point", "MultiPoint"):
+            km = float(props.get("buffer_km", DEFAULT_BUFFER_KM))
+            # buffer en grados, escalado en longitud por cos(lat)
+            from shapely import affinity
+            lat = geom.centroid.y
+            circle = geom.buffer(km / KM_PER_DEG)
+            geom = affinity.scale(circle, xfact=1 / max(0.01, math.cos(math.radians(lat))), yfact=1.0)
+        names.append(str(props.get(name_field, f"region_{n}")))
+        geoms.append(geom)
+    return names, geoms
+
+def rasterize(geoms: Sequence, grid: RegularGrid) -> np.ndarray:
+    """Etiqueta int32 por pixel: 0 = fuera, k = geoms[k-1] (centro del pixel dentro)."""
+    import shapely
+    labels = np.zeros(grid.shape, dtype=np.int32)
+    lats, lons = grid.lats(), grid.lons()
+    for k, geom in enumerate(geoms, start=1):
+        if geom.is_empty:
+            continue
+        rows, cols = grid.window(geom.bounds)
+        if rows.start >= rows.stop or cols.start >= cols.stop:
+            continue
+        shapely.prepare(geom)
+        X, Y = np.meshgrid(lons[cols], lats[rows])
+        inside = shapely.contains_xy(geom, X, Y)
+        block = labels[rows, cols]
+        block[inside & (block == 0)] = k
+    return labels
+
+class ZoneIndex:
+    """
+    Grilla de etiquetas compactada: solo los pixeles que caen en alguna región
+    (índices planos + etiqueta), ordenados por etiqueta.
+    """
+    def __init__(self, level: str, names: List[str], labels: np.ndarray):
+        self.level = level
+        self.names = names
+        flat = labels.ravel()
+        idx = np.flatnonzero(flat)
+        order = np.argsort(flat[idx], kind="stable")
+        self.pixels = idx[order]
+        self.labels = flat[self.pixels] - 1   # 0..K-1
+        self.nregions = len(names)
+
+    @classmethod
+    def build(cls, regions_path: Path, grid: RegularGrid, cache_dir: Path,
+              name_field: str = "name") -> "ZoneIndex":
+        """Rasteriza o reutiliza la caché (clave: contenido del GeoJSON + grilla)."""
+        h = hashlib.sha1(regions_path.read_bytes())
+        h.update(json.dumps(grid.to_dict(), sort_keys=True).encode())
+        h.update(name_field.encode())
+        cache = cache_dir / f"labels_{regions_path.stem}_{h.hexdigest()[:16]}.npy"
+        names_path = cache.with_suffix(".json")
+        if cache.exists() and names_path.exists():
+            labels = np.load(cache)
+            names = json.loads(names_path.read_text(encoding="utf-8"))
+            logging.debug(f"Etiquetas desde caché: {cache.name}")
+        else:
+            names, geoms = load_regions(regions_path, name_field)
+            labels = rasterize(geoms, grid)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp = cache.with_name(cache.name + ".tmp")
+            with tmp.open("wb") as f:
+                np.save(f, labels)
+            names_path.write_text(json.dumps(names, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, cache)
+            logging.info(f"Rasterizadas {len(names)} regiones de {regions_path.name}")
+        return cls(regions_path.stem, names, labels)
+
+# -------------------- ESTADÍSTICAS ------------------------
+def zonal_stats(values: np.ndarray, zones: ZoneIndex) -> Dict[str, np.ndarray]:
+    """
+    Estadísticas de todas las regiones para un campo 2-D (NaN = sin dato).
+    Retorna arrays de largo K: count, mean, std, min, p.., max.
+    """
+    v = np.asarray(values, dtype=np.float64).ravel()[zones.pixels]
+    lab = zones.labels
+    ok = np.isfinite(v)
+    v, lab = v[ok], lab[ok]
+    K = zones.nregions
+    count = np.bincount(lab, minlength=K)
+    s = np.bincount(lab, weights=v, minlength=K)
+    ss = np.bincount(lab, weights=v * v, minlength=K)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = s / count
+        std = np.sqrt(np.maximum(ss / count - mean * mean, 0.0))
+    # Orden por (región, valor): cada región queda como un tramo contiguo ordenado
+    sv = v[np.lexsort((v, lab))]
+    start = np.cumsum(count) - count
+    has = count > 0
+    last = start + np.maximum(count - 1, 0)
+    out = {"count": count, "mean": mean, "std": std}
+
+    def at(q: float) -> np.ndarray:
+        pos = start + q * np.maximum(count - 1, 0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, last)
+        frac = pos - lo
+        res = np.full(K, np.nan)
+        res[has] = sv[lo[has]] * (1 - frac[has]) + sv[hi[has]] * frac[has]
+        return res
+
+    out["min"] = at(0.0)
+    for q in PERCENTILES:
+        out[f"p{q}"] = at(q / 100.0)
+    out["max"] = at(1.0)
+    return out
+
+def iter_fields(nc_paths: Sequence[Path], variable: str = NO2_VAR,
+                qa_max: Optional[int] = 0) -> Iterator[Tuple[str, np.ndarray, RegularGrid]]:
+    """Recorre granulos y pasos de tiempo: (timeISO, campo enmascarado, grilla). Un granulo en memoria."""
+    for nc in sorted(nc_paths):
+        wanted = [variable] + ([QA_VAR] if qa_max is not None else [])
+        ds = open_product(nc, variables=wanted)
+        try:
+            grid = RegularGrid.from_coords(ds["latitude"].values, ds["longitude"].values)
+            times = np.atleast_1d(ds["time"].values) if "time" in ds.coords else []
+            for t in range(ds.sizes.get("time", 1)):
+                step = ds.isel(time=t) if "time" in ds.dims else ds
+                field = mask_fill(step[variable].values)
+                if qa_max is not None and QA_VAR in step:
+                    field[~(step[QA_VAR].values <= qa_max)] = np.nan
+                time_iso = f"{np.datetime64(times[t], 's')}Z" if len(times) > t else granule_time_iso(ds) or nc.stem
+                yield time_iso, field, grid
+        finally:
+            ds.close()
+
+def iter_rows(fields, zone_sets: Sequence[ZoneIndex]) -> Iterator[Dict]:
+    """Filas tidy (una por tiempo x nivel x región con datos)."""
+    for time_iso, field, _grid in fields:
+        for zones in zone_sets:
+            st = zonal_stats(field, zones)
+            for k in np.flatnonzero(st["count"]):
+                row = {"time": time_iso, "level": zones.level, "region": zones.names[k]}
+                for key in FIELDS[3:]:
+                    val = st[key][k]
+                    row[key] = int(val) if key == "count" else f"{val:.6e}"
+                yield row
+
+def run(regions: Sequence[Path], nc_paths: Sequence[Path], out_csv: Path, cache_dir: Path,
+        name_field: str = "name", variable: str = NO2_VAR, qa_max: Optional[int] = 0) -> int:
+    """Procesa todo y escribe el CSV en streaming. Retorna filas escritas."""
+    fields = iter_fields(nc_paths, variable, qa_max)
+    zone_sets: Optional[List[ZoneIndex]] = None
+    written = 0
+    out_csv.parent.mkdir(parents=True, exist_ok=True)
+    with out_csv.open("w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=FIELDS)
+        w.writeheader()
+        for time_iso, field, grid in fields:
+            # La grilla del primer granulo define las etiquetas (L3 comparte grilla)
+            if zone_sets is None:
+                zone_sets = [ZoneIndex.build(p, grid, cache_dir, name_field) for p in regions]
+            for row in iter_rows([(time_iso, field, grid)], zone_sets):
+                w.writerow(row)
+                written += 1
+            f.flush()
+    return written
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Estadísticas zonales TEMPO NO2 para muchas regiones.")
+    parser.add_argument("--regions", nargs="+", required=True, help="Archivos GeoJSON (uno por nivel)")
+    parser.add_argument("--name-field", default="name", help="Propiedad con el nombre de la región")
+    parser.add_argument("--data-dir", default="./data_tempo", help="Carpeta con granulos .nc")
+    parser.add_argument("--var", default=NO2_VAR)
+    parser.add_argument("--qa-max", type=int, default=0, help="Máximo main_data_quality_flag aceptado (-1 = sin filtro)")
+    parser.add_argument("--cache-dir", default="", help="Caché de etiquetas (por defecto data-dir/zonal_cache)")
+    parser.add_argument("--out", default="zonal_stats.csv")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    data_dir = Path(args.data_dir)
+    cache_dir = Path(args.cache_dir) if args.cache_dir else data_dir / "zonal_cache"
+    paths = [p for p in data_dir.rglob("*.nc") if p.is_file()]
+    if not paths:
+        logging.error(f"No hay granulos .nc en {data_dir}")
+        return
+    n = run([Path(p) for p in args.regions], paths, Path(args.out), cache_dir,
+            args.name_field, args.var, None if args.qa_max < 0 else args.qa_max)
+    logging.info(f"{n} filas escritas en {args.out}")
+
+if __name__ == "__main__":
+    main()